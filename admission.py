@@ -0,0 +1,179 @@
+# -*- encoding: utf-8 -*-
+# Copyright (C) 2009 Guillermo Gonzalez
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+"""Admission control of the requests of the xmlrpc service.
+
+Each request has a priority: high, normal or low. The client can give it
+with the X-Bzr-Priority header, if not it's taken from the method and the
+bzr command (see get_priority).
+
+Up to max_running normal and low priority requests run at the same time,
+the others wait in a queue for their turn, higher priority first. When the
+queue is full the request is rejected with ServiceOverloaded, that tells
+the client when to retry. The low priority requests are rejected when the
+queue is half full, leaving room for the others. High priority requests
+(cheap ones, like hello) don't wait.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+from bzrlib import errors
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+priorities = {'high': HIGH, 'normal': NORMAL, 'low': LOW}
+
+# the methods that don't run bzr commands
+high_priority_methods = set([
+    'hello',
+    'list_methods',
+    'quit',
+    'metrics',
+    'job_status',
+    'job_result',
+    'cancel_job',
+    ])
+
+# the methods that run the bzr command in their first argument
+command_methods = set([
+    'run_bzr',
+    'run_bzr_command',
+    'profile_bzr',
+    'stream_run_bzr',
+    'stream_run_bzr_command',
+    ])
+
+# the methods and bzr commands that can take long, on a big history
+low_priority_commands = set([
+    'annotate',
+    'xmlannotate',
+    'log',
+    'xmllog',
+    'missing',
+    'xmlmissing',
+    'search',
+    'check',
+    ])
+
+_state = threading.local()
+
+
+class ServiceOverloaded(errors.BzrError):
+
+    _fmt = ('The service is overloaded, retry after %(retry_after)s '
+            'seconds.')
+
+    def __init__(self, retry_after):
+        errors.BzrError.__init__(self, retry_after=retry_after)
+
+
+def set_priority_hint(hint):
+    """Set the priority (high, normal or low) the client asked for the
+    request handled by this thread (None if it didn't).
+    """
+    _state.hint = hint
+
+
+def get_priority(name, args):
+    """Return the priority of a call to the method name with args."""
+    hint = getattr(_state, 'hint', None)
+    if hint in priorities:
+        return priorities[hint]
+    if name in high_priority_methods:
+        return HIGH
+    if name in low_priority_commands:
+        return LOW
+    if name in command_methods and args:
+        argv = args[0]
+        if len(argv) > 1 and argv[1] in low_priority_commands:
+            return LOW
+    return NORMAL
+
+
+class Admission(object):
+    """Lets up to max_running requests run, and up to max_queued wait.
+
+    0 max_running disables the admission control.
+    """
+
+    def __init__(self, max_running=0, max_queued=16):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self._condition = threading.Condition()
+        self._running = 0
+        self._waiting = []
+        self._counter = itertools.count()
+        # the average time of the requests, to estimate the retry after
+        self._average = 1.0
+        self.rejected = 0
+
+    def call(self, priority, func, *args, **kwargs):
+        """Call func when it's the turn of a request with priority.
+
+        :raise ServiceOverloaded: if there is no room to wait.
+        """
+        if not self.max_running or priority == HIGH:
+            return func(*args, **kwargs)
+        self._acquire(priority)
+        start_time = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._release(time.time() - start_time)
+
+    def _acquire(self, priority):
+        self._condition.acquire()
+        try:
+            if self._running < self.max_running and not self._waiting:
+                self._running += 1
+                return
+            limit = self.max_queued
+            if priority == LOW:
+                limit = self.max_queued // 2
+            if len(self._waiting) >= limit:
+                self.rejected += 1
+                raise ServiceOverloaded(self._get_retry_after())
+            entry = (priority, self._counter.next())
+            heapq.heappush(self._waiting, entry)
+            while self._running >= self.max_running or \
+                    self._waiting[0] != entry:
+                self._condition.wait()
+            heapq.heappop(self._waiting)
+            self._running += 1
+            # there can be more free slots
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def _release(self, elapsed):
+        self._condition.acquire()
+        try:
+            self._running -= 1
+            self._average = 0.9 * self._average + 0.1 * elapsed
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def _get_retry_after(self):
+        """Estimate the seconds until the queue has room again."""
+        waits = float(len(self._waiting) + 1) / self.max_running
+        return max(1, int(round(self._average * waits)))
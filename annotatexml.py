@@ -36,7 +36,7 @@ except ImportError:
     from bzrlib.annotate import _annotate_file
     from bzrlib.annotate import _annotations
 
-from bzrlib import osutils
+from bzrlib import errors, osutils
 
 from writer import _escape_cdata
 
@@ -58,6 +58,45 @@ def annotate_file_xml(branch, rev_id, file_id, to_file=None,
                   (wt_root_path,
                   'file="%s"' % file_path)).encode(encoding, 'replace'))
 
+    for (revno_str, author, date_str, line_rev_id,
+        text, origin) in iter_annotations(branch, rev_id, file_id):
+        if not show_ids:
+            origin = None
+        prevanno = _show_entry(to_file, prevanno, revno_str, author,
+            date_str, line_rev_id, text, origin)
+    to_file.write('</annotation>')
+
+
+def get_annotate_target(wt, branch, relpath, filename, revision=None):
+    """Return the file_id and the revision to annotate.
+
+    The working tree (if any) or the branch must be read locked.
+
+    :param revision: None for the branch tip, or a list of one RevisionSpec.
+    :return: (file_id, file_revision)
+    """
+    if revision is None:
+        revision_id = branch.last_revision()
+    elif len(revision) != 1:
+        raise errors.BzrCommandError(
+            'xmlannotate --revision takes exactly 1 argument')
+    else:
+        revision_id = revision[0].in_history(branch).rev_id
+    tree = branch.repository.revision_tree(revision_id)
+    if wt is not None:
+        file_id = wt.path2id(relpath)
+    else:
+        file_id = tree.path2id(relpath)
+    if file_id is None:
+        raise errors.NotVersionedError(filename)
+    return file_id, tree.get_file_revision(file_id)
+
+
+def iter_annotations(branch, rev_id, file_id):
+    """Iterate over the annotated lines of file_id in rev_id.
+
+    Yields (revno_str, author, date_str, line_rev_id, text, origin).
+    """
     if _annotate_file: # bzr < 1.8
         annotations = _annotations(branch.repository, file_id, rev_id)
         annotation = list(_annotate_file(branch, rev_id, file_id))
@@ -65,14 +104,7 @@ def annotate_file_xml(branch, rev_id, file_id, to_file=None,
         tree = branch.repository.revision_tree(rev_id)
         annotations = tree.annotate_iter(file_id)
         annotation = list(_expand_annotations(annotations, branch))
-
-    for (revno_str, author, date_str, line_rev_id,
-        text, origin) in _annotation_iter(annotation, annotations):
-        if not show_ids:
-            origin = None
-        prevanno = _show_entry(to_file, prevanno, revno_str, author,
-            date_str, line_rev_id, text, origin)
-    to_file.write('</annotation>')
+    return _annotation_iter(annotation, annotations)
 
 
 def _annotation_iter(annotation, annotations):
@@ -0,0 +1,414 @@
+# -*- encoding: utf-8 -*-
+# Copyright (C) 2009 Guillermo Gonzalez
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+"""An asynchronous client of the xmlrpc service, for programs that run an
+asyncore loop.
+
+The calls return right away a Call, that is done when the response arrives
+(see Call.add_callback). The requests are sent over up to max_connections
+connections kept open, up to pipeline of them in each connection without
+waiting for the responses. Each call can have a timeout, and the output of
+a command run with stream is passed to a callback as it arrives.
+
+Like client.py, it only uses the standard library.
+"""
+
+import asynchat
+import asyncore
+import collections
+import socket
+import sys
+import time
+import urlparse
+import xmlrpclib
+from xmlrpclib import Fault
+
+from client import default_url
+
+
+class CallTimeout(Exception):
+    """The response of a call didn't arrive in time."""
+
+
+class Call(object):
+    """A request sent by an AsyncClient, done when its response arrives."""
+
+    def __init__(self, body, path, timeout=None, on_chunk=None):
+        self.body = body
+        self.path = path
+        self.timeout = timeout
+        self.deadline = None
+        if timeout:
+            self.deadline = time.time() + timeout
+        self.on_chunk = on_chunk
+        self.done = False
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def add_callback(self, callback):
+        """Call callback(call) when the call is done (now if it's done)."""
+        if self.done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def result(self):
+        """Return the result of the call, or raise its error (a Fault,
+        CallTimeout or socket.error).
+        """
+        if not self.done:
+            raise ValueError('the call is not done')
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def _finish(self, result=None, error=None):
+        if self.done:
+            return
+        self.done = True
+        self._result = result
+        self._error = error
+        callbacks = self._callbacks
+        self._callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+
+class _Connection(asynchat.async_chat):
+    """A connection to the service, that reads the responses of the calls
+    sent through it in order.
+    """
+
+    def __init__(self, client):
+        asynchat.async_chat.__init__(self, map=client.map)
+        self.client = client
+        self.calls = []
+        self.responses = 0
+        self.create_socket(client.family, socket.SOCK_STREAM)
+        self.connect(client.address)
+        self._start_response()
+
+    def send_call(self, call):
+        headers = ['POST %s HTTP/1.1' % call.path,
+                   'Host: %s' % self.client.host,
+                   'Content-Type: text/xml',
+                   'Content-Length: %d' % len(call.body)]
+        if call.timeout:
+            headers.append('X-Bzr-Timeout: %s' % call.timeout)
+        if self.client.priority is not None:
+            headers.append('X-Bzr-Priority: %s' % self.client.priority)
+        if call.on_chunk is not None:
+            headers.append('TE: trailers')
+        self.calls.append(call)
+        self.push('\r\n'.join(headers) + '\r\n\r\n' + call.body)
+
+    def is_streaming(self):
+        for call in self.calls:
+            if call.on_chunk is not None:
+                return True
+        return False
+
+    def _start_response(self):
+        self._state = 'headers'
+        self._data = []
+        self._received = False
+        self.set_terminator('\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        self._received = True
+        self._data.append(data)
+
+    def found_terminator(self):
+        data = ''.join(self._data)
+        self._data = []
+        if self._state == 'headers':
+            self._read_headers(data)
+        elif self._state == 'body':
+            self._response_done(data, None)
+        elif self._state == 'chunk-size':
+            size = int(data.split(';', 1)[0], 16)
+            if size == 0:
+                self._state = 'trailer'
+                self._trailer = {}
+                self.set_terminator('\r\n')
+            else:
+                self._state = 'chunk'
+                self.set_terminator(size + 2)
+        elif self._state == 'chunk':
+            call = self.calls[0]
+            if call.on_chunk is None:
+                self._body.append(data[:-2])
+            else:
+                call.on_chunk(data[:-2])
+            self._state = 'chunk-size'
+            self.set_terminator('\r\n')
+        elif self._state == 'trailer':
+            if data:
+                name, value = data.split(':', 1)
+                self._trailer[name.strip().lower()] = value.strip()
+            else:
+                self._response_done(''.join(self._body), self._trailer)
+
+    def _read_headers(self, data):
+        lines = data.split('\r\n')
+        version, status, reason = (lines[0].split(None, 2) + [''])[:3]
+        self._status = int(status)
+        self._reason = reason
+        self._headers = {}
+        for line in lines[1:]:
+            name, value = line.split(':', 1)
+            self._headers[name.strip().lower()] = value.strip()
+        self._close = version == 'HTTP/1.0' or \
+            self._headers.get('connection', '').lower() == 'close'
+        self._body = []
+        if self._headers.get('transfer-encoding', '').lower() == 'chunked':
+            self._state = 'chunk-size'
+            self.set_terminator('\r\n')
+            return
+        length = int(self._headers.get('content-length', 0))
+        if length == 0:
+            self._response_done('', None)
+        else:
+            self._state = 'body'
+            self.set_terminator(length)
+
+    def _response_done(self, body, trailer):
+        call = self.calls.pop(0)
+        self.responses += 1
+        status, reason, headers = self._status, self._reason, self._headers
+        if self._close:
+            # the service didn't read the next requests
+            self.close()
+            calls = self.calls
+            self.calls = []
+            self.client._connection_closed(self, calls)
+        else:
+            self._start_response()
+        if status != 200:
+            call._finish(error=xmlrpclib.ProtocolError(
+                self.client.url, status, reason, headers))
+        elif trailer is not None and call.on_chunk is not None:
+            _finish_stream(call, trailer)
+        else:
+            _finish_xmlrpc(call, body)
+        self.client._dispatch()
+
+    def handle_connect(self):
+        pass
+
+    def handle_close(self):
+        self._fail(socket.error('the connection was closed by the service'))
+
+    def handle_error(self):
+        self._fail(sys.exc_info()[1])
+
+    def _fail(self, error):
+        """Close the connection after an error, the calls that the service
+        didn't handle are sent again.
+        """
+        self.close()
+        calls = self.calls
+        self.calls = []
+        if calls and (self._received or not self.responses):
+            # the first call was being handled by the service
+            calls.pop(0)._finish(error=error)
+        self.client._connection_closed(self, calls)
+        self.client._dispatch()
+
+
+def _finish_xmlrpc(call, body):
+    try:
+        result = xmlrpclib.loads(body)[0][0]
+    except Exception, e:
+        call._finish(error=e)
+    else:
+        call._finish(result)
+
+
+def _finish_stream(call, trailer):
+    if 'x-bzr-fault-code' in trailer:
+        call._finish(error=Fault(int(trailer['x-bzr-fault-code']),
+                     trailer['x-bzr-fault-string'].decode('base64')))
+    else:
+        call._finish((int(trailer['x-bzr-exit-status']),
+                      trailer['x-bzr-stderr'].decode('base64')))
+
+
+class AsyncClient(object):
+    """Sends calls to the service at url (or listening on socket_path)
+    without blocking.
+
+    :param max_connections: the connections open at the same time.
+    :param pipeline: the calls sent in each connection before their
+        responses arrive.
+    :param timeout: the default timeout of the calls in seconds.
+    :param priority: the priority of the requests (high, normal or low).
+    :param map: the asyncore map of the connections (asyncore.socket_map by
+        default, so they are handled by the loop of the program).
+    """
+
+    def __init__(self, url=None, socket_path=None, max_connections=8,
+                 pipeline=4, timeout=None, priority=None, map=None):
+        if socket_path is not None:
+            self.url = 'http://localhost/'
+            self.host = 'localhost'
+            self.family = socket.AF_UNIX
+            self.address = socket_path
+        else:
+            if url is None:
+                url = default_url
+            self.url = url
+            parts = urlparse.urlsplit(url)
+            self.host = parts.netloc
+            self.family = socket.AF_INET
+            self.address = (parts.hostname, parts.port or 80)
+        self.max_connections = max_connections
+        self.pipeline = pipeline
+        self.timeout = timeout
+        self.priority = priority
+        if map is None:
+            map = asyncore.socket_map
+        self.map = map
+        self._queue = collections.deque()
+        self._connections = []
+
+    def call(self, method, params=(), timeout=None):
+        """Call method with params.
+
+        :param timeout: the seconds to wait for the response, instead of
+            the default timeout. The service gets the same timeout.
+        :return: a Call.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        return self._submit(Call(xmlrpclib.dumps(tuple(params), method),
+                                 '/RPC2', timeout))
+
+    def run_bzr(self, argv, workdir, timeout=None):
+        """Run a bzr command, the result is (exit_status, output, stderr)."""
+        return self.call('run_bzr_command', (argv, workdir), timeout)
+
+    def stream(self, argv, workdir, on_chunk, method='run_bzr_command',
+               timeout=None):
+        """Run a bzr command, calling on_chunk with its output as it
+        arrives.
+
+        :param method: run_bzr_command or run_bzr (errors reported as xml).
+        :return: a Call, its result is (exit_status, stderr).
+        """
+        if timeout is None:
+            timeout = self.timeout
+        return self._submit(Call(xmlrpclib.dumps((argv, workdir), method),
+                                 '/stream', timeout, on_chunk))
+
+    def pending(self):
+        """Return the number of calls that aren't done."""
+        count = len(self._queue)
+        for connection in self._connections:
+            count += len(connection.calls)
+        return count
+
+    def _submit(self, call):
+        self._queue.append(call)
+        self._dispatch()
+        return call
+
+    def _dispatch(self):
+        """Send the queued calls through the less busy connections."""
+        while self._queue:
+            connection = None
+            for candidate in self._connections:
+                if len(candidate.calls) < self.pipeline and \
+                        not candidate.is_streaming() and \
+                        (connection is None or
+                         len(candidate.calls) < len(connection.calls)):
+                    connection = candidate
+            can_open = len(self._connections) < self.max_connections
+            if connection is None and not can_open:
+                break
+            if connection is None or (connection.calls and can_open):
+                try:
+                    connection = _Connection(self)
+                except socket.error, e:
+                    self._queue.popleft()._finish(error=e)
+                    continue
+                self._connections.append(connection)
+            call = self._queue.popleft()
+            if call.on_chunk is not None and connection.calls:
+                # a stream takes the connection for itself
+                self._queue.appendleft(call)
+                break
+            connection.send_call(call)
+
+    def _connection_closed(self, connection, calls):
+        if connection in self._connections:
+            self._connections.remove(connection)
+        self._queue.extendleft(reversed(calls))
+
+    def check_timeouts(self):
+        """Fail the calls that took longer than their timeout.
+
+        A connection waiting for a call that timed out is closed, the next
+        calls are sent again.
+        """
+        now = time.time()
+        for call in list(self._queue):
+            if call.deadline is not None and call.deadline < now:
+                self._queue.remove(call)
+                call._finish(error=CallTimeout(call.timeout))
+        for connection in list(self._connections):
+            if not connection.calls:
+                continue
+            call = connection.calls[0]
+            if call.deadline is not None and call.deadline < now:
+                connection.close()
+                connection.calls.pop(0)
+                call._finish(error=CallTimeout(call.timeout))
+                self._connection_closed(connection, connection.calls)
+                connection.calls = []
+        self._dispatch()
+
+    def loop(self, calls=None, timeout=None):
+        """Run the asyncore loop until calls (all of them by default) are
+        done, or for timeout seconds.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            if calls is None:
+                if not self.pending():
+                    return
+            elif all(call.done for call in calls):
+                return
+            if deadline is not None and time.time() > deadline:
+                return
+            asyncore.loop(timeout=0.05, map=self.map, count=1)
+            self.check_timeouts()
+
+    def close(self):
+        """Close the connections, the pending calls fail."""
+        error = socket.error('the client was closed')
+        while self._queue:
+            self._queue.popleft()._finish(error=error)
+        for connection in self._connections:
+            connection.close()
+            for call in connection.calls:
+                call._finish(error=error)
+            connection.calls = []
+        self._connections = []
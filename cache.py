@@ -0,0 +1,454 @@
+# -*- encoding: utf-8 -*-
+# Copyright (C) 2009 Guillermo Gonzalez
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+""" caches used by the xmlrpc service """
+
+import threading
+
+from bzrlib.lazy_import import lazy_import
+lazy_import(globals(), """
+from bzrlib import (
+    branch as _mod_branch,
+    commands,
+    errors,
+    info,
+    lru_cache,
+    osutils,
+    trace,
+    urlutils,
+    workingtree,
+    )
+""")
+try:
+    from bzrlib.controldir import ControlDir
+except ImportError:
+    # bzr < 2.2
+    from bzrlib.bzrdir import BzrDir as ControlDir
+
+
+class ObjectCache(object):
+    """A LRU cache of the trees and branches opened by the commands.
+
+    The entries are keyed by the open function and the absolute path given to
+    it. Before an entry is reused it is checked against the branch tip and the
+    dirstate of the tree, if any of them changed the entry is discarded and
+    the objects are opened again.
+
+    bzrlib objects aren't thread safe, so while a request is using an entry
+    it's checked out by the thread running the request. Other threads opening
+    the same path get fresh (uncached) objects. A thread only uses the cache
+    between start() and release(), release() returns the entries to the cache.
+    """
+
+    def __init__(self, max_entries=20):
+        self._cache = lru_cache.LRUCache(max_cache=max_entries)
+        self._lock = threading.Lock()
+        self._in_use = set()
+        self._held = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        """Start using the cache in this thread.
+
+        :return: False if the thread was already using it.
+        """
+        if getattr(self._held, 'entries', None) is not None:
+            return False
+        self._held.entries = {}
+        return True
+
+    def get(self, key, open_func, *args):
+        """Return the result of open_func(*args), cached under key."""
+        held = getattr(self._held, 'entries', None)
+        if held is None:
+            return open_func(*args)
+        if key in held:
+            return held[key][0]
+        self._lock.acquire()
+        try:
+            if key in self._in_use:
+                entry = None
+            else:
+                entry = self._cache.get(key)
+                self._in_use.add(key)
+        finally:
+            self._lock.release()
+        if entry is not None and _get_state(entry[0]) != entry[1]:
+            entry = None
+        if entry is None:
+            self.misses += 1
+            try:
+                result = open_func(*args)
+            except:
+                self._lock.acquire()
+                try:
+                    self._in_use.discard(key)
+                finally:
+                    self._lock.release()
+                raise
+            entry = (result, _get_state(result))
+        else:
+            self.hits += 1
+        held[key] = entry
+        return entry[0]
+
+    def get_held(self, key):
+        """Return the result held for key by this thread, or None."""
+        held = getattr(self._held, 'entries', None)
+        if held is None or key not in held:
+            return None
+        return held[key][0]
+
+    def hold(self, key, result):
+        """Make get() return result for key in this thread, until release().
+
+        result isn't added to the cache.
+        """
+        held = getattr(self._held, 'entries', None)
+        if held is not None and key not in held:
+            held[key] = (result, None)
+
+    def release(self):
+        """Return the entries used by this thread to the cache."""
+        held = getattr(self._held, 'entries', None)
+        if held is None:
+            return
+        self._held.entries = None
+        self._lock.acquire()
+        try:
+            for key, entry in held.items():
+                if key not in self._in_use or entry[1] is None:
+                    # not checked out by get()
+                    continue
+                self._in_use.discard(key)
+                if _is_locked(entry[0]):
+                    # someone forgot to unlock, don't reuse it
+                    trace.mutter('not caching locked objects for %r' % (key,))
+                    continue
+                self._cache[key] = entry
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+        finally:
+            self._lock.release()
+
+
+def _is_locked(result):
+    for obj in result:
+        is_locked = getattr(obj, 'is_locked', None)
+        if is_locked is not None and is_locked():
+            return True
+    return False
+
+
+def _get_state(result):
+    """Return the branch tip and dirstate stat of the opened objects."""
+    state = []
+    for obj in result:
+        if isinstance(obj, workingtree.WorkingTree):
+            try:
+                st = obj._transport.stat('dirstate')
+                state.append((st.st_mtime, st.st_size))
+            except (errors.NoSuchFile, errors.TransportNotPossible):
+                state.append(None)
+        elif isinstance(obj, _mod_branch.Branch):
+            state.append(obj.last_revision_info())
+    return state
+
+
+_object_cache = None
+_orig_open_functions = None
+
+
+def install_object_cache(cache):
+    """Make the bzrlib open_containing functions use cache.
+
+    Only local paths are cached. None uninstalls the cache.
+    """
+    global _object_cache, _orig_open_functions
+    _object_cache = cache
+    if _orig_open_functions is not None or cache is None:
+        return
+    _orig_open_functions = (
+        ControlDir.__dict__['open_containing_tree_or_branch'],
+        ControlDir.__dict__['open_containing'],
+        workingtree.WorkingTree.open_containing,
+        _mod_branch.Branch.open_containing,
+        )
+    orig_tree_or_branch, orig_containing, orig_tree, orig_branch = \
+        _orig_open_functions
+
+    def open_containing_tree_or_branch(klass, location, *args, **kwargs):
+        open_func = orig_tree_or_branch.__get__(None, klass)
+        key = _get_key('tree_or_branch', location)
+        if _object_cache is None or key is None or args or kwargs:
+            return open_func(location, *args, **kwargs)
+        return _object_cache.get(key, open_func, location)
+
+    def open_containing(klass, url, *args, **kwargs):
+        # control dirs aren't cached, only the ones held by
+        # open_tree_or_branch are reused
+        key = _get_key('controldir', url)
+        if _object_cache is not None and key is not None and \
+                not (args or kwargs):
+            held = _object_cache.get_held(key)
+            if held is not None:
+                return held
+        return orig_containing.__get__(None, klass)(url, *args, **kwargs)
+
+    def open_tree_containing(path=None):
+        key = _get_key('tree', path)
+        if _object_cache is None or key is None:
+            return orig_tree(path)
+        return _object_cache.get(key, orig_tree, path)
+
+    def open_branch_containing(url, *args, **kwargs):
+        key = _get_key('branch', url)
+        if _object_cache is None or key is None or args or kwargs:
+            return orig_branch(url, *args, **kwargs)
+        return _object_cache.get(key, orig_branch, url)
+
+    ControlDir.open_containing_tree_or_branch = classmethod(
+        open_containing_tree_or_branch)
+    ControlDir.open_containing = classmethod(open_containing)
+    workingtree.WorkingTree.open_containing = staticmethod(
+        open_tree_containing)
+    _mod_branch.Branch.open_containing = staticmethod(open_branch_containing)
+
+
+def _get_key(kind, location):
+    """Return the cache key for location, or None if it's not a local path."""
+    if location is None:
+        location = osutils.getcwd()
+    if urlutils.is_url(location):
+        if not location.startswith('file://'):
+            return None
+        location = urlutils.local_path_from_url(location)
+    return (kind, osutils.abspath(location))
+
+
+def open_tree_or_branch(location):
+    """Open the tree (if any) and the branch of location.
+
+    Until the objects are released, the open_containing functions return the
+    same tree and branch for location in this thread (and the control dir
+    they return opens them).
+
+    :return: (tree, branch, relpath)
+    """
+    tree, branch, relpath = \
+        ControlDir.open_containing_tree_or_branch(location)
+    if _object_cache is not None:
+        if tree is not None:
+            _object_cache.hold(_get_key('tree', location), (tree, relpath))
+        _object_cache.hold(_get_key('branch', location), (branch, relpath))
+        _object_cache.hold(_get_key('controldir', location),
+                           (_HeldControlDir(tree, branch), relpath))
+    return tree, branch, relpath
+
+
+class _HeldControlDir(object):
+    """The control dir of a held tree (or branch), that opens them instead of
+    new objects.
+    """
+
+    def __init__(self, tree, branch):
+        if tree is not None:
+            self._controldir = tree.bzrdir
+        else:
+            self._controldir = branch.bzrdir
+        self._tree = tree
+        self._branch = branch
+
+    def open_workingtree(self, *args, **kwargs):
+        if self._tree is None:
+            return self._controldir.open_workingtree(*args, **kwargs)
+        return self._tree
+
+    def open_branch(self, *args, **kwargs):
+        if args or kwargs.get('name') is not None:
+            return self._controldir.open_branch(*args, **kwargs)
+        return self._branch
+
+    def __getattr__(self, name):
+        return getattr(self._controldir, name)
+
+
+def use_cached_objects():
+    """Start using the installed cache in the current thread.
+
+    :return: True if release_objects() must be called when done.
+    """
+    if _object_cache is not None:
+        return _object_cache.start()
+    return False
+
+
+def release_objects():
+    """Return the objects checked out by the current thread to the cache."""
+    if _object_cache is not None:
+        _object_cache.release()
+
+
+def _cache_info(opts):
+    # verbose info reports the unknown/ignored files of the working tree
+    return not opts.get('verbose')
+
+
+def _cache_ls(opts):
+    # unknown files don't change the dirstate, only list revisions
+    return opts.get('revision') is not None
+
+
+# the read only commands whose output is determined by their arguments, the
+# branch tip and the dirstate (and a function to check the options, if the
+# output depends on them).
+cacheable_commands = {
+    'xmlannotate': None,
+    'xmlinfo': _cache_info,
+    'xmllog': None,
+    'xmlls': _cache_ls,
+    }
+
+# the commands that show the related branches of the branch (parent, push,
+# submit...), their locations are configuration that changes without
+# changing the branch tip, so they are part of the key too.
+related_branches_commands = set(['xmlinfo'])
+
+
+class ResponseCache(object):
+    """A LRU cache of the responses of read only commands, bounded by the
+    size of the responses in bytes.
+
+    The key of a response is built by get_response_key(), and includes the
+    branch tip and the dirstate state of the location the command works on
+    (and the related branches, for info).
+    """
+
+    def __init__(self, max_size):
+        self._cache = lru_cache.LRUSizeCache(max_size=max_size,
+                                             compute_size=_response_size)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            response = self._cache.get(key)
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return response
+        finally:
+            self._lock.release()
+
+    def add(self, key, response):
+        self._lock.acquire()
+        try:
+            self._cache[key] = response
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+        finally:
+            self._lock.release()
+
+
+def _response_size(response):
+    """the size of a (exitval, Binary, stderr) response"""
+    exitval, out, err = response
+    return len(out.data) + len(err)
+
+
+def get_response_key(name, argv):
+    """Return the cache key for running argv with the function called name.
+
+    This must be called with the workdir of the request set.
+
+    :return: None if the command isn't cacheable.
+    """
+    if len(argv) < 2:
+        return None
+    user_encoding = osutils.get_user_encoding()
+    args = []
+    for arg in argv[1:]:
+        if isinstance(arg, str):
+            arg = arg.decode(user_encoding)
+        args.append(arg)
+    try:
+        cmd_obj = commands.get_cmd_object(args[0])
+        if cmd_obj.name() not in cacheable_commands:
+            return None
+        cmd_args, opts = commands.parse_args(cmd_obj, args[1:])
+    except errors.BzrError:
+        # let the command report it
+        return None
+    check_opts = cacheable_commands[cmd_obj.name()]
+    if check_opts is not None and not check_opts(opts):
+        return None
+    if cmd_args:
+        location = cmd_args[0]
+    else:
+        location = u'.'
+    state = _get_location_state(
+        location, cmd_obj.name() in related_branches_commands)
+    if state is None:
+        return None
+    return (name, tuple(args), osutils.getcwd(), state)
+
+
+def _get_location_state(location, related_branches=False):
+    """Return the branch tip and dirstate state of location, or None
+
+    :param related_branches: include the locations of the related branches
+        (as shown by info) and the bound branch.
+    """
+    try:
+        tree, branch, relpath = \
+            ControlDir.open_containing_tree_or_branch(location)
+        state = [branch.base, branch.last_revision()]
+        if related_branches:
+            state.append(tuple(info._gather_related_branches(branch).locs))
+            state.append(branch.get_bound_location())
+    except errors.BzrError:
+        return None
+    if tree is not None:
+        state.extend(_get_state([tree]))
+    return tuple(state)
+
+
+_response_cache = None
+
+
+def install_response_cache(cache):
+    """Use cache for the responses of the service, None disables it."""
+    global _response_cache
+    _response_cache = cache
+
+
+def get_response_cache():
+    return _response_cache
@@ -18,16 +18,547 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
 #
+"""A client of the xmlrpc service.
 
-from xmlrpclib import Server, Error
+It only uses the standard library (importing bzrlib would take most of the
+time saved by the service), so it can be run as a replacement of the bzr
+script, see main.
+
+When the service isn't running main starts it in the background (see
+spawn_service), and if that fails the command is run by this process.
+"""
+
+from xmlrpclib import Server, Error, Fault, Transport
+import codecs
+import errno
+import xmlrpclib
+import httplib
+import locale
 import os
+import Queue
+import re
+import socket
+import subprocess
 import sys
-from bzrlib import osutils
+import tempfile
+import threading
+import time
+import urlparse
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
+from xml.sax.saxutils import unescape
+
+
+default_url = "http://localhost:11111"
+
+# the exit status of bzr when a command fails
+EXIT_ERROR = 3
+
+_fault_message_re = re.compile('<message>(.*)</message>', re.DOTALL)
+
+# the seconds to wait for a spawned service to answer
+spawn_timeout = 10
+
+# the size of the pieces of a buffered output decoded at a time
+decode_chunk_size = 65536
+
+# what the bzr script does, used to start the service and to run the
+# commands in this process when it can't be started
+_bzr_script = """import sys
+import bzrlib
+import bzrlib.commands
+library_state = bzrlib.initialize()
+library_state.__enter__()
+try:
+    exit_val = bzrlib.commands.main()
+finally:
+    library_state.__exit__(None, None, None)
+sys.exit(exit_val)
+"""
+
+
+class UnixSocketHTTPConnection(httplib.HTTPConnection):
+    """A HTTPConnection to a unix socket."""
+
+    def __init__(self, socket_path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class PooledTransport(Transport):
+    """A xmlrpclib Transport that keeps a pool of open connections.
+
+    The service keeps the connections open between requests, so the
+    requests don't pay the connection setup. A Server using this transport
+    can be shared by many threads, each request uses an idle connection
+    (or opens a new one) and returns it to the pool when done.
+
+    The big responses are compressed by the service.
+    """
+
+    accept_gzip_encoding = True
+    # sent as the X-Bzr-Timeout header, to override the timeout of the service
+    request_timeout = None
+    # sent as the X-Bzr-Priority header: high, normal or low
+    priority = None
+
+    def __init__(self, use_datetime=0, max_idle=8):
+        Transport.__init__(self, use_datetime=use_datetime)
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def new_connection(self, host):
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        return httplib.HTTPConnection(chost)
+
+    def make_connection(self, host):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and connection[0] == host:
+            return connection[1]
+        connection = None
+        if not getattr(self._local, 'retry', False):
+            # when retrying, the other idle connections can be closed too
+            self._lock.acquire()
+            try:
+                for i, (idle_host, idle_connection) in enumerate(self._idle):
+                    if idle_host == host:
+                        connection = self._idle.pop(i)
+                        break
+            finally:
+                self._lock.release()
+        if connection is None:
+            connection = (host, self.new_connection(host))
+        self._local.connection = connection
+        return connection[1]
+
+    def request(self, host, handler, request_body, verbose=0):
+        try:
+            return Transport.request(self, host, handler, request_body,
+                                     verbose)
+        finally:
+            self._release()
+
+    def send_content(self, connection, request_body):
+        if self.request_timeout is not None:
+            connection.putheader('X-Bzr-Timeout', str(self.request_timeout))
+        if self.priority is not None:
+            connection.putheader('X-Bzr-Priority', self.priority)
+        Transport.send_content(self, connection, request_body)
+
+    def _release(self):
+        """Return the connection used by this thread to the pool."""
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        self._local.retry = False
+        if connection is None:
+            return
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                connection = None
+        finally:
+            self._lock.release()
+        if connection is not None:
+            connection[1].close()
+
+    def close(self):
+        """Close the connection used by this thread (after an error)."""
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        self._local.retry = True
+        if connection is not None:
+            connection[1].close()
+
+    def close_all(self):
+        """Close the idle connections."""
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = []
+        finally:
+            self._lock.release()
+        for host, connection in idle:
+            connection.close()
+
+
+class UnixSocketTransport(PooledTransport):
+    """A xmlrpclib Transport to a service listening on a unix socket."""
+
+    # not worth the cpu on the same host
+    accept_gzip_encoding = False
+
+    def __init__(self, socket_path, use_datetime=0, max_idle=8):
+        PooledTransport.__init__(self, use_datetime=use_datetime,
+                                 max_idle=max_idle)
+        self.socket_path = socket_path
+
+    def new_connection(self, host):
+        return UnixSocketHTTPConnection(self.socket_path)
+
+
+def get_server(url=None, socket_path=None, timeout=None, priority=None,
+               max_idle=8):
+    """Return a xmlrpclib.Server for the service at url, or listening on
+    the unix socket at socket_path.
+
+    :param timeout: the seconds the service can spend in each request,
+        instead of its default timeout.
+    :param priority: the priority of the requests (high, normal or low),
+        instead of the one the service gives them.
+    :param max_idle: the connections kept open for the next requests.
+    """
+    if socket_path is not None:
+        transport = UnixSocketTransport(socket_path, max_idle=max_idle)
+        url = "http://localhost/"
+    else:
+        if url is None:
+            url = default_url
+        if not url.startswith('http:'):
+            return Server(url)
+        transport = PooledTransport(max_idle=max_idle)
+    transport.request_timeout = timeout
+    transport.priority = priority
+    return Server(url, transport=transport)
+
+
+class StreamedOutput(object):
+    """The output of a command run by stream_bzr, as it's received.
+
+    Iterating over it yields the chunks of the output. After the last one
+    exit_status and stderr are set, or the Fault of the command is raised.
+    """
+
+    def __init__(self, connection, response):
+        self._connection = connection
+        self._response = response
+        self.exit_status = None
+        self.stderr = None
+
+    def __iter__(self):
+        fp = self._response.fp
+        try:
+            while True:
+                line = fp.readline()
+                if not line:
+                    raise httplib.IncompleteRead('')
+                size = int(line.split(';', 1)[0], 16)
+                if size == 0:
+                    break
+                data = fp.read(size)
+                if len(data) < size:
+                    raise httplib.IncompleteRead(data, size - len(data))
+                fp.read(2)
+                yield data
+            trailer = {}
+            while True:
+                line = fp.readline()
+                if line in ('\r\n', '\n', ''):
+                    break
+                name, value = line.split(':', 1)
+                trailer[name.strip().lower()] = value.strip()
+        finally:
+            self.close()
+        if 'x-bzr-fault-code' in trailer:
+            raise Fault(int(trailer['x-bzr-fault-code']),
+                        trailer['x-bzr-fault-string'].decode('base64'))
+        self.exit_status = int(trailer['x-bzr-exit-status'])
+        self.stderr = trailer['x-bzr-stderr'].decode('base64')
+
+    def close(self):
+        self._response.close()
+        self._connection.close()
+
+
+def stream_bzr(argv, workdir, url=None, socket_path=None,
+               method='run_bzr_command'):
+    """Run a command with the service, receiving its output as it's written.
+
+    :param method: run_bzr_command or run_bzr (errors reported as xml).
+    :return: a StreamedOutput.
+    """
+    if socket_path is not None:
+        connection = UnixSocketHTTPConnection(socket_path)
+    else:
+        if url is None:
+            url = default_url
+        connection = httplib.HTTPConnection(urlparse.urlsplit(url)[1])
+    connection.putrequest('POST', '/stream')
+    connection.putheader('Content-Type', 'text/xml')
+    connection.putheader('TE', 'trailers')
+    body = xmlrpclib.dumps((argv, workdir), method)
+    connection.putheader('Content-Length', str(len(body)))
+    connection.endheaders()
+    connection.send(body)
+    response = connection.getresponse()
+    if response.status != 200:
+        response.read()
+        connection.close()
+        raise xmlrpclib.ProtocolError(url or socket_path, response.status,
+                                      response.reason, response.msg)
+    return StreamedOutput(connection, response)
+
+
+def is_local(url=None, socket_path=None):
+    """Return True if the service at url (or socket_path) runs in this
+    host, so it can be started by spawn_service.
+    """
+    if socket_path is not None:
+        return True
+    if url is None:
+        url = default_url
+    parts = urlparse.urlsplit(url)
+    return parts.scheme == 'http' and \
+        parts.hostname in ('localhost', '127.0.0.1')
+
+
+def is_running(url=None, socket_path=None):
+    """Return True if the service answers at url (or socket_path)."""
+    server = get_server(url=url, socket_path=socket_path)
+    try:
+        server.hello()
+    except (socket.error, Error):
+        return False
+    return True
+
+
+def _get_lock_path(url, socket_path):
+    if socket_path is not None:
+        return socket_path + '.lock'
+    parts = urlparse.urlsplit(url)
+    return os.path.join(tempfile.gettempdir(), 'bzr-xmlrpc-%s-%s-%s.lock'
+                        % (getattr(os, 'getuid', lambda: 0)(), parts.hostname,
+                           parts.port or 80))
+
+
+def spawn_service(url=None, socket_path=None, timeout=None):
+    """Start the service at url (or listening on socket_path) in the
+    background, unless it's already running.
+
+    A lock file next to the socket (or in the temp dir) keeps two clients
+    from starting it at the same time. The service is started with the bzr
+    in BZR_XMLRPC_BZR, by default bzrlib is run with this python.
+
+    :param timeout: the seconds to wait for the service to answer, defaults
+        to spawn_timeout.
+    :return: True if the service is running.
+    """
+    if url is None:
+        url = default_url
+    if timeout is None:
+        timeout = spawn_timeout
+    if socket_path is not None:
+        service_args = ['start-xmlrpc', '--socket', socket_path]
+    else:
+        parts = urlparse.urlsplit(url)
+        service_args = ['start-xmlrpc', '--hostname', parts.hostname,
+                        '--port', str(parts.port or 80)]
+    try:
+        lock_file = open(_get_lock_path(url, socket_path), 'a')
+    except IOError:
+        return False
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        if is_running(url, socket_path):
+            # started by another client while we waited for the lock
+            return True
+        bzr = os.environ.get('BZR_XMLRPC_BZR')
+        if bzr:
+            args = [bzr] + service_args
+        else:
+            args = [sys.executable, '-c', _bzr_script] + service_args
+        kwargs = {}
+        if getattr(os, 'setsid', None) is not None:
+            # detach it from the terminal of the client
+            kwargs['preexec_fn'] = os.setsid
+        devnull = open(os.devnull, 'r+')
+        try:
+            try:
+                process = subprocess.Popen(args, stdin=devnull,
+                                           stdout=devnull, stderr=devnull,
+                                           close_fds=True, **kwargs)
+            except OSError:
+                return False
+        finally:
+            devnull.close()
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if is_running(url, socket_path):
+                return True
+            if process.poll() is not None:
+                # it failed to start
+                return False
+            time.sleep(0.05)
+        return False
+    finally:
+        lock_file.close()
+
+
+def run_in_process(argv):
+    """Run the bzr command in argv[1:] in this process, as bzr does.
+
+    :return: the exit status of the command.
+    """
+    import bzrlib
+    import bzrlib.commands
+    import bzrlib.osutils
+    encoding = bzrlib.osutils.get_user_encoding()
+    argv = [arg.decode(encoding) for arg in argv]
+    library_state = bzrlib.initialize()
+    library_state.__enter__()
+    try:
+        return bzrlib.commands.main(argv)
+    finally:
+        library_state.__exit__(None, None, None)
+
+
+def get_terminal_encoding():
+    """Return the encoding of the terminal (as bzrlib.osutils does)."""
+    encoding = getattr(sys.stdout, 'encoding', None)
+    if not encoding:
+        encoding = getattr(sys.stdin, 'encoding', None)
+    if not encoding:
+        try:
+            encoding = locale.getpreferredencoding()
+        except locale.Error:
+            encoding = None
+    if not encoding:
+        return 'ascii'
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        return 'ascii'
+    return encoding
+
+
+def get_fault_message(fault):
+    """Return the message of the error in a Fault of the service."""
+    match = _fault_message_re.search(fault.faultString)
+    if match is None:
+        return fault.faultString
+    return unescape(match.group(1))
+
+
+def fanout_bzr(argv, workdirs, url=None, socket_path=None, jobs=8,
+               method='run_bzr_command'):
+    """Run a command in each of workdirs, sending up to jobs requests to
+    the service at the same time.
+
+    :param method: run_bzr_command or run_bzr (errors reported as xml).
+    :return: an iterator of (workdir, response) in the order the commands
+        finish, response is (exit_status, output, stderr) or the Fault of
+        the command.
+    """
+    server = get_server(url=url, socket_path=socket_path, max_idle=jobs)
+    pending = Queue.Queue()
+    for workdir in workdirs:
+        pending.put(workdir)
+    results = Queue.Queue()
+
+    def run():
+        while True:
+            try:
+                workdir = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                response = getattr(server, method)(argv, workdir)
+            except Fault, f:
+                response = f
+            except:
+                results.put((workdir, None, sys.exc_info()))
+                continue
+            results.put((workdir, response, None))
+
+    threads = []
+    for i in range(min(jobs, len(workdirs))):
+        thread = threading.Thread(target=run)
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    try:
+        for i in range(len(workdirs)):
+            workdir, response, exc_info = results.get()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield workdir, response
+    finally:
+        # when the caller stops early, don't start the rest
+        while True:
+            try:
+                pending.get_nowait()
+            except Queue.Empty:
+                break
+        for thread in threads:
+            thread.join()
+
+
+def split_output(data, size=None):
+    """Yield data in pieces of size bytes (decode_chunk_size by default)."""
+    if size is None:
+        size = decode_chunk_size
+    for start in xrange(0, len(data), size):
+        yield data[start:start + size]
+
+
+def write_output(chunks, outf, encoding):
+    """Decode the chunks of an output with encoding, writing them to outf as
+    they arrive.
+
+    A character split between two chunks is written once its last byte
+    arrives.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)('replace')
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            outf.write(text)
+            outf.flush()
+    text = decoder.decode('', True)
+    if text:
+        outf.write(text)
+    outf.flush()
+
+
+def run_command(args, url=None, socket_path=None, outf=None):
+    """Run the bzr command in args with the service, writing its output to
+    outf (a file with the terminal encoding, see setup_outf) as it arrives.
+
+    The output is streamed, unless the service doesn't support it.
+
+    :return: (exit_status, stderr)
+    """
+    if outf is None:
+        outf = setup_outf()
+    encoding = get_terminal_encoding()
+    if socket_path is not None or url is None or url.startswith('http:'):
+        try:
+            output = stream_bzr(args, os.getcwd(), url, socket_path)
+        except xmlrpclib.ProtocolError, e:
+            if e.errcode != 404:
+                raise
+            # an older service
+        else:
+            write_output(output, outf, encoding)
+            return output.exit_status, output.stderr
+    server = get_server(url=url, socket_path=socket_path)
+    exit_val, out, err = server.run_bzr_command(args, os.getcwd())
+    write_output(split_output(out.data), outf, encoding)
+    return exit_val, err
+
 
 def setup_outf(encoding_type='replace'):
     """Return a file linked to stdout, which has proper encoding."""
-    import codecs
-    import bzrlib
     if encoding_type == 'exact':
         # force sys.stdout to be binary stream on win32
         if sys.platform == 'win32':
@@ -38,7 +569,7 @@ def setup_outf(encoding_type='replace'):
         outf = sys.stdout
         return
 
-    output_encoding = osutils.get_terminal_encoding()
+    output_encoding = get_terminal_encoding()
 
     outf = codecs.getwriter(output_encoding)(sys.stdout,
                     errors=encoding_type)
@@ -46,22 +577,117 @@ def setup_outf(encoding_type='replace'):
     return outf
 
 
-def main(argv=[]): 
-    server = Server("http://localhost:11111")
+def main(argv=[]):
+    """Run the bzr command in argv[1:] with the service.
+
+    --socket PATH or --url URL (before the command) connect to the service
+    listening on the unix socket PATH, or at URL. They default to the
+    BZR_XMLRPC_SOCKET and BZR_XMLRPC_URL environment variables, so this
+    script can be installed as bzr, the commands that fail are reported
+    like bzr does.
+
+    If the service isn't running in this host it's started (see
+    spawn_service), or the command is run in this process if it can't be
+    started. --no-spawn (or setting BZR_XMLRPC_NO_SPAWN) disables both.
+
+    --fanout PATH... -- runs the command in each PATH (see fanout_bzr),
+    --jobs N sets how many run at the same time. The output of each one is
+    written as it finishes, after a "==> PATH <==" line.
+    """
+    argv = argv[1:]
+    socket_path = os.environ.get('BZR_XMLRPC_SOCKET') or None
+    url = os.environ.get('BZR_XMLRPC_URL') or None
+    spawn = not os.environ.get('BZR_XMLRPC_NO_SPAWN')
+    fanout = None
+    jobs = 8
+    while argv and argv[0].startswith('--'):
+        if argv[0] == '--no-spawn':
+            spawn = False
+            argv = argv[1:]
+        elif argv[0] == '--fanout':
+            fanout = []
+            argv = argv[1:]
+            while argv and argv[0] != '--':
+                fanout.append(argv.pop(0))
+            argv = argv[1:]
+            break
+        elif argv[0].startswith('--jobs='):
+            jobs = int(argv[0][len('--jobs='):])
+            argv = argv[1:]
+        elif argv[0] == '--jobs' and len(argv) > 1:
+            jobs = int(argv[1])
+            argv = argv[2:]
+        elif argv[0].startswith('--socket='):
+            socket_path = argv[0][len('--socket='):]
+            argv = argv[1:]
+        elif argv[0] == '--socket' and len(argv) > 1:
+            socket_path = argv[1]
+            argv = argv[2:]
+        elif argv[0].startswith('--url='):
+            url = argv[0][len('--url='):]
+            argv = argv[1:]
+        elif argv[0] == '--url' and len(argv) > 1:
+            url = argv[1]
+            argv = argv[2:]
+        else:
+            break
+    if fanout is not None:
+        if spawn and is_local(url, socket_path) and \
+                not is_running(url, socket_path):
+            spawn_service(url, socket_path)
+        sys.exit(fanout_main(argv, fanout, url, socket_path, jobs))
     try:
         args = ['bzr']
-        [args.append(arg) for arg in argv[1:]]
-        exit_val, out, err = server.run_bzr_command(args, os.getcwd())
+        [args.append(arg) for arg in argv]
         outf = setup_outf()
-        outf.write(out.data.decode(osutils.get_terminal_encoding(), 'replace'))
+        try:
+            exit_val, err = run_command(args, url, socket_path, outf)
+        except socket.error, e:
+            if not spawn or not is_local(url, socket_path) or \
+                    e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+                raise
+            if not spawn_service(url, socket_path):
+                sys.exit(run_in_process(args))
+            exit_val, err = run_command(args, url, socket_path, outf)
         sys.stderr.write(err)
-        outf.flush();
         sys.stderr.flush();
         sys.exit(exit_val)
-    except Error, exc:
+    except Fault, f:
+        sys.stderr.write('bzr: ERROR: %s\n' % get_fault_message(f))
+        sys.exit(EXIT_ERROR)
+    except (Error, socket.error), exc:
         sys.stderr.write(exc.__repr__())
         raise
 
 
+def fanout_main(argv, paths, url=None, socket_path=None, jobs=8):
+    """Run the bzr command in argv in each of paths, writing the output of
+    each one as it finishes.
+
+    :return: the highest exit status of the commands.
+    """
+    args = ['bzr'] + argv
+    workdirs = [os.path.abspath(path) for path in paths]
+    names = dict(zip(workdirs, paths))
+    outf = setup_outf()
+    encoding = get_terminal_encoding()
+    exit_val = 0
+    for workdir, response in fanout_bzr(args, workdirs, url, socket_path,
+                                        jobs):
+        if isinstance(response, Fault):
+            sys.stderr.write('bzr: ERROR: %s: %s\n'
+                             % (names[workdir], get_fault_message(response)))
+            exit_val = max(exit_val, EXIT_ERROR)
+            continue
+        status, out, err = response
+        outf.write(u'==> %s <==\n' % names[workdir].decode(encoding,
+                                                            'replace'))
+        write_output(split_output(out.data), outf, encoding)
+        sys.stderr.write(err)
+        exit_val = max(exit_val, status)
+    sys.stderr.flush()
+    return exit_val
+
+
 if __name__ == '__main__':
     main(sys.argv)
\ No newline at end of file
@@ -39,10 +39,11 @@ from bzrlib import (
     )
 
 from bzrlib.plugins.xmloutput import (
+    client,
     logxml,
     service,
     )
-import socket
+import socket as _mod_socket
 """)
 
 from bzrlib.plugins.xmloutput.xml_errors import handle_error_xml
@@ -140,7 +141,7 @@ class cmd_xmlannotate(Command):
     @display_command
     @handle_error_xml
     def run(self, filename, revision=None, show_ids=False, null=False):
-        from annotatexml import annotate_file_xml
+        from annotatexml import annotate_file_xml, get_annotate_target
         wt, branch, relpath = \
             bzrdir.BzrDir.open_containing_tree_or_branch(filename)
         if wt is not None:
@@ -149,22 +150,8 @@ class cmd_xmlannotate(Command):
             branch.lock_read()
         wt_root_path = wt.id2abspath(wt.get_root_id())
         try:
-            if revision is None:
-                revision_id = branch.last_revision()
-            elif len(revision) != 1:
-                raise bzrlib.errors.BzrCommandError(
-                    'xmlannotate --revision takes exactly 1 argument')
-            else:
-                revision_id = revision[0].in_history(branch).rev_id
-            tree = branch.repository.revision_tree(revision_id)
-            if wt is not None:
-                file_id = wt.path2id(relpath)
-            else:
-                file_id = tree.path2id(relpath)
-            if file_id is None:
-                raise bzrlib.errors.NotVersionedError(filename)
-
-            file_version = tree.get_file_revision(file_id)
+            file_id, file_version = get_annotate_target(wt, branch, relpath,
+                                                        filename, revision)
             # always run with --all and --long options
             # to get the author of each line
             annotate_file_xml(branch=branch, rev_id=file_version,
@@ -396,25 +383,92 @@ class cmd_start_xmlrpc(Command):
                 help='Use the specified hostname, defaults to localhost.'),
             Option('port', argname='PORT', type=int,
                 help='Use the specified port, defaults to 11111.'),
+            Option('threads', argname='N', type=int,
+                help='Handle up to N requests concurrently, defaults to '
+                     'one request at a time.'),
+            Option('workers', argname='N', type=int,
+                help='Fork N worker processes to handle the requests.'),
+            Option('cache-objects', argname='N', type=int,
+                help='Keep up to N opened trees and branches, defaults '
+                     'to 20 (0 disables the cache).'),
+            Option('cache-responses', argname='BYTES', type=int,
+                help='Cache up to BYTES of the output of the read only '
+                     'commands (xmllog, xmlannotate, xmlinfo and xmlls -r).'),
+            Option('socket', argname='PATH', type=unicode,
+                help='Listen on the unix socket PATH instead of a TCP '
+                     'port.'),
+            Option('idle-timeout', argname='SECONDS', type=int,
+                help='Close the connections idle for SECONDS, defaults to '
+                     '15 (0 closes them after each request).'),
+            Option('max-connections', argname='N', type=int,
+                help='Keep up to N connections open, defaults to 64.'),
+            Option('gzip-threshold', argname='BYTES', type=int,
+                help='Compress the responses bigger than BYTES if the '
+                     'client accepts gzip, defaults to 1400 (0 disables '
+                     'it).'),
+            Option('job-threads', argname='N', type=int,
+                help='Run up to N submitted jobs concurrently, defaults to '
+                     '2 (0 disables the jobs).'),
+            Option('request-timeout', argname='SECONDS', type=int,
+                help='Interrupt the requests that take more than SECONDS, '
+                     'defaults to 0 (no timeout).'),
+            Option('max-running', argname='N', type=int,
+                help='Run up to N commands at the same time, the others '
+                     'wait by priority (0, the default, disables it).'),
+            Option('max-queued', argname='N', type=int,
+                help='Reject the requests when N are waiting, defaults to '
+                     '16.'),
+            Option('max-requests', argname='N', type=int,
+                help='Replace a worker after it handles N requests.'),
+            Option('max-rss', argname='MB', type=int,
+                help='Replace a worker when its resident memory grows '
+                     'over MB megabytes.'),
+            Option('drain-timeout', argname='SECONDS', type=int,
+                help='Wait up to SECONDS for the requests being handled '
+                     'when stopped with --drain, defaults to 30.'),
             'verbose',
             ]
 
     @display_command
-    def run(self, port=11111, hostname='localhost', verbose=False):
-        if hostname is None:
-            hostname = socket.gethostname()
-
-        if verbose:
-            self.outf.write('Listening on http://'+hostname+':'+str(port)+'\n')
-            self.outf.flush()
-
-        self.server = service.BzrXMLRPCServer((hostname, port),
-                                     logRequests=verbose, to_file=self.outf)
+    def run(self, port=11111, hostname='localhost', verbose=False,
+            threads=0, workers=0, cache_objects=20, cache_responses=0,
+            socket=None, idle_timeout=15, max_connections=64,
+            gzip_threshold=1400, job_threads=2, request_timeout=0,
+            max_running=0, max_queued=16, max_requests=0, max_rss=0,
+            drain_timeout=30):
+        if socket is not None:
+            addr = socket
+            if verbose:
+                self.outf.write('Listening on ' + socket + '\n')
+                self.outf.flush()
+        else:
+            if hostname is None:
+                hostname = _mod_socket.gethostname()
+            addr = (hostname, port)
+            if verbose:
+                self.outf.write('Listening on http://'+hostname+':'+str(port)+'\n')
+                self.outf.flush()
+
+        self.server = service.BzrXMLRPCServer(addr,
+                                     logRequests=verbose, to_file=self.outf,
+                                     threads=threads, workers=workers,
+                                     object_cache_size=cache_objects,
+                                     response_cache_size=cache_responses,
+                                     idle_timeout=idle_timeout,
+                                     max_connections=max_connections,
+                                     gzip_threshold=gzip_threshold,
+                                     job_threads=job_threads,
+                                     request_timeout=request_timeout,
+                                     max_running=max_running,
+                                     max_queued=max_queued,
+                                     max_requests=max_requests,
+                                     max_rss=max_rss * 1024 * 1024,
+                                     drain_timeout=drain_timeout)
 
         try:
             self.server.serve_forever()
         finally:
-            self.server.shutdown()
+            self.server.server_close()
 
 
 class cmd_stop_xmlrpc(Command):
@@ -426,15 +480,21 @@ class cmd_stop_xmlrpc(Command):
                 help='Use the specified hostname, defaults to localhost.'),
             Option('port', argname='PORT', type=int,
                 help='Use the specified port, defaults to 11111.'),
+            Option('socket', argname='PATH', type=unicode,
+                help='Stop the service listening on the unix socket PATH.'),
+            Option('drain',
+                help='Let the requests being handled finish (up to the '
+                     'drain timeout of the service).'),
             'verbose',
             ]
 
     @display_command
-    def run(self, port=11111, hostname='localhost', verbose=False):
+    def run(self, port=11111, hostname='localhost', verbose=False,
+            socket=None, drain=False):
         url = "http://"+hostname+":"+str(port)
         if verbose:
-            self.outf.write('Stopping xmlrpc service on ' + url + '\n')
+            self.outf.write('Stopping xmlrpc service on ' + (socket or url)
+                            + '\n')
             self.outf.flush()
-        from xmlrpclib import Server
-        server = Server(url)
-        server.quit()
+        server = client.get_server(url=url, socket_path=socket)
+        server.quit(drain)
@@ -184,7 +184,7 @@ def _show_locking_info_xml(repository, branch=None, working=None, outfile=None):
                 status = 'locked'
             else:
                 status = 'unlocked'
-            outfile.write('<working_tree>%s</<working_tree>' % status)
+            outfile.write('<working_tree>%s</working_tree>' % status)
         if branch:
             if branch.get_physical_lock_status():
                 status = 'locked'
@@ -207,7 +207,7 @@ def _show_missing_revisions_branch_xml(branch, outfile):
         local_extra, remote_extra = missing.find_unmerged(branch, master)
         if remote_extra:
             outfile.write('<branch_stats>')
-            outfile.write('<missing_revisions>%d<missing_revisions>' %
+            outfile.write('<missing_revisions>%d</missing_revisions>' %
                           len(remote_extra))
             outfile.write('</branch_stats>')
 
@@ -0,0 +1,282 @@
+# -*- encoding: utf-8 -*-
+# Copyright (C) 2009 Guillermo Gonzalez
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+"""Commands run in the background by the xmlrpc service.
+
+A job is submitted with submit_job(argv, workdir), that returns its id right
+away. The client polls job_status, reads the output with job_result (it can
+be read while the job is running) and can cancel it with cancel_job. A
+running job is only interrupted when it writes output, so a command that
+works for a long time before writing anything isn't stopped until then.
+
+The output of a job is kept in memory until the job is forgotten (see
+JobManager).
+"""
+
+import threading
+import Queue
+
+from bzrlib.lazy_import import lazy_import
+lazy_import(globals(), """
+from bzrlib import trace
+from bzrlib.plugins.xmloutput import service
+""")
+from bzrlib import errors
+from bzrlib.plugins.xmloutput.xml_errors import XMLError
+from xmlrpclib import Fault, Binary
+
+# the JobManager methods registered in the service
+methods = ['submit_job', 'job_status', 'job_result', 'cancel_job']
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class UnknownJob(errors.BzrError):
+
+    _fmt = 'Unknown job: %(job_id)s'
+
+    def __init__(self, job_id):
+        errors.BzrError.__init__(self, job_id=job_id)
+
+
+class JobCancelled(errors.BzrError):
+    """Raised in the thread of a job when it writes after being cancelled."""
+
+    _fmt = 'The job was cancelled'
+
+
+class _JobOutput(object):
+    """The stdout of a job, that can be read while the job writes it."""
+
+    def __init__(self, job):
+        self._job = job
+        self._chunks = []
+        self._lock = threading.Lock()
+        self.size = 0
+
+    def write(self, data):
+        if self._job.cancelled:
+            raise JobCancelled()
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._lock.acquire()
+        try:
+            self._chunks.append(data)
+            self.size += len(data)
+        finally:
+            self._lock.release()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def read(self, offset=0, length=-1):
+        self._lock.acquire()
+        try:
+            data = ''.join(self._chunks)
+            self._chunks = [data]
+        finally:
+            self._lock.release()
+        if length < 0:
+            return data[offset:]
+        return data[offset:offset + length]
+
+
+class Job(object):
+
+    def __init__(self, job_id, argv, workdir):
+        self.id = job_id
+        self.argv = argv
+        self.workdir = workdir
+        self.state = QUEUED
+        self.cancelled = False
+        self.output = _JobOutput(self)
+        self.exit_status = None
+        self.stderr = None
+        self.fault = None
+
+    def run(self):
+        try:
+            self.exit_status, self.stderr = service.stream_bzr(
+                self.argv, self.workdir, service.custom_commands_main,
+                self.output)
+            self.state = FINISHED
+        except Fault, f:
+            self.fault = f
+            self.state = FAILED
+        except Exception, e:
+            self.fault = Fault(32, str(XMLError(e)))
+            self.state = FAILED
+        if self.cancelled:
+            self.state = CANCELLED
+
+    def get_status(self):
+        status = {'id': self.id, 'state': self.state,
+                  'output_size': self.output.size}
+        if self.state == FINISHED:
+            status['exit_status'] = self.exit_status
+        return status
+
+
+class JobManager(object):
+    """Runs the jobs in a pool of threads.
+
+    The threads are started with the first job (so they aren't started
+    before the service forks its workers). Up to max_finished finished jobs
+    are kept, with up to max_output bytes of output between all of them, the
+    oldest are forgotten. The last finished job is always kept.
+    """
+
+    def __init__(self, threads=2, max_finished=100,
+                 max_output=64 * 1024 * 1024):
+        self.threads = threads
+        self.max_finished = max_finished
+        self.max_output = max_output
+        self._jobs = {}
+        self._finished = []
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pool = []
+
+    def _start(self):
+        self._queue = Queue.Queue()
+        for i in range(self.threads):
+            thread = threading.Thread(target=self._process_queue,
+                                      name='bzr-xmlrpc-job-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            self._pool.append(thread)
+
+    def stop(self):
+        """Stop the threads once they finish the running jobs."""
+        self._lock.acquire()
+        try:
+            for job in self._jobs.values():
+                if job.state == QUEUED:
+                    job.cancelled = True
+                    job.state = CANCELLED
+            if self._queue is not None:
+                for thread in self._pool:
+                    self._queue.put(None)
+            self._queue = None
+            self._pool = []
+        finally:
+            self._lock.release()
+
+    def _process_queue(self):
+        queue = self._queue
+        while True:
+            job = queue.get()
+            if job is None:
+                return
+            self._lock.acquire()
+            try:
+                if job.cancelled:
+                    continue
+                job.state = RUNNING
+            finally:
+                self._lock.release()
+            trace.mutter('running job %s: %s' % (job.id, job.argv))
+            job.run()
+            self._job_done(job)
+
+    def _job_done(self, job):
+        self._lock.acquire()
+        try:
+            self._finished.append(job.id)
+            output_size = sum([self._jobs[job_id].output.size
+                               for job_id in self._finished
+                               if job_id in self._jobs])
+            while len(self._finished) > self.max_finished or \
+                    (len(self._finished) > 1 and
+                     output_size > self.max_output):
+                forgotten = self._jobs.pop(self._finished.pop(0), None)
+                if forgotten is not None:
+                    output_size -= forgotten.output.size
+        finally:
+            self._lock.release()
+
+    def _get_job(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            raise Fault(42, str(XMLError(UnknownJob(job_id))))
+        return job
+
+    def submit_job(self, argv, workdir):
+        """Run a bzr command in the background (errors are reported as in
+        run_bzr), return the id of the job.
+        """
+        self._lock.acquire()
+        try:
+            if self._queue is None:
+                self._start()
+            job = Job(str(self._next_id), argv, workdir)
+            self._next_id += 1
+            self._jobs[job.id] = job
+            self._queue.put(job)
+        finally:
+            self._lock.release()
+        return job.id
+
+    def job_status(self, job_id):
+        """Return the state of a job (queued, running, finished, failed or
+        cancelled), the size of its output so far and its exit status once
+        it's finished.
+        """
+        return self._get_job(job_id).get_status()
+
+    def job_result(self, job_id, offset=0, length=-1):
+        """Return the status of a job with length bytes of its output from
+        offset (all of it by default), and its stderr once it's finished.
+
+        The output can be read while the job is running. The Fault of a
+        failed job is raised.
+        """
+        job = self._get_job(job_id)
+        status = job.get_status()
+        if job.state == FAILED:
+            raise job.fault
+        status['output'] = Binary(job.output.read(offset, length))
+        if job.state == FINISHED:
+            status['stderr'] = job.stderr
+        return status
+
+    def cancel_job(self, job_id):
+        """Cancel a job, a running job stops the next time it writes output.
+
+        :return: False if the job had already finished.
+        """
+        self._lock.acquire()
+        try:
+            job = self._get_job(job_id)
+            if job.state not in (QUEUED, RUNNING):
+                return False
+            job.cancelled = True
+            if job.state == QUEUED:
+                job.state = CANCELLED
+                self._finished.append(job.id)
+        finally:
+            self._lock.release()
+        return True
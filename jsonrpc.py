@@ -0,0 +1,132 @@
+# -*- encoding: utf-8 -*-
+# Copyright (C) 2009 Guillermo Gonzalez
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+"""JSON-RPC 2.0 support for the xmlrpc service.
+
+The same functions registered for xmlrpc are available, with the same
+arguments (params can be an array, or an object for the keyword arguments).
+A Fault is returned as an error with the same code and message, and the
+Binary output of run_bzr as a (utf-8 decoded) string.
+"""
+
+import sys
+
+from xmlrpclib import Binary, Fault
+
+try:
+    import json
+except ImportError:
+    # python < 2.6
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+is_available = json is not None
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+
+def dispatch(server, data):
+    """Handle a JSON-RPC request (or a batch of them) with the functions
+    registered in server.
+
+    :return: the json response, or '' if there is nothing to send back (the
+        request only had notifications).
+    """
+    try:
+        request = json.loads(data)
+    except ValueError, e:
+        return dumps(_error(None, PARSE_ERROR, 'Parse error: %s' % e))
+    if isinstance(request, list):
+        if not request:
+            return dumps(_error(None, INVALID_REQUEST, 'Invalid Request'))
+        responses = [response for response in
+                     [_handle(server, item) for item in request]
+                     if response is not None]
+        if not responses:
+            return ''
+        return '[%s]' % ','.join([dumps(response)
+                                  for response in responses])
+    response = _handle(server, request)
+    if response is None:
+        return ''
+    return dumps(response)
+
+
+def _handle(server, request):
+    """Handle a single request, return the response or None."""
+    if not isinstance(request, dict):
+        return _error(None, INVALID_REQUEST, 'Invalid Request')
+    request_id = request.get('id')
+    method = request.get('method')
+    if request.get('jsonrpc') != '2.0' or \
+            not isinstance(method, basestring):
+        return _error(request_id, INVALID_REQUEST, 'Invalid Request')
+    params = request.get('params', [])
+    if isinstance(params, list):
+        args, kwargs = params, {}
+    elif isinstance(params, dict):
+        args = []
+        kwargs = dict([(str(name), value) for name, value in params.items()])
+    else:
+        return _error(request_id, INVALID_PARAMS, 'Invalid params')
+    func = server.funcs.get(method)
+    if func is None:
+        response = _error(request_id, METHOD_NOT_FOUND,
+                          'method "%s" is not supported' % method)
+    else:
+        try:
+            response = {'jsonrpc': '2.0', 'id': request_id,
+                        'result': func(*args, **kwargs)}
+        except Fault, fault:
+            response = _error(request_id, fault.faultCode, fault.faultString)
+        except:
+            # same as SimpleXMLRPCDispatcher
+            exc_type, exc_value, exc_tb = sys.exc_info()
+            response = _error(request_id, INTERNAL_ERROR,
+                              '%s:%s' % (exc_type, exc_value))
+    if 'id' not in request:
+        # a notification
+        return None
+    return response
+
+
+def _error(request_id, code, message):
+    return {'jsonrpc': '2.0', 'id': request_id,
+            'error': {'code': code, 'message': message}}
+
+
+def _default(obj):
+    if isinstance(obj, Binary):
+        return obj.data.decode('utf-8', 'replace')
+    raise TypeError('%r is not JSON serializable' % (obj,))
+
+
+def dumps(response):
+    """Return the json of a response."""
+    try:
+        return json.dumps(response, default=_default)
+    except (TypeError, ValueError, UnicodeDecodeError), e:
+        if 'result' not in response:
+            raise
+        return json.dumps(_error(response['id'], INTERNAL_ERROR,
+                                 'can not encode the result: %s' % e))
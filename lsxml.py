@@ -31,13 +31,43 @@ def show_ls_xml(outf, revision=None, non_recursive=False,
             from_root=False, unknown=False, versioned=False,
             ignored=False, kind=None, path=None, verbose=False):
 
-    if kind and kind not in ('file', 'directory', 'symlink'):
-        raise errors.BzrCommandError('invalid kind specified')
+    tree, relpath, prefix = open_ls_tree(revision=revision,
+        from_root=from_root, kind=kind, path=path)
+    long_status_kind = {'I':'ignored', '?':'unknown', 'V':'versioned'}
 
-    all = not (unknown or versioned or ignored)
+    tree.lock_read()
+    try:
+        outf.write('<list>')
+        for fp, fc, fkind, fid, pat in iter_ls(tree, relpath, prefix,
+                non_recursive=non_recursive, unknown=unknown,
+                versioned=versioned, ignored=ignored, kind=kind):
+            if fid is None:
+                fid = ''
+            else:
+                fid = '<id>%s</id>' % _escape_cdata(fid)
+            fkind = '<kind>%s</kind>' % fkind
+            status_kind = '<status_kind>%s</status_kind>' % long_status_kind[fc]
+            fpath = '<path>%s</path>' % _escape_cdata(fp)
+            if pat is not None:
+                pattern = '<pattern>%s</pattern>' % _escape_cdata(pat)
+            else:
+                pattern = ''
+            outstring = '<item>%s%s%s%s%s</item>' % (fid, fkind, fpath,
+                                                   status_kind, pattern)
+            outf.write(outstring)
+    finally:
+        outf.write('</list>')
+        tree.unlock()
 
-    selection = {'I':ignored, '?':unknown, 'V':versioned}
-    long_status_kind = {'I':'ignored', '?':'unknown', 'V':'versioned'}
+
+def open_ls_tree(revision=None, from_root=False, kind=None, path=None):
+    """Open the tree listed by ls.
+
+    :return: (tree, relpath, prefix) the tree, the directory to list and the
+        prefix for the listed paths.
+    """
+    if kind and kind not in ('file', 'directory', 'symlink'):
+        raise errors.BzrCommandError('invalid kind specified')
 
     if path is None:
         fs_path = '.'
@@ -61,39 +91,34 @@ def show_ls_xml(outf, revision=None, non_recursive=False,
             revision[0].as_revision_id(branch))
     elif tree is None:
         tree = branch.basis_tree()
+    return tree, relpath, prefix
 
-    tree.lock_read()
-    try:
-        outf.write('<list>')
-        for fp, fc, fkind, fid, entry in tree.list_files(include_root=False,
-                from_dir=relpath, recursive=not non_recursive):
-            if not all and not selection[fc]:
-                continue
-            if kind is not None and fkind != kind:
-                continue
-            if prefix:
-                fp = osutils.pathjoin(prefix, fp)
-            if fid is None:
-                fid = ''
-            else:
-                fid = '<id>%s</id>' % _escape_cdata(fid)
-            fkind = '<kind>%s</kind>' % fkind
-            status_kind = '<status_kind>%s</status_kind>' % long_status_kind[fc]
-            fpath = '<path>%s</path>' % _escape_cdata(fp)
-            if fc == 'I' and ignored:
-                # get the pattern
-                if tree.basedir in fp:
-                    pat = tree.is_ignored(tree.relpath(fp))
-                else:
-                    pat = tree.is_ignored(fp)
-                pattern = '<pattern>%s</pattern>' % _escape_cdata(pat)
-            else:
-                pattern = ''
-            outstring = '<item>%s%s%s%s%s</item>' % (fid, fkind, fpath,
-                                                   status_kind, pattern)
-            outf.write(outstring)
-    finally:
-        outf.write('</list>')
-        tree.unlock()
 
+def iter_ls(tree, relpath, prefix, non_recursive=False, unknown=False,
+            versioned=False, ignored=False, kind=None):
+    """Iterate over the files of a (locked) tree that ls shows.
+
+    Yields (path, class, kind, file_id, pattern), class is one of 'I', '?'
+    or 'V' and pattern is the ignore pattern of the ignored files (when
+    ignored is True) or None.
+    """
+    all = not (unknown or versioned or ignored)
+
+    selection = {'I':ignored, '?':unknown, 'V':versioned}
 
+    for fp, fc, fkind, fid, entry in tree.list_files(include_root=False,
+            from_dir=relpath, recursive=not non_recursive):
+        if not all and not selection[fc]:
+            continue
+        if kind is not None and fkind != kind:
+            continue
+        if prefix:
+            fp = osutils.pathjoin(prefix, fp)
+        pattern = None
+        if fc == 'I' and ignored:
+            # get the pattern
+            if tree.basedir in fp:
+                pattern = tree.is_ignored(tree.relpath(fp))
+            else:
+                pattern = tree.is_ignored(fp)
+        yield fp, fc, fkind, fid, pattern
@@ -0,0 +1,260 @@
+# -*- encoding: utf-8 -*-
+# Copyright (C) 2009 Guillermo Gonzalez
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+"""Metrics of the xmlrpc service, in the Prometheus text format."""
+
+import os
+import re
+import threading
+import time
+
+from bzrlib.lazy_import import lazy_import
+lazy_import(globals(), """
+from bzrlib import (
+    commands,
+    errors,
+    )
+""")
+from xmlrpclib import Fault
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                16777216)
+
+_error_class_re = re.compile('<class>([^<]*)</class>')
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        if labels:
+            labels += ','
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield '%s_bucket{%sle="%s"} %d' % (name, labels, bound,
+                                                cumulative)
+        yield '%s_bucket{%sle="+Inf"} %d' % (name, labels, self.count)
+        labels = labels.rstrip(',')
+        if labels:
+            labels = '{%s}' % labels
+        yield '%s_sum%s %s' % (name, labels, _format_value(self.sum))
+        yield '%s_count%s %d' % (name, labels, self.count)
+
+
+class Metrics(object):
+    """The counters of the requests handled by a process of the service.
+
+    Each worker process has its own metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.latency = {}
+        self.errors = {}
+        self.commands = {}
+        self.response_sizes = {}
+        self.in_flight = 0
+
+    def call(self, name, func, *args, **kwargs):
+        """Call func, counting it as a request for the method name."""
+        self._lock.acquire()
+        try:
+            self.in_flight += 1
+        finally:
+            self._lock.release()
+        error = None
+        start = time.time()
+        try:
+            try:
+                return func(*args, **kwargs)
+            except Fault, f:
+                match = _error_class_re.search(f.faultString)
+                if match is not None:
+                    error = match.group(1)
+                else:
+                    error = 'Fault'
+                raise
+            except Exception, e:
+                error = e.__class__.__name__
+                raise
+        finally:
+            elapsed = time.time() - start
+            self._lock.acquire()
+            try:
+                self.in_flight -= 1
+                self.requests[name] = self.requests.get(name, 0) + 1
+                if name not in self.latency:
+                    self.latency[name] = Histogram(LATENCY_BUCKETS)
+                self.latency[name].observe(elapsed)
+                if error is not None:
+                    self.errors[error] = self.errors.get(error, 0) + 1
+            finally:
+                self._lock.release()
+
+    def count_command(self, argv):
+        """Count a bzr command run by a request."""
+        name = 'unknown'
+        if len(argv) > 1:
+            try:
+                name = commands.get_cmd_object(argv[1]).name()
+            except (errors.BzrError, UnicodeError):
+                pass
+        self._lock.acquire()
+        try:
+            self.commands[name] = self.commands.get(name, 0) + 1
+        finally:
+            self._lock.release()
+
+    def response_size(self, endpoint, size):
+        """Record the size of a response sent by endpoint (xmlrpc, json or
+        stream), before it's compressed.
+        """
+        self._lock.acquire()
+        try:
+            if endpoint not in self.response_sizes:
+                self.response_sizes[endpoint] = Histogram(SIZE_BUCKETS)
+            self.response_sizes[endpoint].observe(size)
+        finally:
+            self._lock.release()
+
+    def render(self, caches=None):
+        """Return the metrics in the Prometheus text format.
+
+        :param caches: a dict of name: cache with hits and misses attributes.
+        """
+        lines = []
+        self._lock.acquire()
+        try:
+            _add_metric(lines, 'bzr_xmlrpc_requests_total', 'counter',
+                        'Requests by method.',
+                        [('method="%s"' % _escape(name), count)
+                         for name, count in sorted(self.requests.items())])
+            _add_histogram(lines, 'bzr_xmlrpc_request_duration_seconds',
+                           'Time to handle a request, by method.', 'method',
+                           self.latency)
+            _add_metric(lines, 'bzr_xmlrpc_commands_total', 'counter',
+                        'bzr commands run, by command name.',
+                        [('command="%s"' % _escape(name), count)
+                         for name, count in sorted(self.commands.items())])
+            _add_histogram(lines, 'bzr_xmlrpc_response_size_bytes',
+                           'Size of the responses, by endpoint.', 'endpoint',
+                           self.response_sizes)
+            _add_metric(lines, 'bzr_xmlrpc_errors_total', 'counter',
+                        'Failed requests, by error class.',
+                        [('class="%s"' % _escape(name), count)
+                         for name, count in sorted(self.errors.items())])
+            _add_metric(lines, 'bzr_xmlrpc_requests_in_flight', 'gauge',
+                        'Requests being handled.', [('', self.in_flight)])
+        finally:
+            self._lock.release()
+        if caches:
+            hits = []
+            misses = []
+            ratios = []
+            for name, cache in sorted(caches.items()):
+                label = 'cache="%s"' % name
+                hits.append((label, cache.hits))
+                misses.append((label, cache.misses))
+                total = cache.hits + cache.misses
+                if total:
+                    ratios.append((label, float(cache.hits) / total))
+            _add_metric(lines, 'bzr_xmlrpc_cache_hits_total', 'counter',
+                        'Cache hits.', hits)
+            _add_metric(lines, 'bzr_xmlrpc_cache_misses_total', 'counter',
+                        'Cache misses.', misses)
+            _add_metric(lines, 'bzr_xmlrpc_cache_hit_ratio', 'gauge',
+                        'Cache hits / lookups.', ratios)
+        rss = get_rss()
+        if rss is not None:
+            _add_metric(lines, 'process_resident_memory_bytes', 'gauge',
+                        'Resident memory size in bytes.', [('', rss)])
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n',
+                                                                   '\\n')
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _add_metric(lines, name, kind, help, samples):
+    lines.append('# HELP %s %s' % (name, help))
+    lines.append('# TYPE %s %s' % (name, kind))
+    for labels, value in samples:
+        if labels:
+            labels = '{%s}' % labels
+        lines.append('%s%s %s' % (name, labels, _format_value(value)))
+
+
+def _add_histogram(lines, name, help, label, histograms):
+    lines.append('# HELP %s %s' % (name, help))
+    lines.append('# TYPE %s histogram' % name)
+    for key, histogram in sorted(histograms.items()):
+        lines.extend(histogram.lines(name, '%s="%s"' % (label, _escape(key))))
+
+
+def get_rss():
+    """Return the resident memory of the process in bytes, or None if it's
+    not available (only linux is supported).
+    """
+    try:
+        f = open('/proc/self/statm')
+        try:
+            pages = int(f.read().split()[1])
+        finally:
+            f.close()
+    except (IOError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+_metrics = None
+
+
+def install_metrics(metrics):
+    """Count the bzr commands run by the service in metrics (None disables
+    it).
+    """
+    global _metrics
+    _metrics = metrics
+
+
+def count_command(argv):
+    if _metrics is not None:
+        _metrics.count_command(argv)
@@ -21,6 +21,7 @@
 """ xmlrpc service module """
 
 import os
+import threading
 
 from bzrlib.lazy_import import lazy_import
 lazy_import(globals(), """
@@ -29,38 +30,459 @@ from bzrlib import (
     commands,
     trace,
     errors,
-    osutils
+    osutils,
+    ui,
     )
 import sys
 import codecs
+import cProfile
+import errno
+import gzip
 import logging
+import marshal
 import traceback
+import Queue
+import select
+import signal
+import socket
+import stat
+import time
 from cStringIO import StringIO
 """)
 
+from bzrlib.plugins.xmloutput import (
+    admission,
+    cache,
+    jobs,
+    jsonrpc,
+    metrics,
+    timing,
+    )
 from bzrlib.plugins.xmloutput.xml_errors import XMLError
 from xmlrpclib import Fault, Binary
-from SimpleXMLRPCServer import SimpleXMLRPCServer
+import xmlrpclib
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
 
 run_dir = os.getcwdu()
 
 
+class BzrXMLRPCRequestHandler(SimpleXMLRPCRequestHandler):
+    """Handles the xmlrpc requests, the JSON-RPC 2.0 requests posted to
+    json_path, the streamed commands posted to stream_path and the GET
+    requests of the metrics in metrics_path.
+
+    A streamed command is a run_bzr or run_bzr_command xmlrpc request, the
+    response is the output of the command sent with chunked transfer
+    encoding as it's written. The result is in the trailer: X-Bzr-Exit-Status
+    and X-Bzr-Stderr, or X-Bzr-Fault-Code and X-Bzr-Fault-String if the
+    command raised a Fault (the strings are base64 encoded).
+    """
+
+    json_path = '/json'
+    stream_path = '/stream'
+    metrics_path = '/metrics'
+    stream_buffer_size = 32768
+
+    def setup(self):
+        if self.server.address_family == getattr(socket, 'AF_UNIX', None):
+            # TCP_NODELAY isn't supported by unix sockets
+            self.disable_nagle_algorithm = False
+        SimpleXMLRPCRequestHandler.setup(self)
+        self.encode_threshold = self.server.gzip_threshold or None
+        if self.server.keep_alive:
+            self.protocol_version = 'HTTP/1.1'
+            # the next request of the connection can be already buffered
+            self.rfile = self.server.get_connection_rfile(self.request,
+                                                          self.rfile)
+
+    def handle(self):
+        """Handle one request, with keep alive the server waits for the next
+        request of the connection (without using a thread).
+        """
+        if not self.server.keep_alive:
+            return SimpleXMLRPCRequestHandler.handle(self)
+        self.close_connection = 1
+        self.handle_one_request()
+
+    def finish(self):
+        if not self.server.keep_alive or self.close_connection:
+            return SimpleXMLRPCRequestHandler.finish(self)
+        if not self.wfile.closed:
+            try:
+                self.wfile.flush()
+            except socket.error:
+                # a final socket error may have occurred here, such as
+                # the local error ECONNABORTED.
+                self.close_connection = 1
+        self.wfile.close()
+
+    def do_GET(self):
+        if self.path != self.metrics_path:
+            self.report_404()
+            return
+        response = self.server.get_metrics()
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain; version=0.0.4")
+        response = self.encode_response(response)
+        self.send_header("Content-length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def do_POST(self):
+        timing.set_request_timeout(self.get_request_timeout())
+        admission.set_priority_hint(self.headers.get('x-bzr-priority'))
+        try:
+            self.dispatch_post()
+        finally:
+            timing.set_request_timeout(None)
+            admission.set_priority_hint(None)
+
+    def get_request_timeout(self):
+        """Return the timeout of the request, the X-Bzr-Timeout header or the
+        default of the server.
+        """
+        timeout = self.headers.get('x-bzr-timeout')
+        if timeout is not None:
+            try:
+                return float(timeout)
+            except ValueError:
+                pass
+        return self.server.request_timeout
+
+    def dispatch_post(self):
+        if self.path == self.stream_path:
+            return self.stream_command()
+        if self.path != self.json_path:
+            return SimpleXMLRPCRequestHandler.do_POST(self)
+        if not jsonrpc.is_available:
+            self.report_404()
+            return
+        try:
+            data = self.rfile.read(int(self.headers["content-length"]))
+            data = self.decode_request_content(data)
+            if data is None:
+                return # response has been sent
+            response = jsonrpc.dispatch(self.server, data)
+        except Exception, e:
+            trace.mutter('json request failed: %s' % (e,))
+            self.send_response(500)
+            self.send_header("Content-length", "0")
+            self.end_headers()
+            return
+        if not response:
+            # only notifications
+            self.send_response(204)
+            self.end_headers()
+            return
+        self.server.metrics.response_size('json', len(response))
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        response = self.encode_response(response)
+        self.send_header("Content-length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def stream_command(self):
+        """Run a command sending its output as it's written."""
+        if self.request_version != 'HTTP/1.1':
+            # chunked transfer encoding is needed for the trailer
+            self.send_error(505)
+            return
+        data = self.rfile.read(int(self.headers["content-length"]))
+        data = self.decode_request_content(data)
+        if data is None:
+            return # response has been sent
+        try:
+            params, method = xmlrpclib.loads(data)
+            argv, workdir = params
+            func = {'run_bzr': custom_commands_main,
+                    'run_bzr_command': commands.main}[method]
+        except (KeyError, ValueError, xmlrpclib.Error), e:
+            self.send_error(400, 'Bad stream request: %s' % (e,))
+            return
+        out = _ChunkedWriter(self, self.stream_buffer_size)
+        try:
+            exitval, err = self.server.call_function('stream_' + method,
+                                                     stream_bzr, argv,
+                                                     workdir, func, out)
+            trailer = {'X-Bzr-Exit-Status': str(exitval),
+                       'X-Bzr-Stderr': err.encode('base64')}
+        except Fault, f:
+            trailer = {'X-Bzr-Fault-Code': str(f.faultCode),
+                       'X-Bzr-Fault-String': f.faultString.encode('base64')}
+        except Exception, e:
+            trailer = {'X-Bzr-Fault-Code': '1',
+                       'X-Bzr-Fault-String':
+                       ('%s:%s' % (e.__class__, e)).encode('base64')}
+        out.close(trailer)
+        self.server.metrics.response_size('stream', out.size)
+
+    def start_stream(self):
+        """Send the headers of a streamed response."""
+        self.protocol_version = 'HTTP/1.1'
+        self.send_response(200)
+        self.send_header("Content-type", "application/octet-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Trailer", "X-Bzr-Exit-Status, X-Bzr-Stderr, "
+                         "X-Bzr-Fault-Code, X-Bzr-Fault-String")
+        if not self.server.keep_alive:
+            self.send_header("Connection", "close")
+            self.close_connection = 1
+        self.end_headers()
+
+    def encode_response(self, response):
+        """gzip the response if it's bigger than encode_threshold and the
+        client accepts it, sending the Content-Encoding header.
+        """
+        if self.encode_threshold is None or \
+                len(response) <= self.encode_threshold:
+            return response
+        if not self.accept_encodings().get("gzip", 0):
+            return response
+        response = _gzip_encode(response)
+        self.send_header("Content-Encoding", "gzip")
+        return response
+
+
+class _ChunkedWriter(object):
+    """A file-like object that sends what's written as the chunks of a
+    streamed response.
+    """
+
+    def __init__(self, handler, buffer_size=32768):
+        self.handler = handler
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._size = 0
+        self._started = False
+        # the bytes of output sent
+        self.size = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if not data:
+            return
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if not self._started:
+            self.handler.start_stream()
+            self._started = True
+        if not self._size:
+            return
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._size = 0
+        self.size += len(data)
+        self.handler.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+        self.handler.wfile.flush()
+
+    def close(self, trailer):
+        """Send the last chunk and the trailer."""
+        self.flush()
+        self.handler.wfile.write('0\r\n')
+        for name, value in trailer.items():
+            self.handler.wfile.write('%s: %s\r\n' %
+                                     (name, value.replace('\n', '')))
+        self.handler.wfile.write('\r\n')
+
+
+def _gzip_encode(data):
+    """gzip the data, as xmlrpclib.gzip_encode (python >= 2.7)"""
+    f = StringIO()
+    gzf = gzip.GzipFile(mode="wb", fileobj=f, compresslevel=1)
+    gzf.write(data)
+    gzf.close()
+    return f.getvalue()
+
+
 class BzrXMLRPCServer(SimpleXMLRPCServer):
-    """ Very simple xmlrpc server to handle bzr commands and search"""
+    """ Very simple xmlrpc server to handle bzr commands and search
+
+    By default requests are handled one at a time in the thread that calls
+    serve_forever. If threads is > 0 the requests are handed to a pool of
+    that many threads, so a slow command doesn't block the other clients.
+
+    If workers is > 0 (and the platform supports fork) serve_forever loads
+    bzrlib and the commands once, and then forks that many worker processes
+    that accept requests from the same socket. A quit request stops all the
+    workers, a worker that dies is replaced. A worker that handled
+    max_requests requests, or whose resident memory grew over max_rss
+    bytes, stops accepting requests, finishes the ones it has and exits to
+    be replaced by a fresh one (0 disables each limit).
+
+    The same functions are available with JSON-RPC 2.0, posting the requests
+    to /json (see jsonrpc.py).
+
+    If addr is a string instead of a (host, port) tuple, the service listens
+    on a unix socket at that path. The socket is only accessible by the user
+    running the service.
+
+    Connections are kept open (HTTP/1.1 keep alive) for the next request of
+    the client, until they are idle for idle_timeout seconds (0 disables
+    keep alive). There are at most max_connections open connections, the
+    one idle for longer is closed to accept a new one. Idle connections
+    don't use a thread of the pool.
+
+    Responses bigger than gzip_threshold bytes are compressed if the client
+    accepts gzip (0 disables it).
+
+    Commands can be submitted as jobs that run in the background in a pool
+    of job_threads threads (see jobs.py). The jobs live in the process that
+    received them, so they are not available with workers.
+
+    The metrics of the service (see metrics.py) are available with a GET
+    request to /metrics, or the metrics function. With workers, each process
+    reports its own metrics.
+
+    A request that takes more than request_timeout seconds (0 disables it)
+    is interrupted at the next safe point (see timing.py), and fails with
+    the RequestTimeout error. The clients can use another timeout with the
+    X-Bzr-Timeout header.
+
+    If max_running is > 0, only that many requests run commands at the same
+    time, up to max_queued wait for their turn by priority and the rest are
+    rejected (see admission.py). This is useful with threads, leaving free
+    threads for the cheap requests.
+
+    A quit request stops accepting connections and exits, the requests
+    being handled by other threads get up to stop_timeout seconds to finish
+    and the queued ones are dropped. A quit request with drain set waits
+    for the requests of the other threads or workers, up to drain_timeout
+    seconds. Before exiting, the caches are dropped and the metrics are
+    written to the log.
+    """
 
     finished = False
+    draining = False
+    stop_timeout = 1
+    _parent_pid = None
 
-    def __init__(self, addr, logRequests=False, to_file=None):
+    def __init__(self, addr, logRequests=False, to_file=None, threads=0,
+                 workers=0, object_cache_size=20, response_cache_size=0,
+                 idle_timeout=15, max_connections=64, gzip_threshold=1400,
+                 job_threads=2, request_timeout=0, max_running=0,
+                 max_queued=16, max_requests=0, max_rss=0,
+                 drain_timeout=30):
+        self._socket_owner = None
+        if isinstance(addr, basestring):
+            self.address_family = socket.AF_UNIX
         SimpleXMLRPCServer.__init__(self, addr=addr,
-            logRequests=logRequests)
+            requestHandler=BzrXMLRPCRequestHandler, logRequests=logRequests)
+        self.metrics = metrics.Metrics()
+        self.admission = admission.Admission(max_running, max_queued)
+        self.threads = threads
+        self.workers = workers
+        self.idle_timeout = idle_timeout
+        self.gzip_threshold = gzip_threshold
+        self.request_timeout = request_timeout
+        self.max_requests = max_requests
+        self.max_rss = max_rss
+        self.drain_timeout = drain_timeout
+        # set in the worker processes
+        self.worker = False
+        self.retiring = False
+        self._handled = 0
+        self.max_connections = max_connections
+        # the pool threads wake up the main loop with a pipe
+        self.keep_alive = idle_timeout > 0 and \
+            (not threads or sys.platform != 'win32')
+        self._connections_lock = threading.Lock()
+        self._idle_connections = {}
+        self._connection_rfiles = {}
+        self._open_connections = 0
+        self._wakeup = None
+        self.object_cache = None
+        if object_cache_size:
+            self.object_cache = cache.ObjectCache(object_cache_size)
+        self.response_cache = None
+        if response_cache_size:
+            self.response_cache = cache.ResponseCache(response_cache_size)
+        self._worker_pids = set()
+        self._parent_handlers = {}
+        self._request_queue = None
+        self._pool = []
         self.register_function(self.system_listMethods, 'list_methods')
         self.register_function(self.shutdown, 'quit')
         self.register_function(self.hello)
+        self.register_function(self.get_metrics, 'metrics')
         register_functions(self)
+        self.jobs = None
+        if not workers and job_threads:
+            self.jobs = jobs.JobManager(job_threads)
+            for name in jobs.methods:
+                self.register_function(getattr(self.jobs, name), name)
         self.to_file = to_file
         if to_file is None:
             self.to_file = sys.stdout
 
+    def register_function(self, function, name=None):
+        """Register a function, called with call_function."""
+        if name is None:
+            name = function.__name__
+        def call(*args, **kwargs):
+            return self.call_function(name, function, *args, **kwargs)
+        call.__doc__ = getattr(function, '__doc__', None)
+        SimpleXMLRPCServer.register_function(self, call, name)
+
+    def call_function(self, name, function, *args, **kwargs):
+        """Call the function of a request: track it in the metrics, wait for
+        its turn and interrupt it after the request timeout.
+
+        A timeout or a rejected request is a Fault with the XMLError of
+        RequestTimeout or ServiceOverloaded.
+        """
+        priority = admission.get_priority(name, args)
+        try:
+            return self.metrics.call(name, self.admission.call, priority,
+                                     timing.call_with_deadline, function,
+                                     *args, **kwargs)
+        except (timing.RequestTimeout, admission.ServiceOverloaded), e:
+            raise Fault(42, str(XMLError(e)))
+
+    def _marshaled_dispatch(self, data, dispatch_method=None, path=None):
+        response = SimpleXMLRPCServer._marshaled_dispatch(
+            self, data, dispatch_method, path)
+        self.metrics.response_size('xmlrpc', len(response))
+        return response
+
+    def server_bind(self):
+        if self.address_family != getattr(socket, 'AF_UNIX', None):
+            return SimpleXMLRPCServer.server_bind(self)
+        _remove_stale_socket(self.server_address)
+        old_umask = os.umask(0177)
+        try:
+            self.socket.bind(self.server_address)
+        finally:
+            os.umask(old_umask)
+        # the forked workers must not remove it
+        self._socket_owner = os.getpid()
+
+    def get_request(self):
+        request, client_address = SimpleXMLRPCServer.get_request(self)
+        if self._socket_owner is not None:
+            # the address of a unix socket client is '', the handler logs
+            # the host of a (host, port) tuple
+            client_address = (self.server_address, 0)
+        return request, client_address
+
+    def server_close(self):
+        SimpleXMLRPCServer.server_close(self)
+        if self._socket_owner == os.getpid():
+            self._socket_owner = None
+            try:
+                os.unlink(self.server_address)
+            except OSError:
+                pass
+
     def register_signal(self, signum):
         """register a signal using self.signal_handler"""
         signal.signal(signum, self.signal_handler)
@@ -70,12 +492,36 @@ class BzrXMLRPCServer(SimpleXMLRPCServer):
         print "Caught signal", signum
         self.shutdown()
 
-    def shutdown(self):
-        """ stop serving and return 1 """
+    def shutdown(self, drain=False):
+        """ stop serving and return 1
+
+        If drain is True, the requests being handled by the other workers
+        finish before they exit.
+        """
         self.finished = True
-        self.server_close()
+        self.draining = self.draining or bool(drain)
+        # serve_requests closes the socket once it stops, we might be
+        # running in the thread that serves the requests.
+        if self._wakeup is not None:
+            try:
+                os.write(self._wakeup[1], 'x')
+            except OSError:
+                pass
         return 1
 
+    def drain_signal_handler(self, signum, frame):
+        """Handle the signal of the parent process, to drain the worker."""
+        self.shutdown(drain=True)
+
+    def flush(self):
+        """Drop the cached objects and responses, and log the metrics."""
+        if self.object_cache is not None:
+            self.object_cache.clear()
+        if self.response_cache is not None:
+            self.response_cache.clear()
+        trace.mutter('metrics of process %d:\n%s'
+                     % (os.getpid(), self.get_metrics()))
+
     def serve_forever(self):
         """Start serving, and block"""
         import bzrlib.osutils
@@ -88,81 +534,1003 @@ class BzrXMLRPCServer(SimpleXMLRPCServer):
         # support new super lazy commands (bzr-1.17)
         if getattr(commands, 'install_bzr_command_hooks'):
             commands.install_bzr_command_hooks()
-        while not self.finished:
-            self.handle_request()
+        if self.object_cache is not None:
+            cache.install_object_cache(self.object_cache)
+        if self.response_cache is not None:
+            cache.install_response_cache(self.response_cache)
+        metrics.install_metrics(self.metrics)
+        if not (self.threads or self.workers) and self.jobs is None:
+            # the requests don't run concurrently (the jobs would)
+            set_chdir_thread(threading.currentThread())
+        try:
+            if self.workers > 0 and getattr(os, 'fork', None) is not None:
+                self.warm_up()
+                self.serve_workers()
+            else:
+                self.serve_requests()
+        finally:
+            set_chdir_thread(None)
+
+    def serve_requests(self):
+        """Handle requests until we are finished."""
+        if self.keep_alive:
+            self._wakeup = os.pipe()
+        if self.threads or self.worker:
+            # wake up from time to time to check if we are finished
+            self.timeout = 0.5
+        if self.threads:
+            self.start_pool()
+        try:
+            if self.keep_alive:
+                self.serve_connections()
+            else:
+                while self._keep_serving():
+                    self.handle_request()
+        finally:
+            # stop accepting connections, and finish the accepted ones
+            self.server_close()
+            if self.keep_alive:
+                self._close_idle_connections(None)
+            if self.threads:
+                if self.draining or self.retiring:
+                    self.stop_pool(self.drain_timeout)
+                else:
+                    # like the workers, that are terminated right away
+                    self._drop_queued_requests()
+                    self.stop_pool(self.stop_timeout)
+            if self.jobs is not None:
+                self.jobs.stop()
+            if self.keep_alive:
+                os.close(self._wakeup[0])
+                os.close(self._wakeup[1])
+                self._wakeup = None
+            self.flush()
+
+    def serve_connections(self):
+        """Accept connections, and wait for the requests of the open ones
+        until we are finished.
+        """
+        # other workers can accept the connection first
+        self.socket.setblocking(0)
+        while self._keep_serving():
+            self._connections_lock.acquire()
+            try:
+                readers = self._idle_connections.keys()
+                accept = self._idle_connections or \
+                    self._open_connections < self.max_connections
+            finally:
+                self._connections_lock.release()
+            if accept:
+                readers.append(self.socket)
+            readers.append(self._wakeup[0])
+            try:
+                ready = select.select(readers, [], [], 0.5)[0]
+            except (select.error, socket.error), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if self.finished:
+                    # the socket was closed by quit
+                    break
+                raise
+            for sock in ready:
+                if self.finished:
+                    break
+                if sock == self._wakeup[0]:
+                    os.read(sock, 512)
+                elif sock is self.socket:
+                    self._accept_connection()
+                else:
+                    self._connections_lock.acquire()
+                    try:
+                        client_address, since = \
+                            self._idle_connections.pop(sock)
+                    finally:
+                        self._connections_lock.release()
+                    self.process_request(sock, client_address)
+            self._close_idle_connections(time.time() - self.idle_timeout)
+
+    def _keep_serving(self):
+        """Return False once we are finished or retiring.
+
+        A worker whose parent process died is finished, so the workers
+        don't outlive a parent that was killed.
+        """
+        if self.worker and os.getppid() != self._parent_pid:
+            trace.mutter('worker %d: the parent process died' % os.getpid())
+            self.finished = True
+        return not (self.finished or self.retiring)
+
+    def _accept_connection(self):
+        try:
+            request, client_address = self.get_request()
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                trace.mutter('accept failed: %s' % (e,))
+            return
+        request.setblocking(1)
+        self._connections_lock.acquire()
+        try:
+            if self._open_connections >= self.max_connections:
+                self._close_oldest_idle_connection()
+            self._open_connections += 1
+        finally:
+            self._connections_lock.release()
+        if self.verify_request(request, client_address):
+            self.process_request(request, client_address)
+        else:
+            self._close_connection(request)
+
+    def _close_oldest_idle_connection(self):
+        """Close the connection idle for longer, the lock must be held."""
+        oldest = None
+        for sock, (client_address, since) in self._idle_connections.items():
+            if oldest is None or since < oldest[1]:
+                oldest = (sock, since)
+        if oldest is not None:
+            del self._idle_connections[oldest[0]]
+            self._close_connection(oldest[0], locked=True)
+
+    def _close_idle_connections(self, idle_since):
+        """Close the connections idle since before idle_since (all if
+        None).
+        """
+        self._connections_lock.acquire()
+        try:
+            for sock, (client_address, since) in \
+                    self._idle_connections.items():
+                if idle_since is None or since < idle_since:
+                    del self._idle_connections[sock]
+                    self._close_connection(sock, locked=True)
+        finally:
+            self._connections_lock.release()
+
+    def _close_connection(self, request, locked=False):
+        if not locked:
+            self._connections_lock.acquire()
+        try:
+            self._open_connections -= 1
+            rfile = self._connection_rfiles.pop(request, None)
+        finally:
+            if not locked:
+                self._connections_lock.release()
+        if rfile is not None:
+            rfile.close()
+        self.shutdown_request(request)
+
+    def get_connection_rfile(self, request, rfile):
+        """Return the file used to read the requests of the connection.
+
+        :param rfile: the file to use if it's the first request.
+        """
+        self._connections_lock.acquire()
+        try:
+            previous = self._connection_rfiles.setdefault(request, rfile)
+        finally:
+            self._connections_lock.release()
+        if previous is not rfile:
+            rfile.close()
+        return previous
+
+    def _handle_connection(self, request, client_address):
+        """Handle a request, and keep the connection for the next one (if the
+        handler didn't close it).
+
+        The requests the client sent without waiting for the responses
+        (pipelined) are handled right away, in order.
+        """
+        while True:
+            keep = False
+            try:
+                handler = self.finish_request(request, client_address)
+                keep = self.keep_alive and \
+                    not (self.finished or self.retiring) and \
+                    handler is not None and not handler.close_connection
+            except:
+                self.handle_error(request, client_address)
+            self._request_done()
+            if not keep:
+                if self.keep_alive:
+                    self._close_connection(request)
+                else:
+                    self.shutdown_request(request)
+                return
+            if not self._has_pipelined_request(request):
+                break
+        self._connections_lock.acquire()
+        try:
+            self._idle_connections[request] = (client_address, time.time())
+        finally:
+            self._connections_lock.release()
+        if self._request_queue is not None:
+            # wake up the main loop to wait for the next request
+            try:
+                os.write(self._wakeup[1], 'x')
+            except OSError:
+                pass
+
+    def _has_pipelined_request(self, request):
+        """Return True if the next request of the connection was already
+        read in the buffer of its file (select wouldn't see it).
+        """
+        self._connections_lock.acquire()
+        try:
+            rfile = self._connection_rfiles.get(request)
+        finally:
+            self._connections_lock.release()
+        rbuf = getattr(rfile, '_rbuf', None)
+        return rbuf is not None and rbuf.tell() > 0
+
+    def _request_done(self):
+        """Count a handled request, and retire the worker process if it
+        handled max_requests or it uses more than max_rss memory.
+        """
+        if not self.worker:
+            return
+        self._connections_lock.acquire()
+        try:
+            self._handled += 1
+            handled = self._handled
+        finally:
+            self._connections_lock.release()
+        if self.retiring:
+            return
+        rss = None
+        if self.max_rss:
+            rss = metrics.get_rss()
+        if self.max_requests and handled >= self.max_requests:
+            reason = 'handled %d requests' % handled
+        elif rss is not None and rss > self.max_rss:
+            reason = 'uses %d bytes' % rss
+        else:
+            return
+        trace.mutter('retiring worker %d: %s' % (os.getpid(), reason))
+        self.retiring = True
+        if self._wakeup is not None:
+            try:
+                os.write(self._wakeup[1], 'x')
+            except OSError:
+                pass
+
+    def finish_request(self, request, client_address):
+        return self.RequestHandlerClass(request, client_address, self)
+
+    def warm_up(self):
+        """Load the commands and the modules they use, so the forked workers
+        don't need to do it for each request.
+        """
+        from bzrlib import (
+            annotate,
+            builtins,
+            bzrdir,
+            info,
+            log,
+            missing,
+            status,
+            workingtree,
+            )
+        from bzrlib.plugins.xmloutput import (
+            annotatexml,
+            cmds,
+            infoxml,
+            logxml,
+            lsxml,
+            missingxml,
+            statusxml,
+            structured,
+            versionxml,
+            )
+        for name in commands.all_command_names():
+            try:
+                commands.get_cmd_object(name)
+            except Exception, e:
+                trace.mutter('failed to load command %s: %s' % (name, e))
+
+    def serve_workers(self):
+        """Fork the worker processes, and wait for them to finish.
+
+        SIGTERM and SIGINT stop the workers before we exit.
+        """
+        self._parent_pid = os.getpid()
+        self._parent_handlers = {}
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                self._parent_handlers[signum] = signal.signal(
+                    signum, self.stop_signal_handler)
+            except ValueError:
+                # not the main thread
+                pass
+        try:
+            for i in range(self.workers):
+                self.start_worker()
+            while self._worker_pids:
+                try:
+                    pid, status = os.wait()
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                self._worker_pids.discard(pid)
+                if os.WIFEXITED(status) and os.WEXITSTATUS(status) in (
+                        0, _DRAINED_EXIT_STATUS):
+                    # the worker handled a quit request
+                    self.finished = True
+                    self.draining = \
+                        os.WEXITSTATUS(status) == _DRAINED_EXIT_STATUS
+                    self.stop_workers()
+                elif not self.finished:
+                    if not (os.WIFEXITED(status) and os.WEXITSTATUS(status)
+                            == _RETIRED_EXIT_STATUS):
+                        trace.mutter('worker %d died with status %d'
+                                     % (pid, status))
+                    self.start_worker()
+        finally:
+            self.stop_workers()
+            self.server_close()
+            for signum, handler in self._parent_handlers.items():
+                signal.signal(signum, handler)
+            self._parent_handlers = {}
+
+    def stop_signal_handler(self, signum, frame):
+        """Handle SIGTERM and SIGINT in the parent process, stopping the
+        workers.
+        """
+        self.finished = True
+        self.stop_workers()
+
+    def start_worker(self):
+        """Fork a worker process, the child never returns from here."""
+        pid = os.fork()
+        if pid:
+            self._worker_pids.add(pid)
+            return
+        exitval = 1
+        try:
+            try:
+                self._worker_pids = set()
+                self.worker = True
+                for signum, handler in self._parent_handlers.items():
+                    signal.signal(signum, handler)
+                signal.signal(signal.SIGUSR1, self.drain_signal_handler)
+                self.serve_requests()
+                if self.finished and self.draining:
+                    exitval = _DRAINED_EXIT_STATUS
+                elif self.retiring and not self.finished:
+                    exitval = _RETIRED_EXIT_STATUS
+                else:
+                    exitval = 0
+            except:
+                traceback.print_exc(file=sys.__stderr__)
+        finally:
+            os._exit(exitval)
+
+    def stop_workers(self):
+        """Terminate the running workers and wait for them.
+
+        If we are draining, the workers finish their requests first (for up
+        to drain_timeout seconds).
+        """
+        if self.draining:
+            self._signal_workers(signal.SIGUSR1)
+            deadline = time.time() + self.drain_timeout
+            while self._worker_pids and time.time() < deadline:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    if e.errno == errno.ECHILD:
+                        break
+                    raise
+                if pid:
+                    self._worker_pids.discard(pid)
+                else:
+                    time.sleep(0.1)
+        self._signal_workers(signal.SIGTERM)
+        while self._worker_pids:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            self._worker_pids.discard(pid)
+        self._worker_pids = set()
+
+    def _signal_workers(self, signum):
+        for pid in self._worker_pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def start_pool(self):
+        """Start the threads that handle the requests."""
+        self._request_queue = Queue.Queue()
+        for i in range(self.threads):
+            thread = threading.Thread(target=self._process_request_queue,
+                                      name='bzr-xmlrpc-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            self._pool.append(thread)
+
+    def stop_pool(self, timeout=None):
+        """Stop the pool threads, after they finish the queued requests.
+
+        :param timeout: the seconds to wait for them, None waits until they
+            finish.
+        """
+        for thread in self._pool:
+            self._request_queue.put(None)
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        for thread in self._pool:
+            if deadline is None:
+                thread.join()
+            else:
+                thread.join(max(0, deadline - time.time()))
+                if thread.isAlive():
+                    trace.mutter('%s still running after %s seconds'
+                                 % (thread.getName(), timeout))
+        self._pool = []
+
+    def _drop_queued_requests(self):
+        """Close the connections queued for the pool."""
+        while True:
+            try:
+                item = self._request_queue.get_nowait()
+            except Queue.Empty:
+                return
+            if item is not None:
+                self.shutdown_request(item[0])
+
+    def process_request(self, request, client_address):
+        """Queue the request for the pool, or handle it if there is no pool."""
+        if self._request_queue is None:
+            return self._handle_connection(request, client_address)
+        self._request_queue.put((request, client_address))
+
+    def _process_request_queue(self):
+        """Main loop of the pool threads."""
+        while True:
+            item = self._request_queue.get()
+            if item is None:
+                return
+            request, client_address = item
+            self._handle_connection(request, client_address)
 
     def hello(self):
         """ simple reply to hello request, 'world!'"""
         return 'world!'
 
+    def get_metrics(self):
+        """Return the metrics of the service in the Prometheus text format."""
+        caches = {}
+        if self.object_cache is not None:
+            caches['objects'] = self.object_cache
+        if self.response_cache is not None:
+            caches['responses'] = self.response_cache
+        return self.metrics.render(caches)
 
-class redirect_output(object):
-    """decorator to redirect stdout/err to a StringIO"""
 
-    def __init__(self, func):
+# the exit status of a worker that retired, to be replaced
+_RETIRED_EXIT_STATUS = 3
+# the exit status of a worker that handled a quit request with drain
+_DRAINED_EXIT_STATUS = 4
+
+
+def _remove_stale_socket(path):
+    """Remove the unix socket at path, if there isn't a service using it.
+
+    Anything that isn't a socket is left alone, as an address in use.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+    if not stat.S_ISSOCK(st.st_mode):
+        raise socket.error(errno.EADDRINUSE,
+                           'Address already in use: %s' % path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error, e:
+            if e.args[0] not in (errno.ECONNREFUSED, errno.ENOENT):
+                raise
+            trace.mutter('removing stale socket %s' % path)
+            os.unlink(path)
+            return
+    finally:
+        sock.close()
+    raise socket.error(errno.EADDRINUSE, 'Address already in use: %s' % path)
+
+
+class _ThreadOutput(object):
+    """A file-like object that writes to the buffer of the current thread.
+
+    Threads that aren't capturing their output write to the wrapped file.
+    """
+
+    def __init__(self, name, default):
+        self._name = name
+        self._default = default
+
+    def _get_file(self):
+        to_file = getattr(_request_state, self._name, None)
+        if to_file is None:
+            return self._default
+        return to_file
+
+    def write(self, data):
+        if self._name == 'stdout':
+            # not stderr, the logging module ignores the errors of the
+            # handlers, and the interruption would be lost
+            timing.check_deadline()
+        return self._get_file().write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._get_file(), name)
+
+
+class _OutputCapture(object):
+    """Replaces sys.stdout/err while at least one thread capture its output.
+
+    Each thread that calls start() gets its own StringIO for stdout and
+    stderr, the bzr logger is redirected to the stderr of the thread doing
+    the logging.
+    """
+
+    def __init__(self):
         self.writer_factory = codecs.getwriter('utf8')
-        self.func = func
-        self.logger_removed = False
+        self._lock = threading.Lock()
+        self._count = 0
+        self._saved = None
+        self._handler = None
 
-    def __call__(self, *args, **kwargs):
-        if self.logger_removed:
-            self.remove_logger()
-        trace.mutter('%s arguments: %s' % (self.func.func_name, str(args)))
-        sys.stdout = StringIO()
-        sys.stderr = StringIO()
-        self.set_logger()
+    def start(self, stdout=None):
+        if stdout is None:
+            stdout = StringIO()
+        _request_state.stdout = stdout
+        _request_state.stderr = StringIO()
+        self._lock.acquire()
         try:
-            return self.func(*args, **kwargs)
+            if self._count == 0:
+                self._saved = (sys.stdout, sys.stderr)
+                sys.stdout = _ThreadOutput('stdout', sys.stdout)
+                sys.stderr = _ThreadOutput('stderr', sys.stderr)
+                self.set_logger()
+            self._count += 1
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        self._lock.acquire()
+        try:
+            self._count -= 1
+            if self._count == 0:
+                self.remove_logger()
+                sys.stdout, sys.stderr = self._saved
+                self._saved = None
         finally:
-            self.remove_logger()
-            sys.stdout = sys.__stdout__
-            sys.stderr = sys.__stderr__
+            self._lock.release()
+        _request_state.stdout = None
+        _request_state.stderr = None
 
     def set_logger(self):
         """add sys.stderr as a log handler"""
+        # only keep the .bzr.log handler
+        del trace._bzr_logger.handlers[1:len(trace._bzr_logger.handlers)]
         encoded_stderr = self.writer_factory(sys.stderr, errors='replace')
-        stderr_handler = logging.StreamHandler(encoded_stderr)
-        stderr_handler.setLevel(logging.INFO)
-        logging.getLogger('bzr').addHandler(stderr_handler)
+        self._handler = logging.StreamHandler(encoded_stderr)
+        self._handler.setLevel(logging.INFO)
+        logging.getLogger('bzr').addHandler(self._handler)
 
     def remove_logger(self):
-        """removes extra log handlers, only keeps the .bzr.log handler"""
-        self.logger_removed = True
-        del trace._bzr_logger.handlers[1:len(trace._bzr_logger.handlers)]
+        """removes the handler added by set_logger"""
+        logging.getLogger('bzr').removeHandler(self._handler)
+        self._handler = None
+
+
+_request_state = threading.local()
+_output_capture = _OutputCapture()
+
+
+_getcwd_hooks = None
+
+
+def _install_getcwd_hooks():
+    """Make os.getcwd, os.getcwdu and osutils.getcwd return the workdir of
+    the current request.
+
+    This is how the requests run in their own working directory, the process
+    working directory is never changed.
+    """
+    global _getcwd_hooks
+    if _getcwd_hooks is not None:
+        return
+    _getcwd_hooks = (os.getcwd, os.getcwdu, osutils.getcwd)
+    orig_getcwd, orig_getcwdu, orig_osutils_getcwd = _getcwd_hooks
+
+    def getcwd():
+        workdir = getattr(_request_state, 'workdir', None)
+        if workdir is None:
+            return orig_getcwd()
+        return workdir.encode(osutils._fs_enc)
+
+    def getcwdu():
+        workdir = getattr(_request_state, 'workdir', None)
+        if workdir is None:
+            return orig_getcwdu()
+        return workdir
+
+    def osutils_getcwd():
+        workdir = getattr(_request_state, 'workdir', None)
+        if workdir is None:
+            return orig_osutils_getcwd()
+        return osutils.normpath(workdir)
+
+    os.getcwd = getcwd
+    os.getcwdu = getcwdu
+    osutils.getcwd = osutils_getcwd
+
+
+def _resolve_workdir(workdir):
+    """Return workdir as an absolute path (relative to run_dir)."""
+    workdir = osutils.safe_unicode(workdir)
+    return os.path.normpath(os.path.join(run_dir, workdir))
+
+
+def set_workdir(workdir):
+    """Set the working directory of the current thread.
+
+    A relative workdir is relative to the directory where the service was
+    started. None restores the process working directory.
+
+    :return: the previous workdir of the thread.
+    """
+    _install_getcwd_hooks()
+    previous = getattr(_request_state, 'workdir', None)
+    if workdir is not None:
+        workdir = _resolve_workdir(workdir)
+    _request_state.workdir = workdir
+    return previous
+
+
+# the thread whose requests change the process working directory, None if
+# the requests run concurrently (see _enter_request)
+_chdir_thread = None
+
+
+def set_chdir_thread(thread):
+    """Make the requests handled by thread change the process working
+    directory to their workdir.
+
+    It's only safe when no other thread handles requests or runs jobs, the
+    requests of the other threads only see their workdir in os.getcwd (see
+    set_workdir),
+    so the files that bzrlib opens with a relative path are still relative
+    to the process working directory.
+    """
+    global _chdir_thread
+    _chdir_thread = thread
+
+
+# the options and arguments of the commands that are local paths, made
+# absolute with the workdir of the request (see resolve_path_arguments)
+path_options = {
+    'commit': ['file'],
+    'send': ['output'],
+    'bundle-revisions': ['output'],
+    }
+path_arguments = {
+    'export': ['dest'],
+    }
+
+
+def resolve_path_arguments(argv):
+    """Return argv with the local paths it has (see path_options and
+    path_arguments) relative to os.getcwdu(), the workdir of the request.
+    """
+    if len(argv) < 2 or argv[1].startswith('-'):
+        return argv
+    try:
+        cmd = commands.get_cmd_object(argv[1])
+    except (errors.BzrError, UnicodeError):
+        return argv
+    name = cmd.name()
+    option_names = path_options.get(name, [])
+    argument_names = path_arguments.get(name, [])
+    if not (option_names or argument_names):
+        return argv
+    options = cmd.options()
+    short_options = {}
+    for option in options.values():
+        short_name = option.short_name()
+        if short_name:
+            short_options[short_name] = option
+    workdir = os.getcwdu()
+
+    def resolve(path):
+        if path == '-':
+            return path
+        return osutils.pathjoin(workdir, osutils.safe_unicode(path))
+
+    positional = list(cmd.takes_args)
+    result = list(argv[:2])
+    args = list(argv[2:])
+    options_done = False
+    while args:
+        arg = args.pop(0)
+        if options_done or not arg.startswith('-') or arg == '-':
+            if positional:
+                if positional[0].rstrip('?*+$') in argument_names:
+                    arg = resolve(arg)
+                if not positional[0].endswith(('*', '+')):
+                    positional.pop(0)
+        elif arg == '--':
+            options_done = True
+        else:
+            if arg.startswith('--'):
+                option_name, equals, value = arg[2:].partition('=')
+                option = options.get(option_name)
+                prefix = '--%s=' % option_name
+                separate = not equals
+            else:
+                option = short_options.get(arg[1])
+                value = arg[2:]
+                prefix = arg[:2]
+                separate = not value
+            if option is None or option.type is None:
+                pass
+            elif separate and args:
+                # the value is the next argument
+                result.append(arg)
+                arg = args.pop(0)
+                if option.name in option_names:
+                    arg = resolve(arg)
+            elif value and option.name in option_names:
+                arg = prefix + resolve(value)
+        result.append(arg)
+    return result
+
+
+class redirect_output(object):
+    """decorator to redirect stdout/err to a StringIO (one per thread)"""
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args, **kwargs):
+        trace.mutter('%s arguments: %s' % (self.func.func_name, str(args)))
+        _output_capture.start()
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            _output_capture.stop()
 
 
 @redirect_output
-def run_bzr(argv, workdir):
-    """run a regular bzr command"""
-    return _run_bzr(argv, workdir, commands.main)
+def run_bzr(argv, workdir, timings=False):
+    """run a regular bzr command
+
+    If timings is True, the breakdown of the time spent by the request is
+    added to the response (see _run_bzr).
+    """
+    return _run_bzr(argv, workdir, commands.main, timings)
 
 
 @redirect_output
-def run_bzr_xml(argv, workdir):
+def run_bzr_xml(argv, workdir, timings=False):
     """run a bzr command, but handle errors using XMLError"""
-    return _run_bzr(argv, workdir, custom_commands_main)
+    return _run_bzr(argv, workdir, custom_commands_main, timings)
+
+
+def _enter_request(workdir):
+    """Set the workdir of the request and start using the object cache.
+
+    The process working directory is changed if the request runs in the
+    thread set by set_chdir_thread, else only the workdir of the thread.
+    """
+    if workdir is not None and \
+            threading.currentThread() is _chdir_thread and \
+            getattr(_request_state, 'workdir', None) is None:
+        previous_cwd = os.getcwdu()
+        os.chdir(_resolve_workdir(workdir))
+        return None, previous_cwd, cache.use_cached_objects()
+    previous_workdir = set_workdir(workdir)
+    return previous_workdir, None, cache.use_cached_objects()
+
+
+def _leave_request(state):
+    """Undo _enter_request."""
+    previous_workdir, previous_cwd, release_objects = state
+    if release_objects:
+        cache.release_objects()
+    if previous_cwd is not None:
+        os.chdir(previous_cwd)
+    else:
+        set_workdir(previous_workdir)
+
+
+def run_in_workdir(workdir, func, *args):
+    """Call func(*args) with workdir as the working directory.
+
+    Errors are reported like in run_bzr: a Fault with the XMLError of the
+    exception.
+    """
+    state = _enter_request(workdir)
+    try:
+        try:
+            return func(*args)
+        except errors.BzrError, e:
+            raise Fault(42, str(XMLError(e)))
+        except Fault:
+            raise
+        except Exception, e:
+            traceback.print_exc(file=sys.__stderr__)
+            raise Fault(32, str(XMLError(e)))
+    finally:
+        _leave_request(state)
+
+
+@redirect_output
+def profile_bzr(argv, workdir):
+    """run a bzr command (errors are reported as in run_bzr) with cProfile.
+
+    The response cache isn't used, the command always runs.
+
+    :return: the response of run_bzr with the profile stats as a 4th item,
+        the data that pstats.Stats loads from a file (see dump_stats).
+    """
+    profiler = cProfile.Profile()
+    response = profiler.runcall(_run_bzr, argv, workdir,
+                                custom_commands_main, use_cache=False)
+    if isinstance(response, Fault):
+        return response
+    profiler.create_stats()
+    return response + (Binary(marshal.dumps(profiler.stats)),)
 
 
-def _run_bzr(argv, workdir, func):
-    """Actually executes the command and build the response."""
+def _run_bzr(argv, workdir, func, timings=False, use_cache=True):
+    """Actually executes the command and build the response.
+
+    If timings is True, a struct with the seconds spent in each part of the
+    request is added to the response: open, lock and write (see timing.py),
+    run (the command, including the previous ones), encode (marshalling the
+    response, timed by marshalling it one more time) and total. If use_cache
+    is False the response cache is not used.
+    """
+    if timings:
+        timing.start()
+        _request_state.stdout = timing.TimedOutput(_request_state.stdout)
+        start_time = time.time()
+        try:
+            response = _run_bzr(argv, workdir, func, use_cache=use_cache)
+        finally:
+            breakdown = timing.stop()
+        if isinstance(response, Fault):
+            return response
+        # the response is marshalled once it's returned (base64 for the
+        # output and xml), do it here too to know how long it takes
+        encode_start = time.time()
+        xmlrpclib.dumps((response,), methodresponse=1)
+        breakdown['encode'] = time.time() - encode_start
+        for category in ('open', 'lock', 'write', 'run'):
+            breakdown.setdefault(category, 0.0)
+        breakdown['total'] = time.time() - start_time
+        return response + (breakdown,)
+    state = _enter_request(workdir)
     try:
-        os.chdir(workdir)
-        exitval = func(argv)
-        sys.stderr.flush()
-        sys.stdout.flush()
-        if isinstance(exitval, Fault):
-            return_val = exitval
+        try:
+            response_cache = None
+            if use_cache:
+                response_cache = cache.get_response_cache()
+            key = None
+            if response_cache is not None:
+                key = cache.get_response_key(func.__name__, argv)
+                if key is not None:
+                    response = response_cache.get(key)
+                    if response is not None:
+                        return response
+            metrics.count_command(argv)
+            argv = resolve_path_arguments(argv)
+            start_time = time.time()
+            # commands write to the ui factory output, make it the buffer
+            ui.ui_factory = ui.make_ui_for_terminal(sys.stdin, sys.stdout,
+                                                    sys.stderr)
+            exitval = func(argv)
+            sys.stderr.flush()
+            sys.stdout.flush()
+            timing.add('run', time.time() - start_time)
+            if isinstance(exitval, Fault):
+                return_val = exitval
+            else:
+                # use a Binary object to wrap the output to avoid NULL and
+                # other non xmlrpc (or client xml parsers) friendly chars
+                out = Binary(data=sys.stdout.getvalue())
+                return_val = (exitval, out, sys.stderr.getvalue())
+                if key is not None and exitval == 0:
+                    response_cache.add(key, return_val)
+            return return_val
+        except:
+            traceback.print_exc(file=sys.__stderr__)
+            raise
+    finally:
+        _leave_request(state)
+
+
+def stream_bzr(argv, workdir, func, stdout):
+    """Run a command with func (run_bzr or custom_commands_main) writing its
+    output to stdout, instead of a buffer.
+
+    :return: (exitval, stderr)
+    """
+    trace.mutter('stream_bzr arguments: %s' % (argv,))
+    _output_capture.start(stdout=stdout)
+    try:
+        state = _enter_request(workdir)
+        try:
+            # commands write to the ui factory output, make it the stream
+            ui.ui_factory = ui.make_ui_for_terminal(sys.stdin, sys.stdout,
+                                                    sys.stderr)
+            metrics.count_command(argv)
+            exitval = func(resolve_path_arguments(argv))
+            sys.stderr.flush()
+            sys.stdout.flush()
+            return exitval, sys.stderr.getvalue()
+        finally:
+            _leave_request(state)
+    finally:
+        _output_capture.stop()
+
+
+def run_bzr_batch(argv_lists, workdir):
+    """run several bzr commands (errors are reported as in run_bzr) in the
+    same request.
+
+    The tree (or branch) of workdir is read locked while the commands run,
+    and they reuse the same opened objects if the object cache is enabled.
+
+    :return: a list with the response of each command, or a struct with the
+        faultCode and faultString of the commands that failed (as in
+        system.multicall).
+    """
+    trace.mutter('run_bzr_batch arguments: %s' % (argv_lists,))
+    state = _enter_request(workdir)
+    try:
+        try:
+            tree, branch, relpath = cache.open_tree_or_branch(u'.')
+        except errors.BzrError:
+            # let the commands report it
+            lockable = None
         else:
-            # use a Binary object to wrap the output to avoid NULL and other
-            # non xmlrpc (or client xml parsers) friendly chars
-            out = Binary(data=sys.stdout.getvalue())
-            return_val = (exitval, out, sys.stderr.getvalue())
-            os.chdir(run_dir)
-        return return_val
-    except:
-        import traceback
-        traceback.print_exc(file=sys.__stderr__)
-        raise
+            lockable = tree
+            if lockable is None:
+                lockable = branch
+            lockable.lock_read()
+        try:
+            results = []
+            for argv in argv_lists:
+                timing.check_deadline()
+                try:
+                    result = run_bzr_xml(argv, workdir)
+                except Fault, f:
+                    result = f
+                if isinstance(result, Fault):
+                    result = {'faultCode': result.faultCode,
+                              'faultString': result.faultString}
+                results.append(result)
+            return results
+        finally:
+            if lockable is not None:
+                lockable.unlock()
+    finally:
+        _leave_request(state)
 
 
 def custom_commands_main(argv):
@@ -190,6 +1558,11 @@ def register_functions(server):
     """register functions exposed via xmlrpc."""
     server.register_function(run_bzr, 'run_bzr_command')
     server.register_function(run_bzr_xml, 'run_bzr')
+    server.register_function(run_bzr_batch, 'run_bzr_batch')
+    server.register_function(profile_bzr, 'profile_bzr')
+    import structured
+    for name in structured.methods:
+        server.register_function(getattr(structured, name), name)
     import search
     if search.is_available:
         server.register_function(search.search, 'search')
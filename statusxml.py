@@ -115,61 +115,24 @@ def show_tree_status_xml(wt, show_unchanged=None,
 
     wt.lock_read()
     try:
-        new_is_working_tree = True
-        if revision is None:
-            if wt.last_revision() != wt.branch.last_revision():
-                trace.warning("working tree is out of date, run 'bzr update'")
-            new = wt
-            old = new.basis_tree()
-        elif len(revision) > 0:
-            try:
-                rev_id = revision[0].in_history(wt.branch).rev_id
-                old = wt.branch.repository.revision_tree(rev_id)
-            except errors.NoSuchRevision, e:
-                raise errors.BzrCommandError(str(e))
-            if (len(revision) > 1) and (revision[1].spec is not None):
-                try:
-                    rev_id = revision[1].in_history(wt.branch).rev_id
-                    new = wt.branch.repository.revision_tree(rev_id)
-                    new_is_working_tree = False
-                except errors.NoSuchRevision, e:
-                    raise errors.BzrCommandError(str(e))
-            else:
-                new = wt
+        old, new, new_is_working_tree = get_status_trees(wt, revision)
         old.lock_read()
         new.lock_read()
         try:
-            nonexistents = None
-            try:
-                specific_files, nonexistents \
-                        = status._filter_nonexistent(specific_files, old, new)
-            except AttributeError:
-                try:
-                    diff._raise_if_nonexistent(specific_files, old, new)
-                except AttributeError:
-                    status._raise_if_nonexistent(specific_files, old, new)
+            specific_files, nonexistents = filter_nonexistent(specific_files,
+                                                              old, new)
             want_unversioned = not versioned
             to_file.write('<?xml version="1.0" encoding="%s"?>' % \
                     osutils.get_user_encoding())
             to_file.write('<status workingtree_root="%s">' % \
                         wt.id2abspath(wt.get_root_id()))
-            delta = new.changes_from(old, want_unchanged=show_unchanged,
-                                  specific_files=specific_files,
-                                  want_unversioned=want_unversioned)
-            # filter out unknown files. We may want a tree method for
-            # this
-            delta.unversioned = [unversioned for unversioned in
-                delta.unversioned if not new.is_ignored(unversioned[0])]
+            delta = get_status_delta(old, new, specific_files,
+                                     want_unversioned, show_unchanged)
             show_tree_xml(delta, to_file,
                        show_ids=show_ids,
                        show_unchanged=show_unchanged,
                        show_unversioned=want_unversioned)
-            # show the new conflicts only for now. XXX: get them from the
-            # delta.
-            conflicts = new.conflicts()
-            if specific_files is not None:
-                conflicts = conflicts.select_conflicts(new, specific_files,
-                        ignore_misses=True, recurse=True)[1]
+            conflicts = get_conflicts(new, specific_files)
             if len(conflicts) > 0:
                 to_file.write("<conflicts>")
                 for conflict in conflicts:
@@ -192,8 +155,98 @@ def show_tree_status_xml(wt, show_unchanged=None,
     finally:
         wt.unlock()
 
+
+def get_status_delta(old, new, specific_files, want_unversioned,
+                     show_unchanged=None):
+    """Return the changes between old and new, without the ignored files."""
+    delta = new.changes_from(old, want_unchanged=show_unchanged,
+                          specific_files=specific_files,
+                          want_unversioned=want_unversioned)
+    # filter out unknown files. We may want a tree method for
+    # this
+    delta.unversioned = [unversioned for unversioned in
+        delta.unversioned if not new.is_ignored(unversioned[0])]
+    return delta
+
+
+def get_conflicts(new, specific_files):
+    """Return the conflicts of the new tree (in specific_files)."""
+    # show the new conflicts only for now. XXX: get them from the
+    # delta.
+    conflicts = new.conflicts()
+    if specific_files is not None:
+        conflicts = conflicts.select_conflicts(new, specific_files,
+                ignore_misses=True, recurse=True)[1]
+    return conflicts
+
+
+def get_status_trees(wt, revision=None):
+    """Return the trees compared by status.
+
+    :param revision: None to compare the working tree with its basis, or a
+        list of one or two RevisionSpecs.
+    :return: (old, new, new_is_working_tree)
+    """
+    new_is_working_tree = True
+    if revision is None:
+        if wt.last_revision() != wt.branch.last_revision():
+            trace.warning("working tree is out of date, run 'bzr update'")
+        new = wt
+        old = new.basis_tree()
+    elif len(revision) > 0:
+        try:
+            rev_id = revision[0].in_history(wt.branch).rev_id
+            old = wt.branch.repository.revision_tree(rev_id)
+        except errors.NoSuchRevision, e:
+            raise errors.BzrCommandError(str(e))
+        if (len(revision) > 1) and (revision[1].spec is not None):
+            try:
+                rev_id = revision[1].in_history(wt.branch).rev_id
+                new = wt.branch.repository.revision_tree(rev_id)
+                new_is_working_tree = False
+            except errors.NoSuchRevision, e:
+                raise errors.BzrCommandError(str(e))
+        else:
+            new = wt
+    return old, new, new_is_working_tree
+
+
+def filter_nonexistent(specific_files, old, new):
+    """Return the specific_files that exist and the ones that don't.
+
+    With old versions of bzrlib this raises PathsDoNotExist instead.
+    """
+    nonexistents = None
+    try:
+        specific_files, nonexistents \
+                = status._filter_nonexistent(specific_files, old, new)
+    except AttributeError:
+        try:
+            diff._raise_if_nonexistent(specific_files, old, new)
+        except AttributeError:
+            status._raise_if_nonexistent(specific_files, old, new)
+    return specific_files, nonexistents
+
+
 def show_pending_merges(new, to_file):
     """Write out a display of pending merges in a working tree."""
+    if len(new.get_parent_ids()) < 2:
+        return
+    to_file.write('<pending_merges>')
+    for revision_id, rev in iter_pending_merges(new):
+        if rev is None:
+            show_ghost(to_file, revision_id)
+        else:
+            to_file.write(logxml.line_log(rev))
+    to_file.write('</pending_merges>')
+
+
+def iter_pending_merges(new):
+    """Iterate over the pending merges of a working tree.
+
+    Yields (revision_id, revision) for the merged revisions and the
+    revisions they bring in, revision is None for ghosts.
+    """
     parents = new.get_parent_ids()
     if len(parents) < 2:
         return
@@ -201,7 +254,6 @@ def show_pending_merges(new, to_file):
     pending = parents[1:]
     branch = new.branch
     last_revision = parents[0]
-    to_file.write('<pending_merges>')
     # TODO: this could be improved using merge_sorted - we'd get the same
     # output rather than one level of indent.
     graph = branch.repository.get_graph()
@@ -211,12 +263,12 @@ def show_pending_merges(new, to_file):
             rev = branch.repository.get_revisions([merge])[0]
         except errors.NoSuchRevision:
             # If we are missing a revision, just print out the revision id
-            show_ghost(to_file, merge)
+            yield merge, None
             other_revisions.append(merge)
             continue
 
         # Log the merge, as it gets a slightly different formatting
-        to_file.write(logxml.line_log(rev))
+        yield merge, rev
         # Find all of the revisions in the merge source, which are not in the
         # last committed revision.
         merge_extra = graph.find_unique_ancestors(merge, other_revisions)
@@ -247,12 +299,7 @@ def show_pending_merges(new, to_file):
             raise AssertionError('Somehow we misunderstood how'
                 ' iter_topo_order works %s != %s' % (first, merge))
         for num, sub_merge, depth, eom in rev_id_iterator:
-            rev = revisions[sub_merge]
-            if rev is None:
-                show_ghost(to_file, sub_merge)
-                continue
-            to_file.write(logxml.line_log(revisions[sub_merge]))
-    to_file.write('</pending_merges>')
+            yield sub_merge, revisions[sub_merge]
 
 
 def show_ghost(to_file, merge):
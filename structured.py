@@ -0,0 +1,505 @@
+# -*- encoding: utf-8 -*-
+# Copyright (C) 2009 Guillermo Gonzalez
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+"""xmlrpc methods that return structs and arrays instead of xml documents.
+
+They return the same information as the xml commands, but the client gets
+it already decoded by its xmlrpc library, without a base64 blob to decode
+and a xml document to parse.
+
+All the methods take the workdir of the request as the first argument.
+Optional arguments can be omitted, or given as an empty value ('', [],
+False) by clients that must send them all. The results never contain None,
+a missing value is a missing key.
+"""
+
+import re
+
+from bzrlib import log as _mod_log
+from bzrlib.lazy_import import lazy_import
+lazy_import(globals(), """
+from StringIO import StringIO
+
+from bzrlib import (
+    builtins,
+    errors,
+    missing as _mod_missing,
+    osutils,
+    urlutils,
+    workingtree,
+    )
+from bzrlib.branch import Branch
+from bzrlib.bzrdir import BzrDir
+from bzrlib.option import _parse_revision_str
+from bzrlib.xml_serializer import elementtree
+
+from bzrlib.plugins.xmloutput import (
+    annotatexml,
+    infoxml,
+    logxml,
+    lsxml,
+    statusxml,
+    )
+""")
+try:
+    from bzrlib.controldir import ControlDir
+except ImportError:
+    # bzr < 2.2
+    from bzrlib.bzrdir import BzrDir as ControlDir
+
+from service import redirect_output, run_in_workdir
+
+
+# the methods registered by the service, under these names
+methods = ['status', 'log', 'ls', 'annotate', 'info', 'missing']
+
+# the characters that can't be in a xml 1.0 document
+_invalid_xml_chars = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+def _xml_text(text):
+    """Return text (file contents, commit messages...) with the characters
+    that xmlrpclib can't send replaced by U+FFFD.
+    """
+    return _invalid_xml_chars.sub(u'\ufffd', osutils.safe_unicode(text))
+
+
+@redirect_output
+def status(workdir, file_list=None, revision=None, versioned=False,
+           show_ids=False):
+    """Return the status of the working tree as a struct.
+
+    The struct has the workingtree_root and (if not empty) the lists added,
+    removed, renamed, kind_changed, modified, unknown, conflicts,
+    nonexistents and pending_merges.
+    """
+    return run_in_workdir(workdir, _status, file_list or None,
+                          revision, versioned, show_ids)
+
+
+def _status(file_list, revision, versioned, show_ids):
+    revision = _get_revision(revision)
+    wt, file_list = workingtree.WorkingTree.open_containing_paths(file_list)
+    wt.lock_read()
+    try:
+        old, new, new_is_working_tree = statusxml.get_status_trees(wt,
+                                                                   revision)
+        old.lock_read()
+        new.lock_read()
+        try:
+            specific_files, nonexistents = statusxml.filter_nonexistent(
+                file_list, old, new)
+            want_unversioned = not versioned
+            result = {'workingtree_root': wt.id2abspath(wt.get_root_id())}
+            delta = statusxml.get_status_delta(old, new, specific_files,
+                                               want_unversioned)
+            result.update(get_delta_dict(delta, show_ids=show_ids,
+                                         show_unversioned=want_unversioned))
+            conflicts = statusxml.get_conflicts(new, specific_files)
+            if len(conflicts) > 0:
+                result['conflicts'] = [{'type': conflict.typestring,
+                                        'path': conflict.path}
+                                       for conflict in conflicts]
+            if nonexistents:
+                result['nonexistents'] = list(nonexistents)
+            if new_is_working_tree:
+                pending_merges = []
+                for revision_id, rev in statusxml.iter_pending_merges(new):
+                    if rev is None:
+                        pending_merges.append({'revisionid': revision_id,
+                                               'ghost': True})
+                    else:
+                        pending_merges.append(get_line_log_dict(rev))
+                if pending_merges:
+                    result['pending_merges'] = pending_merges
+            return result
+        finally:
+            old.unlock()
+            new.unlock()
+    finally:
+        wt.unlock()
+
+
+@redirect_output
+def log(workdir, location=None, revision=None, limit=0, verbose=False,
+        show_ids=False, forward=False):
+    """Return the log of a branch (or of a file in it) as a list of
+    revision structs.
+
+    The merged revisions of a revision are in its 'merges' list. With
+    verbose each revision has the files it changed in 'affected_files'.
+    """
+    return run_in_workdir(workdir, _log, location or u'.',
+                          revision, limit or None, verbose,
+                          show_ids, forward)
+
+
+def _log(location, revision, limit, verbose, show_ids, forward):
+    revision = _get_revision(revision)
+    tree, branch, relpath = ControlDir.open_containing_tree_or_branch(
+        location)
+    if tree is not None:
+        lockable = tree
+    else:
+        lockable = branch
+    lockable.lock_read()
+    try:
+        file_ids = None
+        if relpath:
+            if tree is not None:
+                file_id = tree.path2id(relpath)
+            else:
+                file_id = branch.basis_tree().path2id(relpath)
+            if file_id is None:
+                raise errors.BzrCommandError(
+                    "Path unknown at end or start of revision range: %s" %
+                    relpath)
+            file_ids = [file_id]
+        rev1, rev2 = builtins._get_revision_range(revision, branch, 'log')
+        lf = DictLogFormatter(to_file=None, show_ids=show_ids)
+        if verbose:
+            delta_type = 'full'
+        else:
+            delta_type = None
+        if forward:
+            direction = 'forward'
+        else:
+            direction = 'reverse'
+        request = _mod_log.make_log_request_dict(direction=direction,
+            specific_fileids=file_ids, start_revision=rev1,
+            end_revision=rev2, limit=limit, levels=lf.get_levels(),
+            generate_tags=True, delta_type=delta_type)
+        _mod_log.Logger(branch, request).show(lf)
+        return lf.revisions
+    finally:
+        lockable.unlock()
+
+
+@redirect_output
+def ls(workdir, path=None, revision=None, recursive=True, from_root=False,
+       unknown=False, versioned=False, ignored=False, kind=None):
+    """Return the files of a tree as a list of structs with the keys path,
+    kind, status_kind and (if versioned) id and (if ignored) pattern.
+    """
+    return run_in_workdir(workdir, _ls, path or None,
+                          revision, recursive, from_root,
+                          unknown, versioned, ignored, kind or None)
+
+
+def _ls(path, revision, recursive, from_root, unknown, versioned, ignored,
+        kind):
+    revision = _get_revision(revision)
+    tree, relpath, prefix = lsxml.open_ls_tree(revision=revision,
+        from_root=from_root, kind=kind, path=path)
+    long_status_kind = {'I':'ignored', '?':'unknown', 'V':'versioned'}
+    result = []
+    tree.lock_read()
+    try:
+        for fp, fc, fkind, fid, pattern in lsxml.iter_ls(tree, relpath,
+                prefix, non_recursive=not recursive, unknown=unknown,
+                versioned=versioned, ignored=ignored, kind=kind):
+            item = {'path': fp, 'kind': fkind,
+                    'status_kind': long_status_kind[fc]}
+            if fid is not None:
+                item['id'] = fid
+            if pattern is not None:
+                item['pattern'] = pattern
+            result.append(item)
+    finally:
+        tree.unlock()
+    return result
+
+
+@redirect_output
+def annotate(workdir, filename, revision=None, show_ids=False):
+    """Return the annotated lines of a file.
+
+    The result is a struct with the file, the workingtree_root (if there is
+    a working tree) and the list of lines, each one with the revno, author,
+    date, text and (with show_ids) revisionid.
+    """
+    return run_in_workdir(workdir, _annotate, filename,
+                          revision, show_ids)
+
+
+def _annotate(filename, revision, show_ids):
+    revision = _get_revision(revision)
+    wt, branch, relpath = ControlDir.open_containing_tree_or_branch(filename)
+    if wt is not None:
+        lockable = wt
+    else:
+        lockable = branch
+    lockable.lock_read()
+    try:
+        file_id, file_revision = annotatexml.get_annotate_target(wt, branch,
+            relpath, filename, revision)
+        result = {'file': relpath}
+        if wt is not None:
+            result['workingtree_root'] = wt.id2abspath(wt.get_root_id())
+        lines = []
+        previous = None
+        for (revno_str, author, date_str, line_rev_id, text,
+             origin) in annotatexml.iter_annotations(branch, file_revision,
+                                                      file_id):
+            if revno_str or author or date_str or previous is None:
+                previous = (revno_str, author, date_str)
+            line = {'revno': previous[0], 'author': _xml_text(previous[1]),
+                    'date': previous[2],
+                    'text': _xml_text(text.decode('utf-8', 'replace'))}
+            if show_ids:
+                line['revisionid'] = origin
+            lines.append(line)
+        result['lines'] = lines
+        return result
+    finally:
+        lockable.unlock()
+
+
+@redirect_output
+def info(workdir, location=None, verbose=False):
+    """Return the xmlinfo of a tree, branch or repository as a struct.
+
+    The struct has the same structure as the xml document, lists are used
+    for the repeated elements.
+    """
+    return run_in_workdir(workdir, _info, location or None, verbose)
+
+
+def _info(location, verbose):
+    if location is not None:
+        location = urlutils.normalize_url(location)
+    if verbose:
+        noise_level = 2
+    else:
+        noise_level = 0
+    # the document is small, building it and converting it is simpler than
+    # duplicating infoxml
+    outfile = StringIO()
+    infoxml.show_bzrdir_info_xml(BzrDir.open_containing(location)[0],
+                                 verbose=noise_level, outfile=outfile)
+    document = outfile.getvalue()
+    if not document:
+        return {}
+    if isinstance(document, unicode):
+        document = document.encode('utf-8')
+    return _element_to_value(elementtree.fromstring(document))
+
+
+def _element_to_value(element):
+    """Convert a xml element to a string, a dict or a list.
+
+    Elements with children become a dict, children with the same tag a list
+    (as the plural elements like formats, that contain many format).
+    """
+    children = list(element)
+    if not children:
+        return element.text or ''
+    if element.tag == children[0].tag + 's' and \
+            len(set([child.tag for child in children])) == 1:
+        return [_element_to_value(child) for child in children]
+    result = {}
+    for child in children:
+        value = _element_to_value(child)
+        if child.tag in result:
+            if not isinstance(result[child.tag], list):
+                result[child.tag] = [result[child.tag]]
+            result[child.tag].append(value)
+        else:
+            result[child.tag] = value
+    return result
+
+
+@redirect_output
+def missing(workdir, other_branch=None, reverse=False, mine_only=False,
+            theirs_only=False, show_ids=False, verbose=False):
+    """Return the revisions missing between the branch and other_branch
+    (the parent by default).
+
+    The struct has the last_location and (if not empty) the lists of
+    revisions extra_revisions and missing_revisions. Unlike xmlmissing this
+    never sets the parent of the branch.
+    """
+    return run_in_workdir(workdir, _missing, other_branch or None, reverse,
+                          mine_only, theirs_only, show_ids, verbose)
+
+
+def _missing(other_branch, reverse, mine_only, theirs_only, show_ids,
+             verbose):
+    local_branch = Branch.open_containing(u".")[0]
+    if other_branch is None:
+        other_branch = local_branch.get_parent()
+        if other_branch is None:
+            raise errors.BzrCommandError("No peer location known"
+                                         " or specified.")
+    remote_branch = Branch.open(other_branch)
+    if remote_branch.base == local_branch.base:
+        remote_branch = local_branch
+    local_branch.lock_read()
+    try:
+        remote_branch.lock_read()
+        try:
+            local_extra, remote_extra = _mod_missing.find_unmerged(
+                local_branch, remote_branch)
+            if not reverse:
+                local_extra.reverse()
+                remote_extra.reverse()
+            result = {'last_location': urlutils.unescape_for_display(
+                other_branch, 'utf-8')}
+            if local_extra and not theirs_only:
+                result['extra_revisions'] = _get_revisions(local_extra,
+                    local_branch.repository, show_ids, verbose)
+            if remote_extra and not mine_only:
+                result['missing_revisions'] = _get_revisions(remote_extra,
+                    remote_branch.repository, show_ids, verbose)
+            return result
+        finally:
+            remote_branch.unlock()
+    finally:
+        local_branch.unlock()
+
+
+def _get_revisions(revisions, repository, show_ids, verbose):
+    lf = DictLogFormatter(to_file=None, show_ids=show_ids)
+    for revision in _mod_missing.iter_log_revisions(revisions, repository,
+                                                    verbose):
+        lf.log_revision(revision)
+    return lf.revisions
+
+
+def _get_revision(revision):
+    """Parse a revision argument ('-1', '1..3') to a list of RevisionSpecs"""
+    if not revision:
+        return None
+    return _parse_revision_str(revision)
+
+
+class DictLogFormatter(_mod_log.LogFormatter):
+    """A log formatter that builds a list of revision structs.
+
+    Merged revisions are added to the 'merges' list of the revision that
+    merged them, as the <merge> elements of the xml log.
+    """
+
+    supports_merge_revisions = True
+    supports_delta = True
+    supports_tags = True
+
+    def __init__(self, *args, **kwargs):
+        super(DictLogFormatter, self).__init__(*args, **kwargs)
+        self.revisions = []
+        # the last revision logged at each merge depth
+        self._parents = []
+
+    def log_revision(self, revision):
+        depth = min(revision.merge_depth, len(self._parents))
+        del self._parents[depth:]
+        entry = get_revision_dict(revision, show_ids=self.show_ids,
+                                  show_timezone=self.show_timezone)
+        if depth == 0:
+            self.revisions.append(entry)
+        else:
+            self._parents[depth - 1].setdefault('merges', []).append(entry)
+        self._parents.append(entry)
+
+
+def get_revision_dict(revision, show_ids=False, show_timezone='original'):
+    """Return the struct of a log.LogRevision."""
+    rev = revision.rev
+    result = {}
+    if revision.revno is not None:
+        result['revno'] = revision.revno
+    if revision.tags:
+        result['tags'] = list(revision.tags)
+    if show_ids:
+        result['revisionid'] = rev.revision_id
+        result['parents'] = list(rev.parent_ids)
+    result['committer'] = _xml_text(rev.committer)
+    branch_nick = rev.properties.get('branch-nick')
+    if branch_nick is not None:
+        result['branch_nick'] = _xml_text(branch_nick)
+    result['timestamp'] = osutils.format_date(rev.timestamp,
+                                              rev.timezone or 0,
+                                              show_timezone)
+    if rev.message:
+        result['message'] = _xml_text(logxml._format_message(rev.message))
+    else:
+        result['message'] = '(no message)'
+    if revision.delta is not None:
+        result['affected_files'] = get_delta_dict(revision.delta,
+                                                  show_ids=show_ids)
+    return result
+
+
+def get_line_log_dict(rev):
+    """Return the struct of a pending merge (as xml_line_log)."""
+    result = {'revisionid': rev.revision_id,
+              'committer': _xml_text(rev.committer),
+              'timestamp': osutils.format_date(rev.timestamp,
+                                               rev.timezone or 0)}
+    if rev.message:
+        result['message'] = _xml_text(logxml._format_message(rev.message))
+    return result
+
+
+def get_delta_dict(delta, show_ids=False, show_unversioned=False):
+    """Return the struct of a TreeDelta, as show_tree_xml shows it."""
+    def get_item(path, fid, kind, **kwargs):
+        item = {'path': path, 'kind': kind}
+        if show_ids and fid:
+            item['id'] = fid
+        item.update(kwargs)
+        return item
+
+    def get_list(files):
+        result = []
+        for entry in files:
+            path, fid, kind = entry[:3]
+            item = get_item(path, fid, kind)
+            if len(entry) == 5 and entry[4]:
+                item['meta_modified'] = True
+            result.append(item)
+        return result
+
+    result = {}
+    if delta.removed:
+        result['removed'] = get_list(delta.removed)
+    if delta.added:
+        result['added'] = get_list(delta.added)
+    extra_modified = []
+    if delta.renamed:
+        renamed = []
+        for (oldpath, newpath, fid, kind,
+             text_modified, meta_modified) in delta.renamed:
+            if text_modified or meta_modified:
+                extra_modified.append((newpath, fid, kind,
+                                       text_modified, meta_modified))
+            item = get_item(newpath, fid, kind, oldpath=oldpath)
+            if meta_modified:
+                item['meta_modified'] = True
+            renamed.append(item)
+        result['renamed'] = renamed
+    if delta.kind_changed:
+        result['kind_changed'] = [get_item(path, fid, new_kind,
+                                           oldkind=old_kind)
+                                  for (path, fid, old_kind, new_kind)
+                                  in delta.kind_changed]
+    if delta.modified or extra_modified:
+        result['modified'] = get_list(delta.modified) + \
+            get_list(extra_modified)
+    if show_unversioned and delta.unversioned:
+        result['unknown'] = get_list(delta.unversioned)
+    return result
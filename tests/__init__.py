@@ -32,6 +32,14 @@ def load_tests(basic_tests, module, loader):
         'test_annotate_xml',
         'test_info_xml',
         'test_service',
+        'test_cache',
+        'test_structured',
+        'test_jobs',
+        'test_metrics',
+        'test_timing',
+        'test_admission',
+        'test_client',
+        'test_asyncclient',
         ]
     basic_tests.addTest(loader.loadTestsFromModuleNames(
             ["%s.%s" % (__name__, tmn) for tmn in testmod_names]))
@@ -0,0 +1,101 @@
+# -*- encoding: utf-8 -*-
+
+"""Tests for the admission control of the xmlrpc service."""
+
+import threading
+import time
+
+from bzrlib import tests
+from bzrlib.plugins.xmloutput import admission
+
+
+class TestGetPriority(tests.TestCase):
+
+    def tearDown(self):
+        admission.set_priority_hint(None)
+        tests.TestCase.tearDown(self)
+
+    def test_methods(self):
+        self.assertEquals(admission.HIGH, admission.get_priority('hello', ()))
+        self.assertEquals(admission.LOW,
+                          admission.get_priority('annotate', ('.', 'a')))
+        self.assertEquals(admission.NORMAL,
+                          admission.get_priority('status', ('.',)))
+
+    def test_commands(self):
+        self.assertEquals(admission.LOW, admission.get_priority('run_bzr',
+            (['bzr', 'xmllog', '-v'], '.')))
+        self.assertEquals(admission.NORMAL, admission.get_priority('run_bzr',
+            (['bzr', 'xmlstatus'], '.')))
+
+    def test_hint(self):
+        admission.set_priority_hint('low')
+        self.assertEquals(admission.LOW, admission.get_priority('hello', ()))
+        admission.set_priority_hint('unknown')
+        self.assertEquals(admission.HIGH, admission.get_priority('hello', ()))
+
+
+class TestAdmission(tests.TestCase):
+
+    def setUp(self):
+        tests.TestCase.setUp(self)
+        self.admission = admission.Admission(max_running=1, max_queued=4)
+        self.release = threading.Event()
+        self.calls = []
+        self.threads = []
+        self.start_call(admission.NORMAL, 'first')
+        self.wait_for(lambda: self.calls == ['first'])
+
+    def tearDown(self):
+        self.release.set()
+        for thread in self.threads:
+            thread.join()
+        tests.TestCase.tearDown(self)
+
+    def wait_for(self, condition):
+        for i in range(100):
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail('timed out')
+
+    def call(self, name):
+        self.calls.append(name)
+        self.release.wait()
+
+    def start_call(self, priority, name):
+        thread = threading.Thread(target=self.admission.call,
+                                  args=(priority, self.call, name))
+        thread.start()
+        self.threads.append(thread)
+
+    def test_priority_order(self):
+        self.start_call(admission.LOW, 'low')
+        self.wait_for(lambda: len(self.admission._waiting) == 1)
+        self.start_call(admission.NORMAL, 'normal')
+        self.wait_for(lambda: len(self.admission._waiting) == 2)
+        self.release.set()
+        for thread in self.threads:
+            thread.join()
+        self.assertEquals(['first', 'normal', 'low'], self.calls)
+
+    def test_low_priority_rejected_first(self):
+        self.start_call(admission.LOW, 'low')
+        self.start_call(admission.LOW, 'low')
+        self.wait_for(lambda: len(self.admission._waiting) == 2)
+        e = self.assertRaises(admission.ServiceOverloaded,
+                              self.admission.call, admission.LOW, self.call,
+                              'rejected')
+        self.assertTrue(e.retry_after >= 1)
+        self.start_call(admission.NORMAL, 'normal')
+        self.wait_for(lambda: len(self.admission._waiting) == 3)
+        self.assertEquals(1, self.admission.rejected)
+
+    def test_high_priority_doesnt_wait(self):
+        self.assertEquals('done', self.admission.call(admission.HIGH,
+                                                      lambda: 'done'))
+
+    def test_disabled(self):
+        self.admission.max_running = 0
+        self.assertEquals('done', self.admission.call(admission.NORMAL,
+                                                      lambda: 'done'))
@@ -0,0 +1,104 @@
+# -*- encoding: utf-8 -*-
+
+"""Tests for the asynchronous client of the xmlrpc service."""
+
+import asyncore
+import threading
+import time
+from xmlrpclib import Fault
+
+from bzrlib import (
+    commands,
+    tests,
+    )
+from bzrlib.plugins.xmloutput import asyncclient, client
+from bzrlib.plugins.xmloutput.service import BzrXMLRPCServer
+
+
+class TestAsyncClient(tests.TestCase):
+
+    threads = 4
+
+    def setUp(self):
+        tests.TestCase.setUp(self)
+        commands.install_bzr_command_hooks()
+        self.server = BzrXMLRPCServer(('localhost', 0), threads=self.threads)
+        self.release = threading.Event()
+        def slow():
+            self.release.wait()
+            return 'done'
+        self.server.register_function(slow, 'slow')
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        url = 'http://%s:%s' % self.server.socket.getsockname()
+        def stop():
+            self.release.set()
+            client.get_server(url).quit()
+            thread.join()
+        self.addCleanup(stop)
+        # resolve the lazy imports first, the tests don't allow threads to
+        # use them while they are replaced
+        client.get_server(url).hello()
+        self.client = asyncclient.AsyncClient(url, max_connections=2,
+                                              pipeline=4, map={})
+        self.addCleanup(self.client.close)
+
+    def test_call(self):
+        call = self.client.call('hello')
+        self.assertFalse(call.done)
+        self.client.loop([call])
+        self.assertEquals('world!', call.result())
+
+    def test_callback(self):
+        results = []
+        self.client.call('hello').add_callback(
+            lambda call: results.append(call.result()))
+        self.client.loop()
+        self.assertEquals(['world!'], results)
+
+    def test_many_calls(self):
+        calls = [self.client.call('hello') for i in range(40)]
+        self.assertTrue(len(self.client._connections) <= 2)
+        self.client.loop()
+        self.assertEquals(['world!'] * 40, [call.result() for call in calls])
+        self.assertEquals(0, self.client.pending())
+
+    def test_fault(self):
+        call = self.client.call('run_bzr', (['bzr', 'no-such-command'], '.'))
+        self.client.loop()
+        e = self.assertRaises(Fault, call.result)
+        self.assertEquals(42, e.faultCode)
+
+    def test_timeout(self):
+        slow = self.client.call('slow', timeout=0.2)
+        self.client.loop([slow])
+        self.assertRaises(asyncclient.CallTimeout, slow.result)
+        self.release.set()
+        hello = self.client.call('hello')
+        self.client.loop([hello])
+        self.assertEquals('world!', hello.result())
+
+    def test_run_bzr(self):
+        call = self.client.run_bzr(['bzr', 'rocks'], '.')
+        self.client.loop()
+        exit_status, out, err = call.result()
+        self.assertEquals(0, exit_status)
+        self.assertEquals('It sure does!\n', out.data)
+
+    def test_stream(self):
+        chunks = []
+        call = self.client.stream(['bzr', 'rocks'], '.', chunks.append)
+        hello = self.client.call('hello')
+        self.client.loop()
+        self.assertEquals((0, ''), call.result())
+        self.assertEquals('It sure does!\n', ''.join(chunks))
+        self.assertEquals('world!', hello.result())
+
+    def test_connection_refused(self):
+        self.client.address = ('localhost', 1)
+        self.client.close()
+        call = self.client.call('hello')
+        self.client.loop([call], timeout=5)
+        self.assertTrue(call.done)
+        self.assertRaises(Exception, call.result)
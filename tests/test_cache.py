@@ -0,0 +1,166 @@
+# -*- encoding: utf-8 -*-
+
+"""Tests for the caches used by the xmlrpc service."""
+
+import threading
+
+from bzrlib import (
+    branch,
+    commands,
+    osutils,
+    tests,
+    workingtree,
+    )
+from bzrlib.plugins.xmloutput import (
+    cache,
+    service,
+    )
+
+
+class TestObjectCache(tests.TestCaseWithTransport):
+
+    def setUp(self):
+        tests.TestCaseWithTransport.setUp(self)
+        self.tree = self.make_branch_and_tree('tree')
+        self.cache = cache.ObjectCache()
+
+    def open_tree(self):
+        return self.cache.get(('tree', 'tree'),
+                              workingtree.WorkingTree.open_containing, 'tree')
+
+    def test_not_started(self):
+        first = self.open_tree()
+        second = self.open_tree()
+        self.assertIsNot(first[0], second[0])
+        self.assertEquals(0, self.cache.hits)
+
+    def test_reuse_after_release(self):
+        self.cache.start()
+        first = self.open_tree()
+        self.assertIs(first, self.open_tree())
+        self.cache.release()
+        self.cache.start()
+        self.assertIs(first, self.open_tree())
+        self.cache.release()
+        self.assertEquals(1, self.cache.misses)
+        self.assertEquals(1, self.cache.hits)
+
+    def test_branch_tip_changed(self):
+        self.cache.start()
+        first = self.open_tree()
+        self.cache.release()
+        self.tree.commit('change the tip')
+        self.cache.start()
+        second = self.open_tree()
+        self.cache.release()
+        self.assertIsNot(first[0], second[0])
+
+    def test_in_use_by_other_thread(self):
+        self.cache.start()
+        first = self.open_tree()
+        results = []
+        def open_tree():
+            self.cache.start()
+            try:
+                results.append(self.open_tree())
+            finally:
+                self.cache.release()
+        thread = threading.Thread(target=open_tree)
+        thread.start()
+        thread.join()
+        self.cache.release()
+        self.assertIsNot(first[0], results[0][0])
+
+    def test_locked_objects_are_not_cached(self):
+        self.cache.start()
+        first = self.open_tree()
+        first[0].lock_read()
+        self.cache.release()
+        first[0].unlock()
+        self.cache.start()
+        self.assertIsNot(first, self.open_tree())
+        self.cache.release()
+
+    def test_held_objects_are_not_cached(self):
+        self.cache.start()
+        result = (self.tree, '')
+        self.cache.hold(('tree', 'tree'), result)
+        self.assertIs(result, self.open_tree())
+        self.cache.release()
+        self.cache.start()
+        self.assertIsNot(result, self.open_tree())
+        self.cache.release()
+        self.assertEquals(1, self.cache.misses)
+
+
+class TestInstallObjectCache(tests.TestCaseWithTransport):
+
+    def setUp(self):
+        tests.TestCaseWithTransport.setUp(self)
+        self.object_cache = cache.ObjectCache()
+        cache.install_object_cache(self.object_cache)
+        self.addCleanup(cache.install_object_cache, None)
+
+    def test_open_containing(self):
+        self.make_branch_and_tree('tree')
+        self.assertTrue(cache.use_cached_objects())
+        tree, relpath = workingtree.WorkingTree.open_containing('tree')
+        self.assertIs(tree,
+                      workingtree.WorkingTree.open_containing('tree')[0])
+        a_branch = branch.Branch.open_containing('tree')[0]
+        self.assertIs(a_branch, branch.Branch.open_containing('tree')[0])
+        cache.release_objects()
+        self.assertEquals(2, self.object_cache.misses)
+
+
+class TestResponseCache(tests.TestCaseWithTransport):
+
+    def setUp(self):
+        tests.TestCaseWithTransport.setUp(self)
+        commands.install_bzr_command_hooks()
+        self.response_cache = cache.ResponseCache(1024 * 1024)
+        cache.install_response_cache(self.response_cache)
+        self.addCleanup(cache.install_response_cache, None)
+        self.tree = self.make_branch_and_tree('tree')
+        self.tree.commit('first')
+
+    def run_bzr_xml(self, *argv):
+        return service.run_bzr_xml(['bzr'] + list(argv),
+                                   osutils.abspath('tree'))
+
+    def test_cached_response(self):
+        exitval, out, err = self.run_bzr_xml('xmllog')
+        self.assertEquals((exitval, out, err), self.run_bzr_xml('xmllog'))
+        self.assertEquals(1, self.response_cache.hits)
+
+    def test_branch_tip_changed(self):
+        exitval, out, err = self.run_bzr_xml('xmllog')
+        self.tree.commit('second')
+        exitval, out, err = self.run_bzr_xml('xmllog')
+        self.assertContainsRe(out.data, 'second')
+        self.assertEquals(0, self.response_cache.hits)
+        self.assertEquals(2, self.response_cache.misses)
+
+    def test_not_cacheable(self):
+        self.run_bzr_xml('xmlstatus')
+        self.run_bzr_xml('xmlls')
+        self.run_bzr_xml('xmlinfo', '-v')
+        self.assertEquals(0, self.response_cache.misses)
+        self.run_bzr_xml('xmlls', '-r', '-1')
+        self.run_bzr_xml('xmlinfo')
+        self.assertEquals(2, self.response_cache.misses)
+
+    def test_related_branches_changed(self):
+        exitval, out, err = self.run_bzr_xml('xmlinfo')
+        self.assertNotContainsRe(out.data, 'push_branch')
+        self.tree.branch.set_push_location(self.get_url('other'))
+        exitval, out, err = self.run_bzr_xml('xmlinfo')
+        self.assertContainsRe(out.data, 'push_branch')
+        self.assertEquals(0, self.response_cache.hits)
+
+    def test_arguments_are_part_of_the_key(self):
+        self.tree.commit('second')
+        exitval, out, err = self.run_bzr_xml('xmllog', '-r', '1')
+        self.assertNotContainsRe(out.data, 'second')
+        exitval, out, err = self.run_bzr_xml('xmllog')
+        self.assertContainsRe(out.data, 'second')
@@ -0,0 +1,216 @@
+# -*- encoding: utf-8 -*-
+
+"""Tests for the client of the xmlrpc service."""
+
+import codecs
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from cStringIO import StringIO
+from xmlrpclib import Fault
+
+from bzrlib import (
+    commands,
+    osutils,
+    tests,
+    )
+from bzrlib.plugins.xmloutput import client
+from bzrlib.plugins.xmloutput.service import BzrXMLRPCServer
+from bzrlib.plugins.xmloutput.tests import test_service
+
+
+def run_client(args, env=None):
+    """Run client.py in a new process, return exit status, out and err."""
+    process = subprocess.Popen([sys.executable, client.__file__] + args,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, env=env)
+    out, err = process.communicate()
+    return process.returncode, out, err
+
+
+class TestClient(tests.TestCase):
+
+    def test_no_bzrlib_import(self):
+        process = subprocess.Popen(
+            [sys.executable, '-c',
+             'import sys; sys.path.insert(0, sys.argv[1]); import client; '
+             'print [name for name in sys.modules '
+             'if name.startswith("bzrlib")]',
+             os.path.dirname(client.__file__)],
+            stdout=subprocess.PIPE)
+        out = process.communicate()[0]
+        self.assertEquals('[]\n', out)
+
+    def test_get_fault_message(self):
+        fault = Fault(42, '<?xml version="1.0" encoding="utf-8"?><error>'
+                      '<class>NotBranchError</class><dict></dict>'
+                      '<message>Not a branch: &lt;here&gt;</message></error>')
+        self.assertEquals('Not a branch: <here>',
+                          client.get_fault_message(fault))
+        self.assertEquals('oops', client.get_fault_message(Fault(1, 'oops')))
+
+    def test_write_output(self):
+        out = StringIO()
+        outf = codecs.getwriter('utf-8')(out)
+        # a character split between two chunks
+        client.write_output(['caf\xc3', '\xa9\n', '', 'ok\n'], outf,
+                            'utf-8')
+        self.assertEquals('caf\xc3\xa9\nok\n', out.getvalue())
+
+    def test_write_output_invalid(self):
+        out = StringIO()
+        outf = codecs.getwriter('utf-8')(out)
+        client.write_output(['bad\xff', 'end\xc3'], outf, 'utf-8')
+        self.assertEquals(u'bad\ufffdend\ufffd'.encode('utf-8'),
+                          out.getvalue())
+
+    def test_split_output(self):
+        self.assertEquals(['abc', 'def', 'g'],
+                          list(client.split_output('abcdefg', 3)))
+        self.assertEquals([], list(client.split_output('')))
+
+    def test_get_terminal_encoding(self):
+        # an encoding python knows
+        import codecs
+        codecs.lookup(client.get_terminal_encoding())
+
+
+class TestSpawn(tests.TestCase):
+
+    def setUp(self):
+        tests.TestCase.setUp(self)
+        # the test dir path can be too long for a unix socket
+        self.socket_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.socket_dir)
+        self.socket_path = os.path.join(self.socket_dir, 'bzr.sock')
+        # the spawned service must load this plugin
+        self.overrideEnv('BZR_PLUGINS_AT', 'xmloutput@%s'
+                         % os.path.dirname(os.path.dirname(__file__)))
+
+    def test_is_local(self):
+        self.assertTrue(client.is_local())
+        self.assertTrue(client.is_local('http://127.0.0.1:1234'))
+        self.assertTrue(client.is_local(socket_path=self.socket_path))
+        self.assertFalse(client.is_local('http://example.com:11111'))
+
+    def test_spawn_service(self):
+        self.assertFalse(client.is_running(socket_path=self.socket_path))
+        self.assertTrue(client.spawn_service(socket_path=self.socket_path))
+        server = client.get_server(socket_path=self.socket_path)
+        self.addCleanup(server.quit)
+        self.assertEquals('world!', server.hello())
+        # it's only started once
+        self.assertTrue(client.spawn_service(socket_path=self.socket_path))
+
+    def test_main_spawns_service(self):
+        exit_status, out, err = run_client(['--socket', self.socket_path,
+                                            'rocks'])
+        self.assertTrue(client.is_running(socket_path=self.socket_path))
+        client.get_server(socket_path=self.socket_path).quit()
+        self.assertEquals(0, exit_status)
+        self.assertEquals('It sure does!\n', out)
+
+    def test_spawn_fails(self):
+        self.overrideEnv('BZR_XMLRPC_BZR', '/nonexistent/bzr')
+        self.assertFalse(client.spawn_service(socket_path=self.socket_path))
+
+    def test_run_in_process(self):
+        env = dict(os.environ)
+        env['BZR_XMLRPC_BZR'] = '/nonexistent/bzr'
+        exit_status, out, err = run_client(['--socket', self.socket_path,
+                                            'rocks'], env=env)
+        self.assertEquals(0, exit_status)
+        self.assertEquals('It sure does!\n', out)
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_no_spawn(self):
+        exit_status, out, err = run_client(['--no-spawn', '--socket',
+                                            self.socket_path, 'rocks'])
+        self.assertNotEquals(0, exit_status)
+        self.assertFalse(os.path.exists(self.socket_path))
+
+
+class TestClientMain(test_service.TestXmlRpcServer):
+
+    threads = 2
+
+    def setUp(self):
+        test_service.TestXmlRpcServer.setUp(self)
+        commands.install_bzr_command_hooks()
+        self.url = 'http://%s:%s' % (self.host, self.port)
+
+    def test_run_command(self):
+        exit_status, out, err = run_client(['--url', self.url, 'rocks'])
+        self.assertEquals(0, exit_status)
+        self.assertEquals('It sure does!\n', out)
+        self.assertEquals('', err)
+
+    def test_url_from_environment(self):
+        env = dict(os.environ)
+        env['BZR_XMLRPC_URL'] = self.url
+        exit_status, out, err = run_client(['rocks'], env=env)
+        self.assertEquals(0, exit_status)
+        self.assertEquals('It sure does!\n', out)
+
+    def test_error(self):
+        exit_status, out, err = run_client(['--url=%s' % self.url,
+                                            'no-such-command'])
+        self.assertEquals(client.EXIT_ERROR, exit_status)
+        self.assertEquals('', out)
+        self.assertContainsRe(err, '^bzr: ERROR: .*no-such-command')
+
+
+class TestFanout(tests.TestCaseWithTransport):
+
+    def setUp(self):
+        tests.TestCaseWithTransport.setUp(self)
+        commands.install_bzr_command_hooks()
+        self.server = BzrXMLRPCServer(('localhost', 0), threads=4)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.url = 'http://%s:%s' % self.server.socket.getsockname()
+        def stop():
+            client.get_server(self.url).quit()
+            thread.join()
+        self.addCleanup(stop)
+        self.paths = ['one', 'two', 'three']
+        for path in self.paths:
+            self.make_branch_and_tree(path)
+            self.build_tree(['%s/%s_file' % (path, path)])
+        # resolve the lazy imports first, the tests don't allow threads to
+        # use them while they are replaced
+        client.get_server(self.url).run_bzr_command(
+            ['bzr', 'xmlstatus'], osutils.abspath('one'))
+
+    def test_fanout_bzr(self):
+        workdirs = [osutils.abspath(path) for path in self.paths]
+        results = dict(client.fanout_bzr(['bzr', 'xmlstatus'], workdirs,
+                                         url=self.url, jobs=2))
+        self.assertEquals(sorted(workdirs), sorted(results))
+        for path, workdir in zip(self.paths, workdirs):
+            exit_status, out, err = results[workdir]
+            self.assertEquals(0, exit_status)
+            self.assertContainsRe(out.data, '%s_file' % path)
+
+    def test_fanout_faults(self):
+        workdirs = [osutils.abspath(path) for path in self.paths]
+        results = list(client.fanout_bzr(['bzr', 'no-such-command'],
+                                         workdirs, url=self.url,
+                                         method='run_bzr'))
+        self.assertEquals(3, len(results))
+        for workdir, response in results:
+            self.assertIsInstance(response, Fault)
+
+    def test_main(self):
+        exit_status, out, err = run_client(['--url', self.url, '--fanout',
+                                            'one', 'two', '--', 'xmlstatus'])
+        self.assertEquals(0, exit_status)
+        self.assertEquals('', err)
+        self.assertContainsRe(out, '==> one <==\n<\\?xml')
+        self.assertContainsRe(out, '==> two <==\n<\\?xml')
+        self.assertContainsRe(out, 'two_file')
+        self.assertNotContainsRe(out, 'three')
@@ -426,7 +426,7 @@ class TestInfoXml(blackbox.ExternalBase):
 <repository>%s</repository>
 </format>
 <branch_stats>
-<missing_revisions>1<missing_revisions>
+<missing_revisions>1</missing_revisions>
 </branch_stats>
 <working_tree_stats>
 <unchanged>1</unchanged>
@@ -474,7 +474,7 @@ class TestInfoXml(blackbox.ExternalBase):
 <repository>%s</repository>
 </format>
 <branch_stats>
-<missing_revisions>1<missing_revisions>
+<missing_revisions>1</missing_revisions>
 </branch_stats>
 <working_tree_stats>
 <unchanged>1</unchanged>
@@ -734,7 +734,7 @@ class TestInfoXml(blackbox.ExternalBase):
 <repository>%s</repository>
 </format>
 <branch_stats>
-<missing_revisions>1<missing_revisions>
+<missing_revisions>1</missing_revisions>
 </branch_stats>
 <working_tree_stats>
 <unchanged>0</unchanged>
@@ -1313,7 +1313,7 @@ class TestInfoXml(blackbox.ExternalBase):
                     return 'unlocked'
             expected_lock_output = (
                 "\n<lock_status>\n"
-                "<working_tree>%s</<working_tree>\n"
+                "<working_tree>%s</working_tree>\n"
                 "<branch>%s</branch>\n"
                 "<repository>%s</repository>\n"
                 "</lock_status>" % (
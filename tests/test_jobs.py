@@ -0,0 +1,92 @@
+# -*- encoding: utf-8 -*-
+
+"""Tests for the jobs run in the background by the xmlrpc service."""
+
+import time
+from xmlrpclib import Fault
+
+from bzrlib import (
+    commands,
+    tests,
+    )
+from bzrlib.plugins.xmloutput import jobs
+
+
+class TestJobManager(tests.TestCaseWithTransport):
+
+    def setUp(self):
+        tests.TestCaseWithTransport.setUp(self)
+        commands.install_bzr_command_hooks()
+        self.manager = jobs.JobManager(threads=1)
+        self.addCleanup(self.manager.stop)
+
+    def wait_for_job(self, job_id):
+        for i in range(100):
+            status = self.manager.job_status(job_id)
+            if status['state'] not in (jobs.QUEUED, jobs.RUNNING):
+                return status
+            time.sleep(0.05)
+        self.fail('job %s did not finish' % job_id)
+
+    def test_finished_job(self):
+        job_id = self.manager.submit_job(['bzr', 'rocks'], '.')
+        status = self.wait_for_job(job_id)
+        self.assertEquals({'id': job_id, 'state': jobs.FINISHED,
+                           'output_size': 14, 'exit_status': 0}, status)
+        result = self.manager.job_result(job_id)
+        self.assertEquals('It sure does!\n', result['output'].data)
+        self.assertEquals('', result['stderr'])
+
+    def test_partial_result(self):
+        job_id = self.manager.submit_job(['bzr', 'rocks'], '.')
+        self.wait_for_job(job_id)
+        result = self.manager.job_result(job_id, 3, 4)
+        self.assertEquals('sure', result['output'].data)
+        self.assertEquals('does!\n',
+                          self.manager.job_result(job_id, 8)['output'].data)
+
+    def test_failed_job(self):
+        job_id = self.manager.submit_job(['bzr', 'no-such-command'], '.')
+        self.assertEquals(jobs.FAILED, self.wait_for_job(job_id)['state'])
+        e = self.assertRaises(Fault, self.manager.job_result, job_id)
+        self.assertEquals(42, e.faultCode)
+        self.assertContainsRe(e.faultString, 'unknown command')
+
+    def test_unknown_job(self):
+        e = self.assertRaises(Fault, self.manager.job_status, 'unknown')
+        self.assertEquals(42, e.faultCode)
+        self.assertContainsRe(e.faultString, 'UnknownJob')
+
+    def test_cancel_queued_job(self):
+        manager = jobs.JobManager(threads=0)
+        job_id = manager.submit_job(['bzr', 'rocks'], '.')
+        self.assertTrue(manager.cancel_job(job_id))
+        self.assertEquals(jobs.CANCELLED, manager.job_status(job_id)['state'])
+        self.assertFalse(manager.cancel_job(job_id))
+
+    def test_cancelled_job_stops_writing(self):
+        job = jobs.Job('1', ['bzr', 'rocks'], '.')
+        job.output.write('some output')
+        job.cancelled = True
+        self.assertRaises(jobs.JobCancelled, job.output.write, 'more')
+        self.assertEquals(11, job.output.size)
+
+    def test_finished_jobs_are_forgotten(self):
+        self.manager.max_finished = 1
+        first = self.manager.submit_job(['bzr', 'rocks'], '.')
+        self.wait_for_job(first)
+        second = self.manager.submit_job(['bzr', 'rocks'], '.')
+        self.wait_for_job(second)
+        self.assertRaises(Fault, self.manager.job_status, first)
+
+    def test_finished_output_is_bounded(self):
+        self.manager.max_output = 20
+        first = self.manager.submit_job(['bzr', 'rocks'], '.')
+        self.wait_for_job(first)
+        self.assertEquals(jobs.FINISHED,
+                          self.manager.job_status(first)['state'])
+        second = self.manager.submit_job(['bzr', 'rocks'], '.')
+        self.wait_for_job(second)
+        self.assertRaises(Fault, self.manager.job_status, first)
+        self.assertEquals('It sure does!\n',
+                          self.manager.job_result(second)['output'].data)
@@ -0,0 +1,86 @@
+# -*- encoding: utf-8 -*-
+
+"""Tests for the metrics of the xmlrpc service."""
+
+from xmlrpclib import Fault
+
+from bzrlib import (
+    commands,
+    errors,
+    tests,
+    )
+from bzrlib.plugins.xmloutput import (
+    cache,
+    metrics,
+    )
+from bzrlib.plugins.xmloutput.xml_errors import XMLError
+
+
+class TestMetrics(tests.TestCase):
+
+    def setUp(self):
+        tests.TestCase.setUp(self)
+        self.metrics = metrics.Metrics()
+
+    def test_requests(self):
+        hello = lambda: 'world!'
+        self.assertEquals('world!', self.metrics.call('hello', hello))
+        self.assertEquals('world!', self.metrics.call('hello', hello))
+        self.assertEquals({'hello': 2}, self.metrics.requests)
+        self.assertEquals(2, self.metrics.latency['hello'].count)
+        self.assertEquals(0, self.metrics.in_flight)
+        text = self.metrics.render()
+        self.assertContainsRe(text,
+                              '\nbzr_xmlrpc_requests_total{method="hello"} 2\n')
+        self.assertContainsRe(text,
+            '\nbzr_xmlrpc_request_duration_seconds_bucket'
+            '{method="hello",le="\\+Inf"} 2\n')
+        self.assertContainsRe(text,
+            '\nbzr_xmlrpc_request_duration_seconds_count{method="hello"} 2\n')
+        self.assertContainsRe(text, '\nbzr_xmlrpc_requests_in_flight 0\n')
+
+    def test_errors(self):
+        def fail():
+            raise Fault(42, str(XMLError(errors.NotBranchError('path'))))
+        def crash():
+            raise ValueError()
+        self.assertRaises(Fault, self.metrics.call, 'fail', fail)
+        self.assertRaises(ValueError, self.metrics.call, 'crash', crash)
+        self.assertEquals({'NotBranchError': 1, 'ValueError': 1},
+                          self.metrics.errors)
+        self.assertContainsRe(self.metrics.render(),
+            '\nbzr_xmlrpc_errors_total{class="NotBranchError"} 1\n')
+
+    def test_commands(self):
+        commands.install_bzr_command_hooks()
+        self.metrics.count_command(['bzr', 'st'])
+        self.metrics.count_command(['bzr', 'status'])
+        self.metrics.count_command(['bzr', 'no-such-command'])
+        self.assertEquals({'status': 2, 'unknown': 1}, self.metrics.commands)
+
+    def test_response_size_histogram(self):
+        self.metrics.response_size('xmlrpc', 100)
+        self.metrics.response_size('xmlrpc', 2000)
+        self.assertContainsRe(self.metrics.render(),
+            'bzr_xmlrpc_response_size_bytes_bucket'
+            '{endpoint="xmlrpc",le="256"} 1\n'
+            'bzr_xmlrpc_response_size_bytes_bucket'
+            '{endpoint="xmlrpc",le="1024"} 1\n'
+            'bzr_xmlrpc_response_size_bytes_bucket'
+            '{endpoint="xmlrpc",le="4096"} 2\n')
+
+    def test_cache_ratio(self):
+        object_cache = cache.ObjectCache()
+        object_cache.hits = 3
+        object_cache.misses = 1
+        text = self.metrics.render({'objects': object_cache})
+        self.assertContainsRe(text,
+            '\nbzr_xmlrpc_cache_hit_ratio{cache="objects"} 0.75\n')
+        self.assertContainsRe(text,
+            '\nbzr_xmlrpc_cache_misses_total{cache="objects"} 1\n')
+
+    def test_rss(self):
+        if metrics.get_rss() is None:
+            raise tests.TestNotApplicable('rss is not available')
+        self.assertContainsRe(self.metrics.render(),
+                              '\nprocess_resident_memory_bytes \\d+\n')
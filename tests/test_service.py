@@ -1,35 +1,83 @@
 # -*- encoding: utf-8 -*-
 
+import httplib
+import os
+import pstats
+import shutil
+import tempfile
 import xmlrpclib
 import threading
 
+from bzrlib.plugins.xmloutput.service import *
+# after the * import, so the lazy imports of service don't replace these.
+import errno
+import signal
+import socket
+import subprocess
+import sys
+import time
+from cStringIO import StringIO
 from bzrlib import (
+    branch,
+    commands,
+    osutils,
     tests,
+    trace,
     ui,
     )
-from bzrlib.plugins.xmloutput.service import *
+from bzrlib.plugins.xmloutput import cache, client, jsonrpc, service
 
 
 class TestXmlRpcServer(tests.TestCase):
 
+    threads = 0
+    workers = 0
+    idle_timeout = 15
+    max_connections = 64
+    gzip_threshold = 1400
+    request_timeout = 0
+    max_running = 0
+    max_queued = 16
+    max_requests = 0
+    drain_timeout = 30
+    job_threads = 2
+
     def setUp(self):
         tests.TestCase.setUp(self)
         self.host = 'localhost'
         self.port = 0
         self._start_server()
-        self.client = xmlrpclib.Server("http://%s:%s" % (self.host,
-                                                         str(self.port)))
+        self.client = self._make_client()
 
     def _start_server(self):
-        self.server =  BzrXMLRPCServer((self.host, self.port))
+        self.server =  BzrXMLRPCServer((self.host, self.port),
+                                       threads=self.threads,
+                                       workers=self.workers,
+                                       idle_timeout=self.idle_timeout,
+                                       max_connections=self.max_connections,
+                                       gzip_threshold=self.gzip_threshold,
+                                       request_timeout=self.request_timeout,
+                                       max_running=self.max_running,
+                                       max_queued=self.max_queued,
+                                       max_requests=self.max_requests,
+                                       drain_timeout=self.drain_timeout,
+                                       job_threads=self.job_threads)
+        self.register_functions()
         self.thread = threading.Thread(target=self.server.serve_forever)
         self.thread.setDaemon(True)
         self.thread.start()
         self.host, self.port = self.server.socket.getsockname()
 
+    def _make_client(self):
+        return xmlrpclib.Server("http://%s:%s" % (self.host, str(self.port)))
+
+    def register_functions(self):
+        """Register the functions of the test before the server starts."""
+
     def tearDown(self):
-        response = self.client.quit()
-        self.thread.join()
+        if self.thread.isAlive():
+            self.client.quit()
+            self.thread.join()
         tests.TestCase.tearDown(self)
 
     def test_hello(self):
@@ -52,3 +100,873 @@ class TestXmlRpcServer(tests.TestCase):
                 self.assertNotContainsRe(f.faultString, 'UnicodeEncodeError')
             else:
                 pass
+
+
+class TestThreadedXmlRpcServer(TestXmlRpcServer):
+
+    threads = 2
+
+    def test_concurrent_requests(self):
+        results = []
+        def call_hello():
+            client = xmlrpclib.Server("http://%s:%s" % (self.host,
+                                                         str(self.port)))
+            results.append(client.hello())
+        threads = [threading.Thread(target=call_hello) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(['world!'] * 4, results)
+
+
+class TestForkedXmlRpcServer(TestXmlRpcServer):
+
+    workers = 2
+
+    def setUp(self):
+        if getattr(os, 'fork', None) is None:
+            raise tests.TestNotApplicable('fork is not available')
+        TestXmlRpcServer.setUp(self)
+
+    def test_quit_stops_all_workers(self):
+        for i in range(4):
+            self.assertEquals('world!', self.client.hello())
+        self.client.quit()
+        self.thread.join()
+        self.assertEquals(set(), self.server._worker_pids)
+
+    def test_quit_drain_stops_all_workers(self):
+        self.assertEquals('world!', self.client.hello())
+        self.client.quit(True)
+        self.thread.join()
+        self.assertEquals(set(), self.server._worker_pids)
+
+    def test_no_jobs(self):
+        self.assertFalse('submit_job' in self.client.list_methods())
+
+
+def _process_stat(pid):
+    """Return (state, ppid) of the process pid, or None if it's gone."""
+    try:
+        f = open('/proc/%d/stat' % pid)
+        try:
+            stat = f.read()
+        finally:
+            f.close()
+    except IOError:
+        return None
+    fields = stat[stat.rindex(')') + 2:].split()
+    return fields[0], int(fields[1])
+
+
+class TestParentProcess(tests.TestCase):
+    """The workers of a service running in its own process."""
+
+    def setUp(self):
+        tests.TestCase.setUp(self)
+        if getattr(os, 'fork', None) is None or \
+                not os.path.isdir('/proc/self'):
+            raise tests.TestNotApplicable('needs fork and /proc')
+        # the test dir path can be too long for a unix socket
+        self.socket_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.socket_dir)
+        self.socket_path = os.path.join(self.socket_dir, 'bzr.sock')
+        self.overrideEnv('BZR_PLUGINS_AT', 'xmloutput@%s'
+                         % os.path.dirname(os.path.dirname(__file__)))
+        self.process = subprocess.Popen(
+            [sys.executable, '-c', client._bzr_script, 'start-xmlrpc',
+             '--workers', '2', '--socket', self.socket_path])
+        self.addCleanup(self.kill_all)
+        for i in range(100):
+            if client.is_running(socket_path=self.socket_path):
+                break
+            time.sleep(0.1)
+        self.workers = self.get_workers()
+        self.assertEquals(2, len(self.workers))
+
+    def get_workers(self):
+        workers = []
+        for name in os.listdir('/proc'):
+            if name.isdigit():
+                stat = _process_stat(int(name))
+                if stat is not None and stat[1] == self.process.pid:
+                    workers.append(int(name))
+        return workers
+
+    def kill_all(self):
+        for pid in [self.process.pid] + self.workers:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.process.wait()
+
+    def assertWorkersExit(self):
+        for i in range(50):
+            stats = [_process_stat(pid) for pid in self.workers]
+            if not [stat for stat in stats
+                    if stat is not None and stat[0] != 'Z']:
+                return
+            time.sleep(0.1)
+        self.fail('the workers are still running: %r' % (stats,))
+
+    def test_terminate_parent(self):
+        os.kill(self.process.pid, signal.SIGTERM)
+        self.assertEquals(0, self.process.wait())
+        self.assertWorkersExit()
+
+    def test_kill_parent(self):
+        os.kill(self.process.pid, signal.SIGKILL)
+        self.process.wait()
+        self.assertWorkersExit()
+
+
+class TestWorkerRecycling(TestForkedXmlRpcServer):
+
+    workers = 1
+    max_requests = 2
+
+    def wait_for_worker(self, not_pids=()):
+        for i in range(100):
+            pids = set(self.server._worker_pids)
+            if pids and pids != set(not_pids):
+                return pids
+            time.sleep(0.05)
+        self.fail('no new worker')
+
+    def test_worker_is_replaced(self):
+        first = self.wait_for_worker()
+        self.assertEquals('world!', self.client.hello())
+        self.assertEquals('world!', self.client.hello())
+        second = self.wait_for_worker(first)
+        self.assertEquals('world!', self.client.hello())
+        self.assertNotEquals(first, second)
+
+
+class TestThreadedWorkerRecycling(TestWorkerRecycling):
+
+    threads = 2
+    max_requests = 1
+
+    def register_functions(self):
+        def slow():
+            time.sleep(2)
+            return os.getpid()
+        self.server.register_function(slow, 'slow')
+
+    def test_running_request_finishes(self):
+        first = self.wait_for_worker()
+        results = []
+        slow_thread = threading.Thread(
+            target=lambda: results.append(self._make_client().slow()))
+        slow_thread.start()
+        time.sleep(0.2)
+        # the worker retires while the slow request is running
+        self.assertEquals('world!', self.client.hello())
+        slow_thread.join()
+        # xmlrpclib sends the request again if the connection is closed
+        self.assertEquals(list(first), results)
+        self.assertNotEquals(first, self.wait_for_worker(first))
+
+
+class TestKeepAlive(TestXmlRpcServer):
+
+    threads = 2
+    idle_timeout = 1
+    max_connections = 2
+
+    def post_hello(self, connection):
+        connection.request('POST', '/', xmlrpclib.dumps((), 'hello'))
+        response = connection.getresponse()
+        self.assertEquals(('world!',), xmlrpclib.loads(response.read())[0])
+        return response
+
+    def wait_for_open_connections(self, count):
+        for i in range(50):
+            if self.server._open_connections == count:
+                return
+            time.sleep(0.1)
+        self.assertEquals(count, self.server._open_connections)
+
+    def test_connection_is_reused(self):
+        connection = httplib.HTTPConnection(self.host, self.port)
+        response = self.post_hello(connection)
+        self.assertFalse(response.will_close)
+        sock = connection.sock
+        self.post_hello(connection)
+        self.assertIs(sock, connection.sock)
+        connection.close()
+
+    def test_pipelined_requests(self):
+        body = xmlrpclib.dumps((), 'hello')
+        request = ('POST / HTTP/1.1\r\nHost: localhost\r\n'
+                   'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+        sock = socket.create_connection((self.host, self.port))
+        try:
+            sock.sendall(request * 3)
+            for i in range(3):
+                response = httplib.HTTPResponse(sock)
+                response.begin()
+                self.assertEquals(('world!',),
+                                  xmlrpclib.loads(response.read())[0])
+        finally:
+            sock.close()
+
+    def test_idle_timeout(self):
+        connection = httplib.HTTPConnection(self.host, self.port)
+        self.post_hello(connection)
+        self.wait_for_open_connections(1)
+        time.sleep(1.5)
+        self.wait_for_open_connections(0)
+        connection.close()
+
+    def test_max_connections(self):
+        connections = [httplib.HTTPConnection(self.host, self.port)
+                       for i in range(3)]
+        for connection in connections:
+            self.post_hello(connection)
+        self.wait_for_open_connections(2)
+        for connection in connections:
+            connection.close()
+
+    def test_no_keep_alive(self):
+        self.client.quit()
+        self.thread.join()
+        self.idle_timeout = 0
+        self._start_server()
+        self.client = self._make_client()
+        connection = httplib.HTTPConnection(self.host, self.port)
+        self.assertTrue(self.post_hello(connection).will_close)
+        connection.close()
+
+    def test_pooled_transport(self):
+        server = client.get_server('http://%s:%s' % (self.host, self.port))
+        results = []
+        def call_hello():
+            results.append(server.hello())
+        threads = [threading.Thread(target=call_hello) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(['world!'] * 4, results)
+        self.assertEquals('world!', server.hello())
+        transport = server._ServerProxy__transport
+        self.assertTrue(0 < len(transport._idle) <= 4)
+        transport.close_all()
+
+
+class TestGzip(TestXmlRpcServer):
+
+    gzip_threshold = 10
+
+    def post(self, path, body, headers):
+        connection = httplib.HTTPConnection(self.host, self.port)
+        try:
+            connection.request('POST', path, body, headers)
+            response = connection.getresponse()
+            return response.getheader('Content-Encoding'), response.read()
+        finally:
+            connection.close()
+
+    def test_gzip_response(self):
+        encoding, body = self.post('/', xmlrpclib.dumps((), 'hello'),
+                                   {'Accept-Encoding': 'gzip'})
+        self.assertEquals('gzip', encoding)
+        self.assertEquals(('world!',),
+                          xmlrpclib.loads(xmlrpclib.gzip_decode(body))[0])
+
+    def test_gzip_not_accepted(self):
+        encoding, body = self.post('/', xmlrpclib.dumps((), 'hello'), {})
+        self.assertEquals(None, encoding)
+        self.assertEquals(('world!',), xmlrpclib.loads(body)[0])
+
+    def test_gzip_json_response(self):
+        if not jsonrpc.is_available:
+            raise tests.TestSkipped('json is not available')
+        encoding, body = self.post('/json',
+            '{"jsonrpc": "2.0", "id": 1, "method": "hello"}',
+            {'Accept-Encoding': 'gzip'})
+        self.assertEquals('gzip', encoding)
+        self.assertEquals('world!', jsonrpc.json.loads(
+            xmlrpclib.gzip_decode(body))['result'])
+
+    def test_gzip_disabled(self):
+        self.server.gzip_threshold = 0
+        encoding, body = self.post('/', xmlrpclib.dumps((), 'hello'),
+                                   {'Accept-Encoding': 'gzip'})
+        self.assertEquals(None, encoding)
+
+
+class TestUnixSocketXmlRpcServer(TestXmlRpcServer):
+
+    threads = 2
+
+    def setUp(self):
+        if getattr(socket, 'AF_UNIX', None) is None:
+            raise tests.TestSkipped('unix sockets are not supported')
+        # the test dir path can be too long for a unix socket
+        self.socket_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.socket_dir, 'bzr.sock')
+        TestXmlRpcServer.setUp(self)
+        self.addCleanup(shutil.rmtree, self.socket_dir)
+
+    def _start_server(self):
+        self.server = BzrXMLRPCServer(self.socket_path, threads=self.threads)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _make_client(self):
+        return client.get_server(socket_path=self.socket_path)
+
+    def test_socket_permissions(self):
+        self.assertEquals(0600, os.stat(self.socket_path).st_mode & 0777)
+
+    def test_quit_removes_socket(self):
+        self.client.quit()
+        self.thread.join()
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_stale_socket_is_replaced(self):
+        self.client.quit()
+        self.thread.join()
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.socket_path)
+        stale.close()
+        self._start_server()
+        self.assertEquals('world!', self._make_client().hello())
+
+    def test_socket_in_use(self):
+        self.assertRaises(socket.error, BzrXMLRPCServer, self.socket_path)
+
+    def test_file_is_not_removed(self):
+        path = os.path.join(self.socket_dir, 'notes.txt')
+        f = open(path, 'w')
+        try:
+            f.write('notes')
+        finally:
+            f.close()
+        e = self.assertRaises(socket.error, service._remove_stale_socket,
+                              path)
+        self.assertEquals(errno.EADDRINUSE, e.args[0])
+        self.assertTrue(os.path.exists(path))
+
+
+class TestJsonRpc(TestXmlRpcServer):
+
+    def setUp(self):
+        if not jsonrpc.is_available:
+            raise tests.TestSkipped('json is not available')
+        TestXmlRpcServer.setUp(self)
+
+    def post_json(self, body):
+        connection = httplib.HTTPConnection(self.host, self.port)
+        try:
+            connection.request('POST', '/json', jsonrpc.json.dumps(body),
+                               {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+        if not data:
+            return response.status, None
+        return response.status, jsonrpc.json.loads(data)
+
+    def test_call(self):
+        status, response = self.post_json({'jsonrpc': '2.0', 'id': 1,
+                                           'method': 'hello'})
+        self.assertEquals(200, status)
+        self.assertEquals({'jsonrpc': '2.0', 'id': 1, 'result': 'world!'},
+                          response)
+
+    def test_run_bzr(self):
+        self.permit_source_tree_branch_repo()
+        status, response = self.post_json({'jsonrpc': '2.0', 'id': 1,
+            'method': 'run_bzr',
+            'params': {'argv': ['bzr', 'xmlversion'], 'workdir': '.'}})
+        exitval, out, err = response['result']
+        self.assertEquals(0, exitval)
+        self.assertContainsRe(out, '<version>')
+
+    def test_fault_is_an_error(self):
+        status, response = self.post_json({'jsonrpc': '2.0', 'id': 1,
+            'method': 'run_bzr', 'params': [['bzr', 'no-such-command'], '.']})
+        self.assertEquals(42, response['error']['code'])
+
+    def test_method_not_found(self):
+        status, response = self.post_json({'jsonrpc': '2.0', 'id': 1,
+                                           'method': 'no_such_method'})
+        self.assertEquals(jsonrpc.METHOD_NOT_FOUND,
+                          response['error']['code'])
+
+    def test_batch_and_notification(self):
+        status, response = self.post_json([
+            {'jsonrpc': '2.0', 'id': 1, 'method': 'hello'},
+            {'jsonrpc': '2.0', 'method': 'hello'},
+            {'jsonrpc': '2.0', 'id': 2}])
+        self.assertEquals([1, 2], [item['id'] for item in response])
+        self.assertEquals(jsonrpc.INVALID_REQUEST,
+                          response[1]['error']['code'])
+        status, response = self.post_json({'jsonrpc': '2.0',
+                                           'method': 'hello'})
+        self.assertEquals((204, None), (status, response))
+
+    def test_parse_error(self):
+        connection = httplib.HTTPConnection(self.host, self.port)
+        connection.request('POST', '/json', '{"jsonrpc": ')
+        response = jsonrpc.json.loads(connection.getresponse().read())
+        connection.close()
+        self.assertEquals(jsonrpc.PARSE_ERROR, response['error']['code'])
+
+
+class TestStream(TestXmlRpcServer):
+
+    def setUp(self):
+        TestXmlRpcServer.setUp(self)
+        commands.install_bzr_command_hooks()
+
+    def stream(self, argv, method='run_bzr_command'):
+        return client.stream_bzr(argv, '.', url='http://%s:%s' % (self.host,
+                                                                   self.port),
+                                 method=method)
+
+    def test_stream_output(self):
+        output = self.stream(['bzr', 'rocks'])
+        self.assertEquals(None, output.exit_status)
+        self.assertEquals('It sure does!\n', ''.join(output))
+        self.assertEquals(0, output.exit_status)
+        self.assertEquals('', output.stderr)
+
+    def test_fault_in_trailer(self):
+        output = self.stream(['bzr', 'no-such-command'], method='run_bzr')
+        e = self.assertRaises(xmlrpclib.Fault, list, output)
+        self.assertEquals(42, e.faultCode)
+        self.assertContainsRe(e.faultString, '<error>')
+
+    def test_bad_request(self):
+        e = self.assertRaises(xmlrpclib.ProtocolError, self.stream,
+                              ['bzr', 'rocks'], method='hello')
+        self.assertEquals(400, e.errcode)
+
+
+class TestJobs(TestXmlRpcServer):
+
+    def setUp(self):
+        TestXmlRpcServer.setUp(self)
+        commands.install_bzr_command_hooks()
+
+    def test_submit_job(self):
+        job_id = self.client.submit_job(['bzr', 'rocks'], '.')
+        for i in range(100):
+            status = self.client.job_status(job_id)
+            if status['state'] == 'finished':
+                break
+            time.sleep(0.05)
+        result = self.client.job_result(job_id, 0, 2)
+        self.assertEquals(0, result['exit_status'])
+        self.assertEquals('It', result['output'].data)
+
+
+class TestChdirMode(TestXmlRpcServer):
+    """Only a service without threads, workers or jobs changes the process
+    working directory.
+    """
+
+    job_threads = 0
+    chdir = True
+
+    def register_functions(self):
+        def chdir_mode():
+            return service._chdir_thread is threading.currentThread()
+        self.server.register_function(chdir_mode, 'chdir_mode')
+
+    def test_chdir_mode(self):
+        self.assertEquals(self.chdir, self.client.chdir_mode())
+
+
+class TestChdirModeWithJobs(TestChdirMode):
+
+    job_threads = 2
+    chdir = False
+
+
+class TestMetrics(TestXmlRpcServer):
+
+    def test_metrics(self):
+        self.client.hello()
+        connection = httplib.HTTPConnection(self.host, self.port)
+        connection.request('GET', '/metrics')
+        response = connection.getresponse()
+        text = response.read()
+        connection.close()
+        self.assertEquals(200, response.status)
+        self.assertContainsRe(text,
+                              'bzr_xmlrpc_requests_total{method="hello"} 1\n')
+        self.assertContainsRe(text,
+            'bzr_xmlrpc_response_size_bytes_count{endpoint="xmlrpc"} 1\n')
+        self.assertContainsRe(self.client.metrics(),
+                              'bzr_xmlrpc_cache_hits_total{cache="objects"}')
+
+    def test_not_found(self):
+        connection = httplib.HTTPConnection(self.host, self.port)
+        connection.request('GET', '/other')
+        self.assertEquals(404, connection.getresponse().status)
+        connection.close()
+
+
+class TestRequestTimeout(TestXmlRpcServer):
+
+    request_timeout = 0.1
+
+    def setUp(self):
+        TestXmlRpcServer.setUp(self)
+        def slow():
+            time.sleep(0.2)
+            sys.stdout.write('output')
+            return 'done'
+        self.server.register_function(redirect_output(slow), 'slow')
+        self.steps = []
+        def warn():
+            time.sleep(0.2)
+            trace.warning('late')
+            self.steps.append('warned')
+            sys.stdout.write('output')
+            self.steps.append('written')
+            return 'done'
+        self.server.register_function(redirect_output(warn), 'warn')
+
+    def test_timeout(self):
+        e = self.assertRaises(xmlrpclib.Fault, self.client.slow)
+        self.assertEquals(42, e.faultCode)
+        self.assertContainsRe(e.faultString, '<class>RequestTimeout</class>')
+        self.assertEquals('world!', self.client.hello())
+
+    def test_timeout_after_warning(self):
+        # the warning can't interrupt the request, the next write does
+        e = self.assertRaises(xmlrpclib.Fault, self.client.warn)
+        self.assertContainsRe(e.faultString, '<class>RequestTimeout</class>')
+        self.assertEquals(['warned'], self.steps)
+
+    def test_client_timeout(self):
+        server = client.get_server(url='http://%s:%s' % (self.host,
+                                                          self.port),
+                                   timeout=5)
+        self.assertEquals('done', server.slow())
+
+
+class TestAdmission(TestXmlRpcServer):
+
+    threads = 2
+    max_running = 1
+    max_queued = 0
+
+    def test_overloaded(self):
+        running = threading.Event()
+        release = threading.Event()
+        def slow():
+            running.set()
+            release.wait()
+            return 'done'
+        self.server.register_function(slow, 'slow')
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(self._make_client().slow()))
+        thread.start()
+        running.wait()
+        try:
+            e = self.assertRaises(xmlrpclib.Fault, self.client.slow)
+            self.assertContainsRe(e.faultString,
+                                  '<class>ServiceOverloaded</class>')
+            # hello doesn't wait
+            self.assertEquals('world!', self.client.hello())
+        finally:
+            release.set()
+            thread.join()
+        self.assertEquals(['done'], results)
+
+
+class TestDrain(TestXmlRpcServer):
+
+    threads = 2
+
+    def setUp(self):
+        TestXmlRpcServer.setUp(self)
+        self.running = threading.Event()
+        self.release = threading.Event()
+        def slow():
+            self.running.set()
+            self.release.wait()
+            return 'done'
+        self.server.register_function(slow, 'slow')
+        self.results = []
+        self.slow_thread = threading.Thread(
+            target=lambda: self.results.append(self._make_client().slow()))
+        self.slow_thread.start()
+        self.running.wait()
+
+    def tearDown(self):
+        self.release.set()
+        self.slow_thread.join()
+        TestXmlRpcServer.tearDown(self)
+        # the pool threads that weren't waited for by the server
+        for thread in threading.enumerate():
+            if thread.getName().startswith('bzr-xmlrpc-'):
+                thread.join()
+
+    def test_drain(self):
+        self.assertEquals(1, self.client.quit(True))
+        # the listening socket is closed, but the running request finishes
+        self.assertRaises(socket.error, self._make_client().hello)
+        self.assertTrue(self.thread.isAlive())
+        self.release.set()
+        self.slow_thread.join()
+        self.thread.join()
+        self.assertEquals(['done'], self.results)
+
+    def test_drain_timeout(self):
+        self.server.drain_timeout = 0.1
+        self.client.quit(True)
+        self.thread.join()
+        self.assertEquals([], self.results)
+
+    def test_quit_doesnt_wait(self):
+        self.server.stop_timeout = 0.1
+        self.assertEquals(1, self.client.quit())
+        # the slow request is still running
+        self.thread.join(5)
+        self.assertFalse(self.thread.isAlive())
+        self.assertEquals([], self.results)
+
+
+class TestChunkedWriter(tests.TestCase):
+
+    def setUp(self):
+        tests.TestCase.setUp(self)
+        self.wfile = StringIO()
+        self.started = []
+
+    def start_stream(self):
+        self.started.append(True)
+
+    def test_chunks(self):
+        writer = service._ChunkedWriter(self, buffer_size=4)
+        writer.write('ab')
+        self.assertEquals([], self.started)
+        writer.write(u'c\xe9')
+        writer.write('')
+        writer.write('d')
+        writer.close({'X-Bzr-Exit-Status': '0'})
+        self.assertEquals([True], self.started)
+        self.assertEquals('5\r\nabc\xc3\xa9\r\n1\r\nd\r\n0\r\n'
+                          'X-Bzr-Exit-Status: 0\r\n\r\n',
+                          self.wfile.getvalue())
+
+    def test_no_output(self):
+        writer = service._ChunkedWriter(self)
+        writer.close({})
+        self.assertEquals([True], self.started)
+        self.assertEquals('0\r\n\r\n', self.wfile.getvalue())
+
+
+class TestWorkdir(tests.TestCaseWithTransport):
+
+    def setUp(self):
+        tests.TestCaseWithTransport.setUp(self)
+        commands.install_bzr_command_hooks()
+
+    def test_run_in_workdir(self):
+        self.make_branch_and_tree('one')
+        self.make_branch_and_tree('two')
+        self.build_tree(['one/one_file', 'two/two_file'])
+        cwd = os.getcwd()
+        exit, out, err = run_bzr_xml(['bzr', 'xmlstatus'],
+                                     osutils.abspath('one'))
+        self.assertContainsRe(out.data, 'one_file')
+        exit, out, err = run_bzr_xml(['bzr', 'xmlstatus'],
+                                     osutils.abspath('two'))
+        self.assertContainsRe(out.data, 'two_file')
+        self.assertEquals(cwd, os.getcwd())
+
+    def test_failed_request_keeps_cwd(self):
+        self.make_branch_and_tree('one')
+        cwd = os.getcwd()
+        self.assertRaises(Fault, run_bzr_xml, ['bzr', 'no-such-command'],
+                          osutils.abspath('one'))
+        self.assertEquals(cwd, os.getcwd())
+        self.assertEquals(cwd, osutils.getcwd())
+
+    def test_workdir_is_per_thread(self):
+        self.make_branch_and_tree('one')
+        cwd = os.getcwd()
+        workdir = osutils.abspath('one')
+        cwds = []
+        def run():
+            set_workdir(workdir)
+            try:
+                cwds.append(os.getcwd())
+            finally:
+                set_workdir(None)
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEquals([workdir], cwds)
+        self.assertEquals(cwd, os.getcwd())
+
+    def make_tree_with_file(self):
+        tree = self.make_branch_and_tree('tree')
+        self.build_tree_contents([('tree/a', 'a\n'),
+                                  ('tree/msg.txt', 'from a file\n')])
+        tree.add(['a'])
+        return tree
+
+    def check_relative_paths(self):
+        tree = self.make_tree_with_file()
+        cwd = os.getcwd()
+        workdir = osutils.abspath('tree')
+        exit, out, err = run_bzr_xml(['bzr', 'commit', '-F', 'msg.txt'],
+                                     workdir)
+        self.assertEquals(0, exit)
+        revision = tree.branch.repository.get_revision(
+            tree.branch.last_revision())
+        self.assertEquals('from a file\n', revision.message)
+        exit, out, err = run_bzr_xml(['bzr', 'export', 'out.tar'], workdir)
+        self.assertEquals(0, exit)
+        self.failUnlessExists('tree/out.tar')
+        self.failIfExists('out.tar')
+        self.assertEquals(cwd, os.getcwd())
+
+    def test_relative_paths(self):
+        self.check_relative_paths()
+
+    def test_relative_paths_with_chdir(self):
+        set_chdir_thread(threading.currentThread())
+        self.addCleanup(set_chdir_thread, None)
+        self.check_relative_paths()
+
+    def test_chdir_is_undone(self):
+        self.make_branch_and_tree('one')
+        set_chdir_thread(threading.currentThread())
+        self.addCleanup(set_chdir_thread, None)
+        cwd = os.getcwd()
+        self.assertRaises(Fault, run_bzr_xml, ['bzr', 'no-such-command'],
+                          osutils.abspath('one'))
+        self.assertEquals(cwd, os.getcwd())
+
+    def test_resolve_path_arguments(self):
+        workdir = osutils.abspath('.')
+        self.assertEquals(
+            ['bzr', 'commit', '-F', workdir + '/msg', '-m', 'x'],
+            resolve_path_arguments(['bzr', 'commit', '-F', 'msg', '-m', 'x']))
+        self.assertEquals(
+            ['bzr', 'commit', '-F' + workdir + '/msg', '--strict'],
+            resolve_path_arguments(['bzr', 'commit', '-Fmsg', '--strict']))
+        self.assertEquals(
+            ['bzr', 'ci', '--file=' + workdir + '/msg', 'a'],
+            resolve_path_arguments(['bzr', 'ci', '--file=msg', 'a']))
+        self.assertEquals(
+            ['bzr', 'export', '-r', '1', workdir + '/out.tar', 'b'],
+            resolve_path_arguments(['bzr', 'export', '-r', '1', 'out.tar',
+                                    'b']))
+        self.assertEquals(
+            ['bzr', 'send', '-o', '-', '/tmp/b'],
+            resolve_path_arguments(['bzr', 'send', '-o', '-', '/tmp/b']))
+        self.assertEquals(['bzr', 'status', 'a'],
+                          resolve_path_arguments(['bzr', 'status', 'a']))
+
+
+class TestBatch(tests.TestCaseWithTransport):
+
+    def setUp(self):
+        tests.TestCaseWithTransport.setUp(self)
+        commands.install_bzr_command_hooks()
+        self.tree = self.make_branch_and_tree('tree')
+        self.build_tree(['tree/a'])
+        self.tree.commit('first')
+
+    def test_run_bzr_batch(self):
+        results = run_bzr_batch([['bzr', 'xmlstatus'],
+                                 ['bzr', 'xmllog', '-l', '1'],
+                                 ['bzr', 'no-such-command']],
+                                osutils.abspath('tree'))
+        self.assertEquals(3, len(results))
+        self.assertContainsRe(results[0][1].data, '<unknown>')
+        self.assertContainsRe(results[1][1].data, 'first')
+        self.assertEquals(42, results[2]['faultCode'])
+        self.assertFalse(self.tree.branch.is_locked())
+
+    def test_objects_are_reused(self):
+        object_cache = cache.ObjectCache()
+        cache.install_object_cache(object_cache)
+        self.addCleanup(cache.install_object_cache, None)
+        locked = []
+        lock_read = branch.BzrBranch.lock_read
+        def record_lock_read(a_branch):
+            locked.append(a_branch)
+            return lock_read(a_branch)
+        self.overrideAttr(branch.BzrBranch, 'lock_read', record_lock_read)
+        results = run_bzr_batch([['bzr', 'xmlstatus'], ['bzr', 'xmlinfo'],
+                                 ['bzr', 'xmllog']], osutils.abspath('tree'))
+        self.assertContainsRe(results[1][1].data, '<info>')
+        self.assertContainsRe(results[2][1].data, 'first')
+        self.assertEquals(1, object_cache.misses)
+        self.assertEquals(1, len(set([id(b) for b in locked])))
+
+
+class TestProfile(tests.TestCaseWithTransport):
+
+    def setUp(self):
+        tests.TestCaseWithTransport.setUp(self)
+        commands.install_bzr_command_hooks()
+
+    def test_profile_bzr(self):
+        exitval, out, err, stats = profile_bzr(['bzr', 'rocks'], '.')
+        self.assertEquals((0, 'It sure does!\n', ''), (exitval, out.data, err))
+        self.build_tree_contents([('stats', stats.data)])
+        profile_stats = pstats.Stats('stats')
+        self.assertTrue('run_bzr' in [function for filename, line, function
+                                      in profile_stats.stats])
+
+    def test_fault(self):
+        self.assertRaises(Fault, profile_bzr, ['bzr', 'no-such-command'], '.')
+
+
+class TestRedirectOutput(tests.TestCase):
+
+    def test_output_is_captured_per_thread(self):
+        first_wrote = threading.Event()
+        second_wrote = threading.Event()
+        results = {}
+
+        @redirect_output
+        def write(name, wait_for, notify):
+            sys.stdout.write(name)
+            notify.set()
+            wait_for.wait(5)
+            sys.stdout.write(name)
+            return sys.stdout.getvalue()
+
+        def run(name, wait_for, notify):
+            results[name] = write(name, wait_for, notify)
+
+        threads = [
+            threading.Thread(target=run,
+                             args=('first', second_wrote, first_wrote)),
+            threading.Thread(target=run,
+                             args=('second', first_wrote, second_wrote))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals('firstfirst', results['first'])
+        self.assertEquals('secondsecond', results['second'])
+
+    def test_restores_stdout(self):
+        stdout = sys.stdout
+        @redirect_output
+        def write():
+            sys.stdout.write('foo')
+            return sys.stdout.getvalue()
+        self.assertEquals('foo', write())
+        self.assertIs(stdout, sys.stdout)
@@ -0,0 +1,116 @@
+# -*- encoding: utf-8 -*-
+
+"""Tests for the xmlrpc methods that return structs."""
+
+import xmlrpclib
+from xmlrpclib import Fault
+
+from bzrlib import (
+    commands,
+    osutils,
+    tests,
+    )
+from bzrlib.plugins.xmloutput import structured
+
+
+class TestStructuredMethods(tests.TestCaseWithTransport):
+
+    def setUp(self):
+        tests.TestCaseWithTransport.setUp(self)
+        commands.install_bzr_command_hooks()
+        self.tree = self.make_branch_and_tree('tree')
+        self.build_tree(['tree/a', 'tree/dir/'])
+        self.tree.add(['a', 'dir'], ['a-id', 'dir-id'])
+        self.tree.commit('first', rev_id='rev-1')
+        self.workdir = osutils.abspath('tree')
+
+    def test_status(self):
+        self.build_tree_contents([('tree/a', 'changed\n'), ('tree/b', '')])
+        result = structured.status(self.workdir, [], '', False, True)
+        self.assertEquals([{'path': 'a', 'kind': 'file', 'id': 'a-id'}],
+                          result['modified'])
+        self.assertEquals([{'path': 'b', 'kind': 'file'}], result['unknown'])
+        self.assertFalse('added' in result)
+
+    def test_status_versioned(self):
+        self.build_tree(['tree/b'])
+        result = structured.status(self.workdir, versioned=True)
+        self.assertFalse('unknown' in result)
+
+    def test_log(self):
+        other = self.tree.bzrdir.sprout('other').open_workingtree()
+        other.commit('merged', rev_id='rev-merged')
+        self.tree.merge_from_branch(other.branch)
+        self.tree.commit('merge', rev_id='rev-2')
+        revisions = structured.log(self.workdir, show_ids=True)
+        self.assertEquals(['2', '1'], [r['revno'] for r in revisions])
+        self.assertEquals('rev-2', revisions[0]['revisionid'])
+        self.assertEquals(['merged'],
+                          [r['message'] for r in revisions[0]['merges']])
+        self.assertFalse('merges' in revisions[1])
+
+    def test_log_verbose_limit(self):
+        self.build_tree(['tree/b'])
+        self.tree.add('b')
+        self.tree.commit('second')
+        revisions = structured.log(self.workdir, '', '', 1, True)
+        self.assertEquals(1, len(revisions))
+        self.assertEquals([{'path': 'b', 'kind': 'file'}],
+                          revisions[0]['affected_files']['added'])
+
+    def test_log_revision(self):
+        self.tree.commit('second')
+        revisions = structured.log(self.workdir, revision='1')
+        self.assertEquals(['first'], [r['message'] for r in revisions])
+
+    def test_ls(self):
+        self.build_tree(['tree/b'])
+        result = structured.ls(self.workdir)
+        self.assertEquals([('a', 'versioned'), ('b', 'unknown'),
+                           ('dir', 'versioned')],
+                          sorted([(item['path'], item['status_kind'])
+                                  for item in result]))
+        self.assertEquals(['a'], [item['path'] for item in
+                                  structured.ls(self.workdir, revision='1',
+                                                kind='file')])
+
+    def test_annotate(self):
+        result = structured.annotate(self.workdir, 'a', show_ids=True)
+        self.assertEquals('a', result['file'])
+        self.assertEquals([('1', 'rev-1', u'contents of tree/a')],
+                          [(line['revno'], line['revisionid'], line['text'])
+                           for line in result['lines']])
+
+    def test_info(self):
+        result = structured.info(self.workdir)
+        self.assertEquals('Standalone tree', result['layout'])
+        self.assertTrue(isinstance(result['formats'], list))
+        self.assertTrue('branch_root' in result['location'])
+
+    def test_missing(self):
+        other = self.tree.bzrdir.sprout('other').open_workingtree()
+        other.commit('theirs')
+        result = structured.missing(self.workdir, osutils.abspath('other'))
+        self.assertEquals(['theirs'],
+                          [r['message'] for r in result['missing_revisions']])
+        self.assertFalse('extra_revisions' in result)
+
+    def round_trip(self, result):
+        """Return result as received by a xmlrpc client."""
+        return xmlrpclib.loads(xmlrpclib.dumps((result,),
+                                               methodresponse=True))[0][0]
+
+    def test_invalid_xml_chars(self):
+        self.build_tree_contents([('tree/a', 'int a;\x0c\nint b;\n')])
+        self.tree.commit(u'control\x01char')
+        result = self.round_trip(structured.annotate(self.workdir, 'a'))
+        self.assertEquals([u'int a;\ufffd', u'int b;'],
+                          [line['text'] for line in result['lines']])
+        result = self.round_trip(structured.log(self.workdir, limit=1))
+        self.assertEquals(u'control\ufffdchar', result[0]['message'])
+
+    def test_bzr_error_is_a_fault(self):
+        e = self.assertRaises(Fault, structured.annotate, self.workdir,
+                              'unknown')
+        self.assertEquals(42, e.faultCode)
+        self.assertContainsRe(e.faultString, 'NotVersionedError')
@@ -0,0 +1,114 @@
+# -*- encoding: utf-8 -*-
+
+"""Tests for the timing breakdown and the timeouts of the requests."""
+
+import time
+import xmlrpclib
+
+from bzrlib import (
+    commands,
+    osutils,
+    tests,
+    )
+from bzrlib.plugins.xmloutput import (
+    service,
+    timing,
+    )
+
+
+class TestTiming(tests.TestCase):
+
+    def tearDown(self):
+        if getattr(timing._state, 'timings', None) is not None:
+            timing.stop()
+        tests.TestCase.tearDown(self)
+
+    def test_nested_calls_are_counted_once(self):
+        timing.start()
+        timing.call('open', timing.call, 'lock', lambda: None)
+        timing.add('run', 1.0)
+        totals = timing.stop()
+        self.assertEquals(['open', 'run'], sorted(totals))
+        self.assertEquals(1.0, totals['run'])
+
+    def test_not_timing(self):
+        self.assertEquals(3, timing.call('open', lambda x: x, 3))
+        timing.add('run', 1.0)
+
+
+class TestDeadline(tests.TestCase):
+
+    def setUp(self):
+        tests.TestCase.setUp(self)
+        timing.set_request_timeout(0.01)
+        self.addCleanup(timing.set_request_timeout, None)
+
+    def test_interrupted_at_safe_point(self):
+        calls = []
+        def slow():
+            time.sleep(0.02)
+            timing.check_deadline()
+            calls.append('not reached')
+        self.assertRaises(timing.RequestTimeout, timing.call_with_deadline,
+                          slow)
+        self.assertEquals([], calls)
+
+    def test_interruption_is_raised_again(self):
+        calls = []
+        def slow():
+            time.sleep(0.02)
+            try:
+                timing.check_deadline()
+            except timing.RequestTimeout:
+                pass
+            timing.check_deadline()
+            calls.append('not reached')
+        self.assertRaises(timing.RequestTimeout, timing.call_with_deadline,
+                          slow)
+        self.assertEquals([], calls)
+
+    def test_in_time(self):
+        self.assertEquals(1, timing.call_with_deadline(lambda: 1))
+
+    def test_no_timeout(self):
+        timing.set_request_timeout(None)
+        def slow():
+            time.sleep(0.02)
+            timing.check_deadline()
+            return 1
+        self.assertEquals(1, timing.call_with_deadline(slow))
+
+
+class TestRunBzrTimings(tests.TestCaseWithTransport):
+
+    def setUp(self):
+        tests.TestCaseWithTransport.setUp(self)
+        commands.install_bzr_command_hooks()
+        self.make_branch_and_tree('tree')
+
+    def test_timings(self):
+        response = service.run_bzr_xml(['bzr', 'xmlstatus'],
+                                       osutils.abspath('tree'), True)
+        self.assertEquals(4, len(response))
+        breakdown = response[3]
+        self.assertEquals(['encode', 'lock', 'open', 'run', 'total',
+                           'write'], sorted(breakdown))
+        self.assertTrue(breakdown['open'] > 0)
+        self.assertTrue(breakdown['lock'] > 0)
+        self.assertTrue(breakdown['write'] > 0)
+        self.assertTrue(breakdown['total'] >= breakdown['run'])
+
+    def test_encode_is_the_marshalling(self):
+        dumps = xmlrpclib.dumps
+        def slow_dumps(*args, **kwargs):
+            time.sleep(0.05)
+            return dumps(*args, **kwargs)
+        self.overrideAttr(xmlrpclib, 'dumps', slow_dumps)
+        response = service.run_bzr_xml(['bzr', 'xmlstatus'],
+                                       osutils.abspath('tree'), True)
+        self.assertTrue(response[3]['encode'] >= 0.05)
+
+    def test_no_timings(self):
+        response = service.run_bzr_xml(['bzr', 'xmlstatus'],
+                                       osutils.abspath('tree'))
+        self.assertEquals(3, len(response))
@@ -0,0 +1,238 @@
+# -*- encoding: utf-8 -*-
+# Copyright (C) 2009 Guillermo Gonzalez
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA
+#
+"""Breakdown of the time spent by a request, and request timeouts.
+
+While a thread is between start() and stop(), the time spent in the
+instrumented functions is added to its timings by category:
+
+ * open: opening control dirs, trees and branches
+ * lock: locking the opened trees and branches
+ * write: writing the output of the command (including the xml)
+
+The instrumentation is installed the first time it's used, and it does
+nothing for the threads that aren't timing a request. Nested calls are only
+counted once, in the category of the outermost one.
+
+The instrumented functions (and the writes to the stdout of the requests)
+are also the safe points where a request that took longer than its timeout
+is interrupted, raising RequestTimeout (see call_with_deadline). The locks
+taken by the command are released as the exception propagates, unlocking
+isn't a safe point.
+"""
+
+import threading
+import time
+
+from bzrlib.lazy_import import lazy_import
+lazy_import(globals(), """
+from bzrlib import (
+    branch as _mod_branch,
+    workingtree,
+    )
+""")
+from bzrlib import errors
+try:
+    from bzrlib.controldir import ControlDir
+except ImportError:
+    # bzr < 2.2
+    from bzrlib.bzrdir import BzrDir as ControlDir
+
+_lock_methods = ('lock_read', 'lock_write', 'lock_tree_write')
+
+_state = threading.local()
+_hooks_installed = False
+
+
+class RequestTimeout(errors.BzrError):
+
+    _fmt = 'The request took more than %(timeout)s seconds.'
+
+    def __init__(self, timeout):
+        errors.BzrError.__init__(self, timeout=timeout)
+
+
+class _Timings(object):
+
+    def __init__(self):
+        self.totals = {}
+        self.active = None
+
+    def add(self, category, seconds):
+        self.totals[category] = self.totals.get(category, 0.0) + seconds
+
+
+def start():
+    """Start timing a request in this thread."""
+    install_hooks()
+    _state.timings = _Timings()
+
+
+def stop():
+    """Stop timing the request of this thread.
+
+    :return: a dict of category: seconds.
+    """
+    timings = _state.timings
+    _state.timings = None
+    return timings.totals
+
+
+def add(category, seconds):
+    """Add seconds to category, if this thread is timing a request."""
+    timings = getattr(_state, 'timings', None)
+    if timings is not None:
+        timings.add(category, seconds)
+
+
+def call(category, func, *args, **kwargs):
+    """Call func, adding the time it takes to category."""
+    check_deadline()
+    timings = getattr(_state, 'timings', None)
+    if timings is None or timings.active is not None:
+        return func(*args, **kwargs)
+    timings.active = category
+    start_time = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        timings.active = None
+        timings.add(category, time.time() - start_time)
+
+
+def set_request_timeout(timeout):
+    """Set the timeout in seconds of the request handled by this thread
+    (None or 0 for no timeout).
+    """
+    _state.request_timeout = timeout
+
+
+def call_with_deadline(func, *args, **kwargs):
+    """Call func, interrupting it at the next safe point after the request
+    timeout of this thread expires.
+
+    RequestTimeout is raised if the timeout expired, even if func handled
+    the interruption.
+    """
+    timeout = getattr(_state, 'request_timeout', None)
+    if not timeout or getattr(_state, 'deadline', None) is not None:
+        # no timeout, or already running with a deadline
+        return func(*args, **kwargs)
+    install_hooks()
+    _state.deadline = time.time() + timeout
+    _state.expired = False
+    try:
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            if _state.expired:
+                raise RequestTimeout(timeout)
+            raise
+    finally:
+        _state.deadline = None
+    if _state.expired:
+        raise RequestTimeout(timeout)
+    return result
+
+
+def check_deadline():
+    """A safe point, raise RequestTimeout if the request of this thread
+    must be interrupted.
+
+    It's raised at every safe point until the request returns from
+    call_with_deadline, in case the code between them handled the first one.
+    """
+    deadline = getattr(_state, 'deadline', None)
+    if deadline is None or time.time() <= deadline:
+        return
+    _state.expired = True
+    raise RequestTimeout(_state.request_timeout)
+
+
+def timed(category, func):
+    """Return a function that calls func timing it in category."""
+    def timed_func(*args, **kwargs):
+        return call(category, func, *args, **kwargs)
+    timed_func.__doc__ = func.__doc__
+    timed_func.__name__ = func.__name__
+    timed_func._timed = True
+    return timed_func
+
+
+def _timed_open(func):
+    """Time func as open, instrumenting the locks of what it opens."""
+    def open_func(*args, **kwargs):
+        result = call('open', func, *args, **kwargs)
+        if isinstance(result, tuple):
+            objects = result
+        else:
+            objects = (result,)
+        for obj in objects:
+            if getattr(obj, 'lock_read', None) is not None:
+                _instrument_locks(obj.__class__)
+        return result
+    open_func.__doc__ = func.__doc__
+    open_func.__name__ = func.__name__
+    return open_func
+
+
+def _instrument_locks(cls):
+    """Time the lock methods of cls (in the class that defines them)."""
+    for name in _lock_methods:
+        for klass in cls.__mro__:
+            method = klass.__dict__.get(name)
+            if method is None:
+                continue
+            if not getattr(method, '_timed', False):
+                setattr(klass, name, timed('lock', method))
+            break
+
+
+def install_hooks():
+    """Instrument the bzrlib functions that open trees and branches."""
+    global _hooks_installed
+    if _hooks_installed:
+        return
+    _hooks_installed = True
+    for cls, name in [(ControlDir, 'open_containing_tree_or_branch'),
+                      (ControlDir, 'open_containing'),
+                      (ControlDir, 'open'),
+                      (workingtree.WorkingTree, 'open_containing'),
+                      (workingtree.WorkingTree, 'open'),
+                      (_mod_branch.Branch, 'open_containing'),
+                      (_mod_branch.Branch, 'open')]:
+        method = cls.__dict__[name]
+        if isinstance(method, classmethod):
+            setattr(cls, name, classmethod(_timed_open(method.__func__)))
+        elif isinstance(method, staticmethod):
+            setattr(cls, name, staticmethod(_timed_open(method.__func__)))
+
+
+class TimedOutput(object):
+    """A file-like object that times the writes to the wrapped file."""
+
+    def __init__(self, to_file):
+        self._file = to_file
+
+    def write(self, data):
+        return call('write', self._file.write, data)
+
+    def writelines(self, lines):
+        return call('write', self._file.writelines, lines)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)